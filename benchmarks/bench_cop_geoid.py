@@ -0,0 +1,66 @@
+"""Compare the COP pixel-copy + geoid offset path against the full gdal.Warp
+
+Both write a WGS84-height DEM for the same bbox. Prints each one's wall time,
+and the largest height difference between the two outputs.
+Needs GDAL, and network access unless `--vrt-filename` points to local tiles.
+
+Usage:
+    python benchmarks/bench_cop_geoid.py --bbox -156 19 -154 21 [--outdir /tmp]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from sardem import cop_dem
+
+
+def _run(output_name, bbox, vrt_filename, pixel_copy):
+    t0 = time.perf_counter()
+    cop_dem.download_and_stitch(
+        output_name,
+        bbox,
+        keep_egm=False,
+        vrt_filename=vrt_filename,
+        output_type="float32",
+        pixel_copy=pixel_copy,
+    )
+    return time.perf_counter() - t0
+
+
+def _read(filename):
+    from osgeo import gdal
+
+    ds = gdal.Open(filename)
+    arr = ds.GetRasterBand(1).ReadAsArray()
+    ds = None
+    return arr
+
+
+def main(bbox, outdir=".", vrt_filename=None):
+    warp_file = os.path.join(outdir, "cop_warp.tif")
+    copy_file = os.path.join(outdir, "cop_pixel_copy.tif")
+    # The first run also fills GDAL's and sardem's caches: time each path cold
+    t_warp = _run(warp_file, bbox, vrt_filename, pixel_copy=False)
+    t_copy = _run(copy_file, bbox, vrt_filename, pixel_copy=True)
+    # Second pixel-copy run reuses the cached undulation grid
+    t_copy2 = _run(copy_file, bbox, vrt_filename, pixel_copy=True)
+
+    warped, copied = _read(warp_file), _read(copy_file)
+    print("Output shape: {}".format(copied.shape))
+    print("{:<34s}{:8.2f} s".format("gdal.Warp (PROJ geoid shift)", t_warp))
+    print("{:<34s}{:8.2f} s".format("Translate + offset", t_copy))
+    print("{:<34s}{:8.2f} s".format("Translate + cached offset", t_copy2))
+    diff = np.abs(warped.astype(float) - copied)[(warped != 0) & (copied != 0)]
+    print("Max height difference: {:.4f} m".format(diff.max()))
+    print("Pixels differing by > 1 cm: {}".format(np.count_nonzero(diff > 0.01)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bbox", nargs=4, type=float, required=True)
+    parser.add_argument("--outdir", default=".")
+    parser.add_argument("--vrt-filename")
+    args = parser.parse_args()
+    main(args.bbox, args.outdir, args.vrt_filename)
@@ -0,0 +1,60 @@
+"""Benchmark the interpolation backends against `bilinear_interpolate`
+
+Usage:
+    python benchmarks/bench_interpolation.py [--size 2000] [--rate 3]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from sardem import upsample
+
+
+def _time(func, repeat=3):
+    """Best wall time of `repeat` calls to `func`"""
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(size=2000, rate=3, repeat=3):
+    rng = np.random.default_rng(0)
+    arr = rng.integers(-100, 4000, size=(size, size)).astype(np.int16)
+    xi = np.linspace(0, size - 1, size * rate)
+    yi = np.linspace(0, size - 1, size * rate)
+    print("Upsampling {0}x{0} int16 by {1}x{1}".format(size, rate))
+
+    t = _time(
+        lambda: upsample.bilinear_interpolate(
+            arr.astype(float), xi.reshape(1, -1), yi.reshape(-1, 1)
+        ),
+        repeat,
+    )
+    print("{:<30s}{:8.3f} s".format("bilinear_interpolate", t))
+
+    backends = ["numpy"]
+    try:
+        upsample.set_backend("numba")
+        backends.append("numba")
+    except ImportError:
+        print("numba not installed: skipping numba backend")
+    for backend in backends:
+        upsample.set_backend(backend)
+        for method in upsample.RESAMPLE_METHODS:
+            # Compile before timing
+            upsample.separable_resample(arr[:10, :10], xi[:5], yi[:5], method)
+            t = _time(lambda: upsample.separable_resample(arr, xi, yi, method), repeat)
+            print("{:<30s}{:8.3f} s".format("{} ({})".format(method, backend), t))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=2000)
+    parser.add_argument("--rate", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.size, args.rate, args.repeat)
@@ -0,0 +1,136 @@
+"""Time GDAL reads through /vsicurl/ with each of the `remote_io` presets
+
+Serves a tiled GeoTIFF from a local HTTP server which answers Range requests,
+adding `--latency` to each request to stand in for a remote object store.
+For each preset, prints the wall time to open the file and read a window of
+it, the number of HTTP requests, and the number of bytes sent.
+Needs GDAL. The server speaks HTTP/1.1 only, so this measures the range
+merging, directory listing and caching options, not HTTP/2 multiplexing.
+
+Usage:
+    python benchmarks/bench_remote_io.py [--latency 0.05] [--size 3600]
+"""
+import argparse
+import os
+import re
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from sardem import remote_io
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """Serves "bytes=start-end" ranges of files after a delay, counting requests"""
+
+    latency = 0.0
+    num_requests = 0
+    bytes_sent = 0
+    lock = threading.Lock()
+
+    def send_head(self):
+        time.sleep(self.latency)
+        with self.lock:
+            RangeHandler.num_requests += 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, "_remaining", None)
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        with self.lock:
+            RangeHandler.bytes_sent += remaining
+        outputfile.write(source.read(remaining))
+
+    def log_message(self, *args):
+        pass
+
+
+def _write_tile(filename, size):
+    from osgeo import gdal
+
+    # Smooth "terrain", so the compressed blocks have realistic sizes
+    y, x = np.mgrid[:size, :size] / size
+    data = (1000 * np.sin(6 * x) * np.cos(4 * y)).astype(np.float32)
+    ds = gdal.GetDriverByName("GTiff").Create(
+        filename,
+        size,
+        size,
+        1,
+        gdal.GDT_Float32,
+        options=["TILED=YES", "BLOCKXSIZE=1024", "BLOCKYSIZE=1024", "COMPRESS=LZW"],
+    )
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+
+
+def _read(url, size):
+    from osgeo import gdal
+
+    t0 = time.perf_counter()
+    ds = gdal.Open(url)
+    # A window which isn't aligned with the blocks
+    ds.GetRasterBand(1).ReadAsArray(size // 5, size // 5, size // 2, size // 2)
+    ds = None
+    return time.perf_counter() - t0
+
+
+def main(latency=0.05, size=3600):
+    from osgeo import gdal
+
+    gdal.UseExceptions()
+    RangeHandler.latency = latency
+    with tempfile.TemporaryDirectory() as tmpdir:
+        handler = partial(RangeHandler, directory=tmpdir)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+        header = ("preset", "time (s)", "requests", "MB sent")
+        print("{:<8s}{:>10s}{:>10s}{:>12s}".format(*header))
+        for preset in remote_io.PRESETS:
+            # A new file for each preset, so nothing is read from GDAL's caches
+            name = "tile_{}.tif".format(preset)
+            _write_tile(os.path.join(tmpdir, name), size)
+            RangeHandler.num_requests = RangeHandler.bytes_sent = 0
+            remote_io.set_profile(preset)
+            with remote_io.gdal_config(builtin=True):
+                elapsed = _read("/vsicurl/{}/{}".format(base_url, name), size)
+            print(
+                "{:<8s}{:>10.2f}{:>10d}{:>12.1f}".format(
+                    preset,
+                    elapsed,
+                    RangeHandler.num_requests,
+                    RangeHandler.bytes_sent / 1e6,
+                )
+            )
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Seconds added to each request"
+    )
+    parser.add_argument("--size", type=int, default=3600, help="Tile size in pixels")
+    args = parser.parse_args()
+    main(args.latency, args.size)
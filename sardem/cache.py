@@ -0,0 +1,217 @@
+"""Size-bounded management of the sardem download cache
+
+Everything downloaded by sardem (.hgt/.raw tiles, geoid grids, cookies...)
+goes into `utils.get_cache_dir()`. To keep it from filling the disk, the cache
+has a byte budget, and the least recently used files are evicted first.
+
+Accesses are tracked by setting each file's access time explicitly with
+`touch`, so eviction works the same on filesystems mounted `noatime`.
+
+The budget is DEFAULT_MAX_SIZE, or the SARDEM_CACHE_SIZE environment variable
+(e.g. "20G", "500M", or a number of bytes).
+"""
+import contextlib
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks
+    fcntl = None
+
+from sardem import utils
+
+logger = logging.getLogger("sardem")
+
+DEFAULT_MAX_SIZE = "20G"
+MAX_SIZE_ENV = "SARDEM_CACHE_SIZE"
+# Files which are still being written, or which coordinate writers
+IN_PROGRESS_SUFFIXES = (".part", ".tmp", ".lock")
+# The automatic pruning after a download never evicts files used this
+# recently: other jobs sharing the cache may be about to read them
+RECENT_USE_SECONDS = 3600
+
+_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size):
+    """Convert a size like "20G" or "512M" to a number of bytes
+
+    Examples:
+        >>> parse_size("20G")
+        21474836480
+        >>> parse_size("1.5k")
+        1536
+        >>> parse_size(1000)
+        1000
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1] if size and size[-1] in _UNITS else ""
+    number = size[: len(size) - len(unit)]
+    try:
+        return int(float(number) * _UNITS[unit])
+    except ValueError:
+        raise ValueError("Invalid cache size: {}".format(size))
+
+
+def get_max_size():
+    """Cache budget in bytes, from SARDEM_CACHE_SIZE or DEFAULT_MAX_SIZE"""
+    return parse_size(os.getenv(MAX_SIZE_ENV, DEFAULT_MAX_SIZE))
+
+
+def touch(path):
+    """Record an access to `path` by setting its access time to now"""
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock for creating `path`, shared across processes
+
+    Uses an advisory fcntl lock on `path`.lock, so concurrent sardem jobs
+    (or threads) sharing one cache wait for each other instead of writing
+    the same file. The lock is released if the process dies.
+    On platforms without fcntl, this does nothing.
+
+    Callers must re-check whether `path` exists once they hold the lock.
+    The .lock file is removed once `path` exists: anyone still waiting on
+    it will then see `path` and not write it again.
+    """
+    lock_path = path + ".lock"
+    with open(lock_path, "a") as f:
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.path.exists(path):
+                try:
+                    os.remove(lock_path)
+                except OSError:
+                    pass
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def list_files(cache_dir=None):
+    """List the files in the cache, least recently used first
+
+    Returns:
+        list[tuple[str, int, float]]: (path, size in bytes, access time)
+    """
+    cache_dir = cache_dir or utils.get_cache_dir()
+    files = []
+    for root, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename.endswith(IN_PROGRESS_SUFFIXES):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Removed while we were walking
+                continue
+            files.append((path, st.st_size, st.st_atime))
+    return sorted(files, key=lambda f: f[2])
+
+
+def stats(cache_dir=None):
+    """Summarize the cache contents
+
+    Returns:
+        dict: with keys "cache_dir", "num_files", "total_bytes", "max_bytes",
+            "oldest_access" and "newest_access" (None if empty)
+    """
+    cache_dir = cache_dir or utils.get_cache_dir()
+    files = list_files(cache_dir)
+    return {
+        "cache_dir": cache_dir,
+        "num_files": len(files),
+        "total_bytes": sum(size for _, size, _ in files),
+        "max_bytes": get_max_size(),
+        "oldest_access": files[0][2] if files else None,
+        "newest_access": files[-1][2] if files else None,
+    }
+
+
+def prune(max_bytes=None, cache_dir=None, keep=(), min_age=0):
+    """Evict least recently used files until the cache fits in `max_bytes`
+
+    Args:
+        max_bytes (int): cache budget in bytes. Defaults to `get_max_size()`
+        cache_dir (str): cache to prune. Defaults to `utils.get_cache_dir()`
+        keep (Iterable[str]): paths which must not be removed, e.g. the tiles
+            in use by the current run
+        min_age (float): files accessed within the last `min_age` seconds
+            are not removed either, e.g. RECENT_USE_SECONDS to protect the
+            tiles of concurrent jobs. The cache may then stay over budget.
+
+    Returns:
+        list[str]: paths of the removed files
+    """
+    if max_bytes is None:
+        max_bytes = get_max_size()
+    keep = set(os.path.abspath(p) for p in keep if p)
+    cutoff = time.time() - min_age
+    files = list_files(cache_dir)
+    total = sum(size for _, size, _ in files)
+    removed = []
+    for path, size, atime in files:
+        if total <= max_bytes or atime > cutoff:
+            # Files are sorted by access time: the rest are all more recent
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed.append(path)
+    if removed:
+        logger.info(
+            "Evicted %d files from cache to stay under %s bytes", len(removed), max_bytes
+        )
+    if total > max_bytes:
+        logger.info(
+            "Cache is %s bytes, over its %s byte budget: the rest is in use",
+            total,
+            max_bytes,
+        )
+    return removed
+
+
+def clear(cache_dir=None):
+    """Remove everything from the cache
+
+    Returns:
+        list[str]: paths of the removed files
+    """
+    return prune(max_bytes=0, cache_dir=cache_dir)
+
+
+def format_size(num_bytes):
+    """Human readable byte count
+
+    Examples:
+        >>> format_size(1536)
+        '1.5K'
+        >>> format_size(12)
+        '12B'
+    """
+    for unit in ("B", "K", "M", "G"):
+        if abs(num_bytes) < 1024:
+            break
+        num_bytes /= 1024.0
+    else:
+        unit = "T"
+    if unit == "B":
+        return "{}B".format(int(num_bytes))
+    return "{:.1f}{}".format(num_bytes, unit)
@@ -3,6 +3,8 @@ Command line interface for running sardem
 """
 
 import json
+import os
+import sys
 from argparse import (
     ArgumentError,
     ArgumentParser,
@@ -10,9 +12,11 @@ from argparse import (
     FileType,
     RawTextHelpFormatter,
 )
+from datetime import datetime
 
 from sardem.download import Downloader
-from sardem import utils
+from sardem.upsample import RESAMPLE_METHODS
+from sardem import remote_io, utils
 
 
 def positive_small_int(argstring):
@@ -24,6 +28,32 @@ def positive_small_int(argstring):
     return intval
 
 
+def positive_float(argstring):
+    try:
+        val = float(argstring)
+        assert val > 0
+    except (ValueError, AssertionError):
+        raise ArgumentTypeError("must be a positive number: {}".format(argstring))
+    return val
+
+
+def positive_int(argstring):
+    try:
+        intval = int(argstring)
+        assert intval > 0
+    except (ValueError, AssertionError):
+        raise ArgumentTypeError("must be a positive integer: {}".format(argstring))
+    return intval
+
+
+def gdal_option(argstring):
+    try:
+        remote_io.parse_overrides([argstring])
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+    return argstring
+
+
 DESCRIPTION = """Download and stitch DEM data for local InSAR processing.
 
     Pick a lat/lon bounding box for a DEM, and it will download
@@ -36,12 +66,16 @@ DESCRIPTION = """Download and stitch DEM data for local InSAR processing.
     Usage Examples:
         sardem --bbox -156 18.8 -154.7 20.3  # bounding box: [left  bottom  right top]
         sardem -156.0 20.2 1 2 --xrate 2 --yrate 2  # Makes a box 1 degree wide, 2 deg high
+        sardem --bbox -156 18.8 -154.7 20.3 --target-res 0.0002  # Any output pixel size
+        sardem --bbox -156 18.8 -154.7 20.3 --looks 10 10  # Average 10x10 pixel blocks
         sardem --bbox -156 18.8 -154.7 20.3 --data-source COP  # Copernicus DEM
         sardem --geojson dem_area.geojson -x 11 -y 3 # Use geojson file to define area
         sardem --bbox -156 18.8 -154.7 20.3 --data-source NASA_WATER -o my_watermask.wbd # Water mask
         sardem --bbox -156 18.8 -154.7 20.3 --data COP -isce  # Generate .isce XML files as well
         sardem --bbox -104 30 -103 31 --data-source 3DEP  # USGS 3DEP lidar DEM (US only)
         sardem --bbox -104 30 -103 31 --data-source NISAR  # NISAR DEM (requires Earthdata login)
+        sardem cache stats  # Size of the download cache (also: prune, clear)
+        sardem prefetch --aoi-file frames.geojson  # Download NASA tiles ahead of time
 
 
     Default out is elevation.tif for GTiff format (the default).
@@ -110,6 +144,40 @@ def get_cli_args():
         type=positive_small_int,
         help="Rate in y dir to upsample DEM (default=1, no upsampling)",
     )
+    parser.add_argument(
+        "--target-res",
+        nargs="+",
+        type=positive_float,
+        metavar="RES",
+        help="Output pixel size in degrees: one value, or X Y (e.g. 0.7 arcsec is\n"
+        "0.000194444). Alternative to --xrate/--yrate for spacings which are\n"
+        "not a divisor of the source's, done in the same single resampling pass.",
+    )
+    parser.add_argument(
+        "--target-shape",
+        nargs=2,
+        type=positive_int,
+        metavar=("rows", "cols"),
+        help="Output size in pixels over the bounding box, e.g. to match an\n"
+        "existing grid. Alternative to --xrate/--yrate and --target-res.",
+    )
+    parser.add_argument(
+        "--looks",
+        nargs=2,
+        type=positive_int,
+        default=(1, 1),
+        metavar=("X", "Y"),
+        help="Number of pixels in x (columns) and y (rows) to average into one\n"
+        "output pixel, after any resampling (default 1 1: no multilooking).\n"
+        "For NASA data, voids are left out of the averages.",
+    )
+    parser.add_argument(
+        "--resample-method",
+        choices=RESAMPLE_METHODS,
+        default="bilinear",
+        help="Kernel to crop/upsample NASA and NASA_WATER DEMs (default %(default)s).\n"
+        "cubic, cubicspline and lanczos use the same kernels as GDAL.",
+    )
     parser.add_argument(
         "--output",
         "-o",
@@ -155,6 +223,42 @@ def get_cli_args():
             )
         ),
     )
+    parser.add_argument(
+        "--download-workers",
+        type=positive_int,
+        default=5,
+        help=(
+            "Number of tiles to download at once (NASA/NASA_WATER sources, and COP"
+            " with --cache-cop-tiles, default %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--cache-cop-tiles",
+        action="store_true",
+        help=(
+            "Save the Copernicus tiles covering the bbox into CACHE_DIR/cop/ and"
+            " read them from disk, now and on later runs, instead of streaming"
+            " them from AWS (COP source only)."
+        ),
+    )
+    parser.add_argument(
+        "--pixel-copy",
+        action="store_true",
+        help=(
+            "Without resampling, copy the Copernicus pixels and add the EGM2008"
+            " undulation from the geoid grid, instead of warping every pixel"
+            " (COP source only)."
+        ),
+    )
+    parser.add_argument(
+        "--cache-geoid",
+        action="store_true",
+        help=(
+            "Add the geoid undulation from small per-tile geoid grids saved in"
+            " CACHE_DIR/geoid/, shared by the NASA, COP and 3DEP sources, instead"
+            " of reading the full geoid grid each run."
+        ),
+    )
     parser.add_argument(
         "--output-format",
         "-of",
@@ -174,9 +278,9 @@ def get_cli_args():
         "--vrt-filename",
         help=(
             "Path or URL to a VRT to read tiles from (COP and NISAR sources only).\n"
-            "Useful when the default remote VRT is slow or unreachable: download\n"
-            "the VRT tree locally with `--download-cop-vrt DEST` and pass\n"
-            "DEST/cop_global.vrt here."
+            "By default, COP reads from a VRT of only the tiles near the bbox,\n"
+            "built from a bundled tile index. To use the full VRT tree, download\n"
+            "it with `--download-cop-vrt DEST` and pass DEST/cop_global.vrt here."
         ),
     )
     parser.add_argument(
@@ -185,16 +289,190 @@ def get_cli_args():
         help=(
             "Download the COP DEM VRT tree from GitHub into DEST and exit.\n"
             "After downloading, pass DEST/cop_global.vrt to --vrt-filename on\n"
-            "subsequent runs to avoid the slow remote VRT resolution path."
+            "subsequent runs to read tiles through it."
+        ),
+    )
+    parser.add_argument(
+        "--remote-io",
+        choices=list(remote_io.PRESETS),
+        help=(
+            "GDAL settings for reading remote tiles (COP and NISAR sources):\n"
+            "'tuned' (HTTP/2 multiplexing, merged range requests, larger caches),\n"
+            "'http1' (the same over HTTP/1.1), or 'gdal' (GDAL's defaults).\n"
+            "Default {} (or the {} environment variable).".format(
+                remote_io.DEFAULT_PRESET, remote_io.PROFILE_ENV
+            )
+        ),
+    )
+    parser.add_argument(
+        "--gdal-config",
+        metavar="KEY=VALUE",
+        action="append",
+        type=gdal_option,
+        help=(
+            "GDAL config option to set for the remote reads, on top of\n"
+            "--remote-io (e.g. GDAL_HTTP_MAX_RETRY=10). KEY= leaves KEY to GDAL.\n"
+            "May be repeated."
         ),
     )
     return parser.parse_args()
 
 
+def get_cache_cli_args(argv=None):
+    from sardem import cache
+
+    parser = ArgumentParser(
+        prog="sardem cache",
+        description=(
+            "Inspect or shrink the download cache. Least recently used files are"
+            " evicted first.\nThe default budget ({}) can be set with the {}"
+            " environment variable.".format(cache.DEFAULT_MAX_SIZE, cache.MAX_SIZE_ENV)
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "command",
+        choices=["stats", "prune", "clear"],
+        help="stats: show cache usage\n"
+        "prune: evict files until the cache fits in --max-size\n"
+        "clear: remove all cached files",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Cache location (Default = {})".format(utils.get_cache_dir()),
+    )
+    parser.add_argument(
+        "--max-size",
+        help="Budget for `prune`, e.g. 20G or 500M (Default = {})".format(
+            cache.DEFAULT_MAX_SIZE
+        ),
+    )
+    return parser.parse_args(argv)
+
+
+def cache_cli(argv=None):
+    from sardem import cache
+
+    args = get_cache_cli_args(argv)
+    if args.command == "stats":
+        info = cache.stats(args.cache_dir)
+        print("Cache directory: {}".format(info["cache_dir"]))
+        print("Files: {}".format(info["num_files"]))
+        print(
+            "Size: {} (budget {})".format(
+                cache.format_size(info["total_bytes"]),
+                cache.format_size(info["max_bytes"]),
+            )
+        )
+        for key, label in [("oldest_access", "Oldest"), ("newest_access", "Newest")]:
+            if info[key] is not None:
+                print(
+                    "{} access: {:%Y-%m-%d %H:%M}".format(
+                        label, datetime.fromtimestamp(info[key])
+                    )
+                )
+        return
+
+    if args.command == "prune":
+        max_bytes = cache.parse_size(args.max_size) if args.max_size else None
+        removed = cache.prune(max_bytes=max_bytes, cache_dir=args.cache_dir)
+    else:
+        removed = cache.clear(args.cache_dir)
+    print("Removed {} files".format(len(removed)))
+
+
+def get_prefetch_cli_args(argv=None):
+    from sardem import prefetch
+
+    parser = ArgumentParser(
+        prog="sardem prefetch",
+        description=(
+            "Download all SRTM tiles covering a set of areas into the cache,"
+            " so that\nlater DEM jobs don't wait on the network."
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--bbox",
+        nargs=4,
+        action="append",
+        default=[],
+        metavar=("left", "bottom", "right", "top"),
+        type=float,
+        help="Bounding box of an area of interest. Can be repeated.",
+    )
+    parser.add_argument(
+        "--aoi-file",
+        action="append",
+        default=[],
+        help="geojson file with one or more areas of interest (e.g. a\n"
+        "FeatureCollection of frames). Can be repeated.",
+    )
+    parser.add_argument(
+        "--data-source",
+        "-d",
+        choices=["NASA", "NASA_WATER"],
+        type=str.upper,
+        default="NASA",
+        help="Tiles to download (default %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Cache location (Default = {})".format(utils.get_cache_dir()),
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=positive_int,
+        default=prefetch.DEFAULT_WORKERS,
+        help="Number of tiles to download at once (default %(default)s)",
+    )
+    args = parser.parse_args(argv)
+    if not args.bbox and not args.aoi_file:
+        parser.error("Need at least one --bbox or --aoi-file")
+    return args
+
+
+def prefetch_cli(argv=None):
+    from sardem import cache, prefetch
+
+    args = get_prefetch_cli_args(argv)
+    bboxes = list(args.bbox)
+    for filename in args.aoi_file:
+        bboxes.extend(prefetch.aoi_file_bboxes(filename))
+
+    result = prefetch.prefetch(
+        bboxes,
+        data_source=args.data_source,
+        cache_dir=args.cache_dir,
+        max_workers=args.download_workers,
+    )
+    print(
+        "Tiles: {tiles} ({downloaded} downloaded, {cached} already cached,"
+        " {nonexistent} with no data)".format(**result)
+    )
+    print(
+        "Downloaded {} in {:.1f} s ({}/s)".format(
+            cache.format_size(result["bytes"]),
+            result["seconds"],
+            cache.format_size(result["bytes_per_second"]),
+        )
+    )
+
+
 def cli():
+    if sys.argv[1:2] == ["cache"]:
+        return cache_cli(sys.argv[2:])
+    if sys.argv[1:2] == ["prefetch"]:
+        return prefetch_cli(sys.argv[2:])
     args = get_cli_args()
     import sardem.dem
 
+    if args.remote_io or args.gdal_config:
+        preset = args.remote_io or os.getenv(
+            remote_io.PROFILE_ENV, remote_io.DEFAULT_PRESET
+        )
+        remote_io.set_profile(preset, remote_io.parse_overrides(args.gdal_config))
+
     if args.download_cop_vrt:
         from sardem import cop_dem
 
@@ -218,6 +496,17 @@ def cli():
     ):
         raise ValueError("Need --bbox, --geojson, or --wkt-file")
 
+    if args.target_res and args.target_shape:
+        raise ValueError("Can only use one of --target-res or --target-shape")
+    if (args.target_res or args.target_shape) and (args.xrate, args.yrate) != (1, 1):
+        raise ValueError("Can't use --xrate/--yrate with --target-res/--target-shape")
+    if args.target_res and len(args.target_res) > 2:
+        raise ValueError("--target-res takes one value, or two (X Y)")
+    target_res = None
+    if args.target_res:
+        # A single value is used in both directions
+        target_res = (args.target_res[0], args.target_res[-1])
+
     geojson_dict = json.load(args.geojson) if args.geojson else None
     if args.left_lon:
         left_lon, top_lat = args.left_lon, args.top_lat
@@ -257,4 +546,13 @@ def cli():
         output_format=args.output_format,
         output_type=args.output_type,
         vrt_filename=args.vrt_filename,
+        download_workers=args.download_workers,
+        resample_method=args.resample_method,
+        target_res=target_res,
+        target_shape=args.target_shape,
+        xlooks=args.looks[0],
+        ylooks=args.looks[1],
+        cache_tiles=args.cache_cop_tiles,
+        pixel_copy=args.pixel_copy,
+        cache_geoid=args.cache_geoid,
     )
@@ -1,9 +1,14 @@
+import functools
 import logging
+import math
 import os
 import shutil
 import subprocess
 
-from . import utils
+import numpy as np
+import requests
+
+from . import cache, loading, upsample, utils
 
 logger = logging.getLogger("sardem")
 
@@ -15,7 +20,34 @@ EPSG_CODES = {
 EGM_FILES = {
     "egm96": os.path.join(utils.get_cache_dir(), "egm96_15.gtx"),
     "egm08": os.path.join(utils.get_cache_dir(), "egm08_25.gtx"),
+    # GEOID18, from NAVD88 to NAD83 heights over CONUS (read with GDAL)
+    "geoid18": os.path.join(utils.get_cache_dir(), "us_noaa_g2018u0.tif"),
+}
+# The PROJ geoid grids, downloaded into the cache when first needed
+EGM_URLS = {
+    "egm96": "https://download.osgeo.org/proj/vdatum/egm96_15/egm96_15.gtx",
+    "egm08": "https://download.osgeo.org/proj/vdatum/egm08_25/egm08_25.gtx",
+    "geoid18": "https://cdn.proj.org/us_noaa_g2018u0.tif",
 }
+# .gtx files start with the grid origin (south, west), spacing and shape,
+# followed by the rows of big-endian float32 undulations, from south to north
+GTX_HEADER = np.dtype(
+    [
+        ("lat0", ">f8"),
+        ("lon0", ">f8"),
+        ("dlat", ">f8"),
+        ("dlon", ">f8"),
+        ("rows", ">i4"),
+        ("cols", ">i4"),
+    ]
+)
+# (connect, read) timeouts for the geoid download, in seconds
+GEOID_TIMEOUT = (10, 60)
+GEOID_CHUNK_SIZE = 1024 * 1024
+# The geoid grid nodes around each 1x1 degree tile (a few KB) are saved in this
+# subfolder of the cache, and the last GEOID_TILE_LRU_SIZE are kept in memory
+GEOID_TILE_DIR = "geoid"
+GEOID_TILE_LRU_SIZE = 256
 
 
 def egm_to_wgs84(filename, output=None, overwrite=True, copy_rsc=True, geoid="egm96"):
@@ -69,20 +101,195 @@ def _get_size(filename):
     return xsize, ysize
 
 
-def convert_dem_to_wgs84(dem_filename, geoid="egm96"):
+def convert_dem_to_wgs84(
+    dem_filename,
+    geoid="egm96",
+    dtype=None,
+    cache_dir=None,
+    num_threads=None,
+    use_cache=False,
+):
     """Convert the file `dem_filename` from EGM96 heights to WGS84 ellipsoidal heights
 
-    Overwrites file, requires GDAL to be installed
+    Adds the geoid undulation to the DEM in place, by blocks of rows run in
+    parallel threads. The undulation is bilinearly interpolated from the
+    `geoid` grid (as PROJ/gdalwarp do) at the DEM pixel centers, which are
+    read from `dem_filename`.rsc (with X_FIRST/Y_FIRST at the top left edge).
+    If the geoid grid can't be downloaded, falls back to converting with
+    gdalwarp and PROJ's own grids, or keeps the geoid heights with a warning
+    when GDAL is missing.
+
+    Args:
+        dem_filename (str): binary DEM with a .rsc file, overwritten in place
+        geoid (str): "egm96" or "egm08"
+        dtype (str, np.dtype): data type of the DEM. Default guesses from the
+            file size: int16, float32 or float64
+        cache_dir (str): where to find/download the geoid grid.
+            Defaults to `utils.get_cache_dir()`
+        num_threads (int): number of blocks to convert at once
+        use_cache (bool): read the undulation from the geoid tiles saved in
+            the cache (see `geoid_tile`), making any missing ones, instead of
+            from the full geoid grid. The results are the same. Default False
+    """
+    rsc_dict = loading.load_dem_rsc(dem_filename + ".rsc")
+    shape = (rsc_dict["file_length"], rsc_dict["width"])
+    if dtype is None:
+        dtype = _guess_dtype(dem_filename, shape)
+    dtype = np.dtype(dtype)
+    lons, lats = _pixel_centers(rsc_dict)
+    # Get the undulation first: if this fails, the DEM is left untouched
+    try:
+        undulation = _undulation_source(geoid, lons, lats, cache_dir, use_cache)
+    except (requests.RequestException, OSError):
+        logger.error("Failed to get the %s geoid grid:", geoid, exc_info=True)
+        _convert_with_gdalwarp(dem_filename, geoid=geoid)
+        return
+    dem = np.memmap(dem_filename, mode="r+", dtype=dtype, shape=shape)
+
+    def _convert_block(block_rows):
+        und = undulation(lats[slice(*block_rows)])
+        block = dem[slice(*block_rows)]
+        if np.issubdtype(dtype, np.integer):
+            np.rint(und, out=und)
+        block += und.astype(dtype)
+
+    block_rows = upsample._get_block_rows(shape[1])
+    blocks = [r for r, _ in upsample._block_iterator(shape, (block_rows, None))]
+    upsample._map_blocks(_convert_block, blocks, num_threads)
+    dem.flush()
+    del dem
+
+
+def add_geoid_offset(
+    filename, geoid="egm08", nodata=None, cache_dir=None, use_cache=False
+):
+    """Add the `geoid` undulation to the GDAL raster `filename`, in place
+
+    The undulation at each pixel center is a bilinear interpolation of the
+    geoid grid, as PROJ does in gdal.Warp, computed one block of rows at a
+    time. Pixels equal to `nodata` are left unchanged. With `use_cache`, the
+    undulation comes from the cached geoid tiles (see `geoid_tile`).
+    """
+    from osgeo import gdal
+
+    ds = gdal.Open(filename, gdal.GA_Update)
+    gt = ds.GetGeoTransform()
+    rows, cols = ds.RasterYSize, ds.RasterXSize
+    grid = {
+        "x_first": gt[0],
+        "y_first": gt[3],
+        "x_step": gt[1],
+        "y_step": gt[5],
+        "file_length": rows,
+        "width": cols,
+    }
+    lons, lats = _pixel_centers(grid)
+    # In double precision, like PROJ
+    undulation = _undulation_source(
+        geoid, lons, lats, cache_dir, use_cache, dtype=np.float64
+    )
+    band = ds.GetRasterBand(1)
+    block_rows = upsample._get_block_rows(cols)
+    for (r0, r1), _ in upsample._block_iterator((rows, cols), (block_rows, None)):
+        block = band.ReadAsArray(0, r0, cols, r1 - r0)
+        shifted = block + undulation(lats[r0:r1])
+        if np.issubdtype(block.dtype, np.integer):
+            np.rint(shifted, out=shifted)
+        shifted = shifted.astype(block.dtype)
+        if nodata is not None:
+            shifted[block == nodata] = nodata
+        band.WriteArray(shifted, 0, r0)
+    band.FlushCache()
+    ds = None
+
+
+def write_with_geoid_offset(
+    write_func,
+    output_name,
+    output_format,
+    output_type,
+    geoid="egm08",
+    nodata=None,
+    cache_dir=None,
+    use_cache=False,
+):
+    """Write a GDAL raster of geoid heights, then add the `geoid` undulation
+
+    `write_func(filename, output_format, output_type)` writes the geoid
+    heights (e.g. with gdal.Translate or gdal.Warp). For integer
+    `output_type`s, they are first written as a float32 GeoTIFF, so the heights
+    are rounded only once, after adding the undulation (as gdal.Warp does).
+    See `add_geoid_offset` for the other arguments.
+    """
+    import tempfile
+
+    from osgeo import gdal
+
+    if np.issubdtype(np.dtype(output_type.lower()), np.floating):
+        write_func(output_name, output_format, output_type)
+        add_geoid_offset(
+            output_name, geoid, nodata=nodata, cache_dir=cache_dir, use_cache=use_cache
+        )
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        float_name = os.path.join(tmpdir, "geoid_heights.tif")
+        write_func(float_name, "GTiff", "float32")
+        add_geoid_offset(
+            float_name, geoid, nodata=nodata, cache_dir=cache_dir, use_cache=use_cache
+        )
+        # GDAL rounds to the nearest integer, as gdal.Warp does
+        gdal.Translate(
+            output_name,
+            float_name,
+            options=gdal.TranslateOptions(
+                format=output_format,
+                outputType=gdal.GetDataTypeByName(output_type.title()),
+            ),
+        )
+
+
+def fetch_geoid(geoid, bbox, cache_dir=None, use_cache=False):
+    """Get what `add_geoid_offset` needs for `bbox` before writing any output
+
+    Downloads the `geoid` grid, or with `use_cache` makes the missing geoid
+    tiles under `bbox` (see `geoid_tile`).
+
+    Raises:
+        requests.RequestException, OSError: if the geoid grid can't be downloaded
+        ValueError: if `bbox` is not within the geoid grid
+    """
+    left, bottom, right, top = bbox
+    tiles = [
+        (lat, (lon + 180) % 360 - 180)
+        for lat in range(math.floor(bottom), math.ceil(top))
+        for lon in range(math.floor(left), math.ceil(right))
+    ]
+    if use_cache:
+        for lat, lon in tiles:
+            geoid_tile(geoid, lat, lon, cache_dir=cache_dir)
+        return
+    grid, header = read_geoid(download_geoid(geoid, cache_dir=cache_dir))
+    for lat, lon in tiles:
+        # Only checks that the tile is in the grid
+        _cut_geoid_tile(grid, header, lat, lon)
+
+
+def _convert_with_gdalwarp(dem_filename, geoid="egm96"):
+    """Fallback for `convert_dem_to_wgs84`, using PROJ's grids through gdalwarp
+
+    Leaves the DEM with its EGM heights if GDAL is missing or the warp fails.
     """
     if not utils._gdal_installed_correctly():
-        logger.error("GDAL required to convert DEM to WGS84")
+        logger.warning(
+            "GDAL is not installed: keeping %s as %s geoid heights", dem_filename, geoid
+        )
         return
+    logger.info("Converting %s to WGS84 heights with gdalwarp", dem_filename)
 
     path_, fname = os.path.split(dem_filename)
     rsc_filename = os.path.join(path_, fname + ".rsc")
 
     output_egm = os.path.join(path_, "egm_" + fname)
-    # output_wgs = dem_filename.replace(ext, ".wgs84" + ext)
     rsc_filename_egm = os.path.join(path_, "egm_" + fname + ".rsc")
     os.rename(dem_filename, output_egm)
     os.rename(rsc_filename, rsc_filename_egm)
@@ -94,6 +301,291 @@ def convert_dem_to_wgs84(dem_filename, geoid="egm96"):
         os.remove(rsc_filename_egm)
     except Exception:
         logger.error("Failed to convert DEM:", exc_info=True)
-        logger.error("Reverting back, using EGM dem as output")
+        logger.warning(
+            "Reverting back: keeping %s as %s geoid heights", dem_filename, geoid
+        )
         os.rename(output_egm, dem_filename)
-        os.rename(rsc_filename_egm, rsc_filename)
\ No newline at end of file
+        os.rename(rsc_filename_egm, rsc_filename)
+
+
+def geoid_tile(geoid, lat, lon, cache_dir=None):
+    """The nodes of the `geoid` grid needed to interpolate over one 1x1 degree tile
+
+    Each tile is cut once from the full geoid grid and saved under
+    `cache_dir`/geoid/`geoid`/ (a few KB, e.g. 28 x 28 nodes for egm08), so
+    later runs over the tile, by any data source, don't need the full grid.
+    The tiles count towards the cache budget, and are evicted least recently
+    used first like the DEM tiles (see `cache.prune`). Within a process, the
+    last `GEOID_TILE_LRU_SIZE` tiles stay in memory.
+
+    Interpolating a tile gives the same undulations as the full grid.
+
+    Args:
+        geoid (str): "egm96", "egm08" or "geoid18"
+        lat (int): latitude of the tile's bottom edge
+        lon (int): longitude of the tile's left edge, from -180 to 179
+        cache_dir (str): sardem cache. Defaults to `utils.get_cache_dir()`
+
+    Returns:
+        tuple[ndarray, dict]: the float32 nodes and their header, as from
+            `read_gtx`
+
+    Raises:
+        ValueError: if the tile is outside of the geoid grid
+    """
+    cache_dir = cache_dir or utils.get_cache_dir()
+    grid, header, path = _load_geoid_tile(geoid, lat, lon, cache_dir)
+    cache.touch(path)
+    return grid, header
+
+
+@functools.lru_cache(maxsize=GEOID_TILE_LRU_SIZE)
+def _load_geoid_tile(geoid, lat, lon, cache_dir):
+    """Load (cutting first if needed) the saved geoid tile"""
+    tile_name = "{}{:02d}{}{:03d}".format(
+        "N" if lat >= 0 else "S", abs(lat), "E" if lon >= 0 else "W", abs(lon)
+    )
+    path = os.path.join(cache_dir, GEOID_TILE_DIR, geoid, tile_name + ".npz")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with cache.file_lock(path):
+            if not os.path.exists(path):
+                grid, header = read_geoid(download_geoid(geoid, cache_dir=cache_dir))
+                tile, tile_header = _cut_geoid_tile(grid, header, lat, lon)
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, grid=tile, **tile_header)
+                os.replace(tmp_path, path)
+    with np.load(path) as data:
+        tile = data["grid"]
+        tile_header = {name: data[name].item() for name in GTX_HEADER.names}
+    return tile, tile_header, path
+
+
+def _cut_geoid_tile(grid, header, lat, lon):
+    """Nodes of `grid` around the tile, with one extra node on each side"""
+    dlat, dlon = header["dlat"], header["dlon"]
+    r0 = math.floor((lat - header["lat0"]) / dlat) - 1
+    r1 = math.ceil((lat + 1 - header["lat0"]) / dlat) + 2
+    # Longitudes are counted east from the grid's first column
+    x0 = ((lon - header["lon0"]) % 360.0) / dlon
+    c0 = math.floor(x0) - 1
+    c1 = math.ceil(x0 + 1 / dlon) + 2
+    cols = np.arange(c0, c1)
+    period = int(round(360.0 / dlon))
+    if header["cols"] >= period:
+        # Global grid: wrap around the antimeridian
+        cols %= period
+    else:
+        cols = cols[(cols >= 0) & (cols < header["cols"])]
+    rows = np.arange(max(r0, 0), min(r1, header["rows"]))
+    # The nodes around the tile itself must be in the grid
+    if (
+        len(rows) == 0
+        or len(cols) == 0
+        or rows[0] > r0 + 1
+        or rows[-1] < r1 - 2
+        or (header["cols"] < period and (cols[0] > c0 + 1 or cols[-1] < c1 - 2))
+    ):
+        raise ValueError(
+            "Tile at ({}, {}) is outside of the geoid grid {}".format(lat, lon, header)
+        )
+    tile = np.asarray(grid[rows[0] : rows[-1] + 1][:, cols], dtype=np.float32)
+    tile_header = dict(
+        header,
+        lat0=header["lat0"] + rows[0] * dlat,
+        lon0=header["lon0"] + (c0 + (cols[0] - c0) % period) * dlon,
+        rows=tile.shape[0],
+        cols=tile.shape[1],
+    )
+    return tile, tile_header
+
+
+def _undulation_source(geoid, lons, lats, cache_dir, use_cache, dtype=np.float32):
+    """Function of a block of `lats`, giving their undulation at `lons`
+
+    Gets the geoid grid (or the geoid tiles, with `use_cache`) first, so
+    that a failed download raises before anything is converted.
+    """
+    if not use_cache:
+        grid, header = read_geoid(download_geoid(geoid, cache_dir=cache_dir))
+        return lambda block_lats: _undulation_on_grid(
+            grid, header, lons, block_lats, dtype=dtype
+        )
+
+    # Column spans of the pixels in each tile, as longitudes from -180 to 179
+    tile_lons = np.floor((lons + 180.0) % 360.0 - 180.0).astype(int)
+    col_spans = _runs(tile_lons)
+    tile_lats = np.floor(lats).astype(int)
+    tiles = {
+        (lat, lon): geoid_tile(geoid, lat, lon, cache_dir=cache_dir)
+        for lat in np.unique(tile_lats).tolist()
+        for lon, _, _ in col_spans
+    }
+
+    def _tiled_undulation(block_lats):
+        out = np.empty((len(block_lats), len(lons)), dtype=dtype)
+        for lat, r0, r1 in _runs(np.floor(block_lats).astype(int)):
+            for lon, c0, c1 in col_spans:
+                grid, header = tiles[(lat, lon)]
+                out[r0:r1, c0:c1] = _undulation_on_grid(
+                    grid, header, lons[c0:c1], block_lats[r0:r1], dtype=dtype
+                )
+        return out
+
+    return _tiled_undulation
+
+
+def _runs(values):
+    """(value, start, stop) of each run of equal `values`
+
+    Examples:
+        >>> _runs(np.array([3, 3, 4, 4, 4, 3]))
+        [(3, 0, 2), (4, 2, 5), (3, 5, 6)]
+    """
+    edges = np.flatnonzero(np.diff(values)) + 1
+    starts = [0] + edges.tolist()
+    stops = edges.tolist() + [len(values)]
+    return [(values[i].item(), i, j) for i, j in zip(starts, stops)]
+
+
+def _pixel_centers(rsc_dict, shape=None):
+    """Longitudes and latitudes of the pixel centers of an .rsc grid"""
+    rdict_lower = {k.lower(): v for k, v in rsc_dict.items()}
+    rows, cols = shape or (rdict_lower["file_length"], rdict_lower["width"])
+    lons = rdict_lower["x_first"] + (np.arange(cols) + 0.5) * rdict_lower["x_step"]
+    lats = rdict_lower["y_first"] + (np.arange(rows) + 0.5) * rdict_lower["y_step"]
+    return lons, lats
+
+
+def geoid_undulation(lons, lats, geoid="egm96", cache_dir=None, use_cache=False):
+    """Height of the `geoid` above the WGS84 ellipsoid on a lat/lon grid
+
+    Args:
+        lons (ndarray): 1D longitudes of the grid columns (degrees)
+        lats (ndarray): 1D latitudes of the grid rows (degrees)
+        geoid (str): "egm96", "egm08" or "geoid18"
+        cache_dir (str): where to find/download the geoid grid
+        use_cache (bool): interpolate the cached geoid tiles (see `geoid_tile`)
+
+    Returns:
+        ndarray: float32 undulations, shape (len(lats), len(lons))
+    """
+    lons, lats = np.asarray(lons), np.asarray(lats)
+    return _undulation_source(geoid, lons, lats, cache_dir, use_cache)(lats)
+
+
+def _undulation_on_grid(grid, header, lons, lats, dtype=np.float32):
+    """Bilinear interpolation of the .gtx `grid` at `lats` x `lons`
+
+    The geoid varies slowly, and the DEM is on a regular lat/lon grid: the
+    interpolation is separable, done with `upsample.separable_bilinear` on
+    just the geoid rows covering `lats`. It is computed in `dtype` (float64
+    to match PROJ's double precision).
+    """
+    # Fractional grid indices, with longitudes wrapped into the grid's range
+    xi = np.mod(lons - header["lon0"], 360.0) / header["dlon"]
+    yi = (lats - header["lat0"]) / header["dlat"]
+    row_start, row_stop = upsample._source_span(yi, grid.shape[0])
+    window = np.asarray(grid[row_start:row_stop], dtype=dtype)
+    # Repeat the first column past the end if the grid doesn't include the
+    # wrapped column itself (e.g. both -180 and 180)
+    period = int(round(360.0 / header["dlon"]))
+    if grid.shape[1] <= period:
+        window = np.hstack([window, window[:, :1]])
+    out = np.empty((len(yi), len(xi)), dtype=dtype)
+    return upsample.separable_bilinear(window, xi, yi - row_start, out=out)
+
+
+def read_gtx(filename):
+    """Memory-map a .gtx geoid grid
+
+    Returns:
+        tuple[ndarray, dict]: the big-endian float32 grid (rows from south to
+            north), and the header with keys "lat0", "lon0" (center of the
+            southwest pixel), "dlat", "dlon", "rows", "cols"
+    """
+    header = np.fromfile(filename, dtype=GTX_HEADER, count=1)[0]
+    header = {name: header[name].item() for name in GTX_HEADER.names}
+    grid = np.memmap(
+        filename,
+        mode="r",
+        dtype=">f4",
+        offset=GTX_HEADER.itemsize,
+        shape=(header["rows"], header["cols"]),
+    )
+    return grid, header
+
+
+def read_geoid(filename):
+    """Read a geoid grid: a .gtx file, or a PROJ GeoTIFF grid (needs GDAL)
+
+    Returns:
+        tuple[ndarray, dict]: the grid and its header, as from `read_gtx`
+    """
+    if filename.endswith(".gtx"):
+        return read_gtx(filename)
+    return _read_geotiff_geoid(filename)
+
+
+@functools.lru_cache(maxsize=2)
+def _read_geotiff_geoid(filename):
+    from osgeo import gdal
+
+    ds = gdal.Open(filename)
+    band = ds.GetRasterBand(1)
+    gt = ds.GetGeoTransform()
+    rows, cols = ds.RasterYSize, ds.RasterXSize
+    grid = band.ReadAsArray().astype(np.float32)
+    grid = grid * (band.GetScale() or 1) + (band.GetOffset() or 0)
+    ds = None
+    header = {
+        # Center of the southwest pixel, with rows going from south to north
+        "lat0": gt[3] + (rows - 0.5) * gt[5],
+        "lon0": gt[0] + 0.5 * gt[1],
+        "dlat": -gt[5],
+        "dlon": gt[1],
+        "rows": rows,
+        "cols": cols,
+    }
+    return grid[::-1], header
+
+
+def download_geoid(geoid="egm96", cache_dir=None):
+    """Path to the .gtx grid for `geoid`, downloading it into the cache if needed"""
+    filename = EGM_FILES[geoid]
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, os.path.basename(filename))
+    if os.path.exists(filename):
+        cache.touch(filename)
+        return filename
+
+    with cache.file_lock(filename):
+        if os.path.exists(filename):
+            return filename
+        url = EGM_URLS[geoid]
+        logger.info("Downloading %s to %s", url, filename)
+        # Written to a .part file first, so no truncated grid is ever left
+        part_filename = filename + ".part"
+        try:
+            with requests.get(url, stream=True, timeout=GEOID_TIMEOUT) as response:
+                response.raise_for_status()
+                with open(part_filename, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=GEOID_CHUNK_SIZE):
+                        f.write(chunk)
+            os.replace(part_filename, filename)
+        except BaseException:
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
+            raise
+    return filename
+
+
+def _guess_dtype(filename, shape):
+    itemsize = os.path.getsize(filename) // (shape[0] * shape[1])
+    dtypes = {2: np.int16, 4: np.float32, 8: np.float64}
+    if itemsize not in dtypes:
+        raise ValueError(
+            "Can't tell the data type of {} with shape {}".format(filename, shape)
+        )
+    return dtypes[itemsize]
\ No newline at end of file
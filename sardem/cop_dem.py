@@ -1,13 +1,38 @@
+import functools
 import logging
+import os
+import re
+import uuid
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
 
+import numpy as np
 import requests
 
-from sardem import conversions, utils
+from sardem import cache, conversions, download, remote_io, utils
 from sardem.constants import DEFAULT_RES
 
 TILE_LIST_URL = "https://copernicus-dem-30m.s3.amazonaws.com/tileList.txt"
 URL_TEMPLATE = "https://copernicus-dem-30m.s3.amazonaws.com/{t}/{t}.tif"
+TILE_NAME_TEMPLATE = "Copernicus_DSM_COG_10_{lat}_00_{lon}_00_DEM"
+COP_GLOBAL_VRT_URL = "/vsicurl/https://raw.githubusercontent.com/scottstanie/sardem/master/sardem/data/cop_global.vrt"  # noqa
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+# Compact copy of the VRT tree under `DATA_DIR` (cop_global.vrt -> cop_NE.vrt ...
+# -> N00_E000.vrt ... -> COG tiles): the size and source rectangles of each VRT
+# and each tile. See `make_cop_tile_index` and `make_bbox_vrts`.
+COP_TILE_INDEX_FILE = os.path.join(DATA_DIR, "cop_tiles.npz")
+# Tiles further than this (in degrees) from the bbox are left out of the VRT
+COP_VRT_MARGIN = 1.0
+# Where `bbox_vrt` writes its in-memory VRTs
+BBOX_VRT_PREFIX = "/vsimem/sardem_cop_"
+# Subfolder of the cache for COG tiles (see `cache_cop_tiles`), and how far
+# around the bbox (in degrees) tiles are fetched, for the resampling kernels
+TILE_CACHE_DIR = "cop"
+TILE_CACHE_MARGIN = 0.01
 
 logger = logging.getLogger("sardem")
 utils.set_logger_handler(logger)
@@ -19,9 +44,15 @@ def download_and_stitch(
     keep_egm=False,
     xrate=1,
     yrate=1,
+    target_shape=None,
     vrt_filename=None,
     output_format="GTiff",
     output_type="float32",
+    pixel_copy=False,
+    cache_dir=None,
+    cache_tiles=False,
+    download_workers=5,
+    cache_geoid=False,
 ):
     """Download the COP DEM from AWS.
 
@@ -31,8 +62,31 @@ def download_and_stitch(
     References:
         https://spacedata.copernicus.eu/web/cscda/dataset-details?articleId=394198
         https://copernicus-dem-30m.s3.amazonaws.com/readme.html
+
+    `xrate`/`yrate` may be non-integer. If `target_shape` (rows, cols) is
+    given, the output has exactly that shape instead of using the rates.
+
+    If `vrt_filename` is None, a VRT of only the COG tiles near `bbox` is
+    built in memory from the bundled tile index (see `bbox_vrt`). It reads
+    the same pixels as the global VRT `COP_GLOBAL_VRT_URL`, without fetching
+    and parsing its tree of VRTs. With `cache_tiles`, the COG tiles under
+    `bbox` are first downloaded (`download_workers` at once) into
+    `cache_dir`/cop/ and read from disk, now and on later runs (see
+    `cache_cop_tiles`).
+
+    With `pixel_copy`, DEMs on the source grid (rates of 1) are cropped with
+    gdal.Translate, and the EGM2008 undulation is then added in blocks (see
+    `conversions.add_geoid_offset`), instead of a gdal.Warp transforming every
+    pixel with PROJ. The heights match the gdal.Warp ones to within 1e-3 m
+    (exactly for integer output types, which are rounded once after adding the
+    undulation). The EGM2008 grid is kept in `cache_dir` (default
+    `utils.get_cache_dir()`); if it can't be downloaded, gdal.Warp is used.
+
+    With `cache_geoid`, the undulation is always added this way (after a
+    horizontal-only gdal.Warp when resampling), from the EGM2008 tiles saved in
+    `cache_dir`/geoid/ (see `conversions.geoid_tile`), which are shared with
+    the other data sources and don't need the full grid on later runs.
     """
-    import os
     import tempfile
 
     from osgeo import gdal
@@ -40,7 +94,32 @@ def download_and_stitch(
     gdal.UseExceptions()
 
     if vrt_filename is None:
-        vrt_filename = "/vsicurl/https://raw.githubusercontent.com/scottstanie/sardem/master/sardem/data/cop_global.vrt"  # noqa
+        if load_cop_tile_index() is not None:
+            tile_filename = None
+            if cache_tiles:
+                tile_filename = cache_cop_tiles(
+                    bbox, cache_dir=cache_dir, max_workers=download_workers
+                )
+            # Only the tiles near the bbox, instead of fetching the global VRT tree
+            with bbox_vrt(bbox, tile_filename=tile_filename) as vrt_filename:
+                download_and_stitch(
+                    output_name,
+                    bbox,
+                    keep_egm=keep_egm,
+                    xrate=xrate,
+                    yrate=yrate,
+                    target_shape=target_shape,
+                    vrt_filename=vrt_filename,
+                    output_format=output_format,
+                    output_type=output_type,
+                    pixel_copy=pixel_copy,
+                    cache_dir=cache_dir,
+                    cache_geoid=cache_geoid,
+                )
+            return
+        vrt_filename = COP_GLOBAL_VRT_URL
+    if cache_tiles:
+        logger.warning("Not caching tiles: they're read through %s", vrt_filename)
 
     bboxes = utils.check_dateline(bbox)
 
@@ -54,6 +133,10 @@ def download_and_stitch(
             yrate,
             output_format,
             output_type,
+            target_shape=target_shape,
+            pixel_copy=pixel_copy,
+            cache_dir=cache_dir,
+            cache_geoid=cache_geoid,
         )
         return
 
@@ -64,9 +147,10 @@ def download_and_stitch(
         )
     )
 
+    sub_shapes = _split_target_shape(bboxes, target_shape)
     temp_files = []
     with tempfile.TemporaryDirectory() as tmpdir:
-        for idx, sub_bbox in enumerate(bboxes):
+        for idx, (sub_bbox, sub_shape) in enumerate(zip(bboxes, sub_shapes)):
             temp_file = os.path.join(tmpdir, "dem_part_{}.tif".format(idx))
             temp_files.append(temp_file)
             logger.info("Downloading region {} of {}".format(idx + 1, len(bboxes)))
@@ -79,6 +163,10 @@ def download_and_stitch(
                 yrate,
                 "GTiff",
                 output_type,
+                target_shape=sub_shape,
+                pixel_copy=pixel_copy,
+                cache_dir=cache_dir,
+                cache_geoid=cache_geoid,
             )
 
         # Shift eastern tiles so they're adjacent to western tiles in pixel space
@@ -89,6 +177,10 @@ def download_and_stitch(
         vrt_temp = os.path.join(tmpdir, "merged.vrt")
         gdal.BuildVRT(vrt_temp, temp_files)
 
+        # The regions overlap by a pixel at the dateline: resize to the target
+        size_options = {}
+        if target_shape is not None:
+            size_options = dict(width=target_shape[1], height=target_shape[0])
         if output_format == "GTiff":
             gdal.Warp(
                 output_name,
@@ -97,6 +189,7 @@ def download_and_stitch(
                     format=output_format,
                     multithread=True,
                     callback=gdal.TermProgress,
+                    **size_options
                 ),
             )
         else:
@@ -105,9 +198,43 @@ def download_and_stitch(
                 vrt_temp,
                 format=output_format,
                 callback=gdal.TermProgress,
+                **size_options
             )
 
 
+def _split_target_shape(bboxes, target_shape):
+    """Split the columns of `target_shape` between side-by-side `bboxes`
+
+    Each bbox gets all the rows, and a share of the columns proportional to
+    its width, as snapped by `utils.align_bounds_to_pixel_grid` for GDAL.
+
+    Examples:
+        >>> bboxes = [(170, -10, 180, 10), (-180, -10, -175, 10)]
+        >>> _split_target_shape(bboxes, (100, 300))
+        [(100, 200), (100, 100)]
+        >>> _split_target_shape([(170, -10, 180, 10)], None)
+        [None]
+    """
+    if target_shape is None:
+        return [None] * len(bboxes)
+    rows, cols = target_shape
+    widths = []
+    for bbox in bboxes:
+        left, _, right, _ = utils.align_bounds_to_pixel_grid(bbox)
+        widths.append(right - left)
+    # Round the cumulative edges, so the parts add up to exactly `cols`
+    total = sum(widths)
+    edges = [int(round(cols * sum(widths[:i]) / total)) for i in range(len(widths) + 1)]
+    shapes = [(rows, hi - lo) for lo, hi in zip(edges[:-1], edges[1:])]
+    if any(c < 1 for _, c in shapes):
+        raise ValueError(
+            "target_shape {} is too narrow to split across the dateline".format(
+                target_shape
+            )
+        )
+    return shapes
+
+
 def _shift_tile_if_needed(filepath):
     """Shift tile geotransform by -360 if x origin is positive.
 
@@ -138,11 +265,36 @@ def _download_single_bbox(
     yrate,
     output_format,
     output_type,
+    target_shape=None,
+    pixel_copy=False,
+    cache_dir=None,
+    cache_geoid=False,
 ):
     """Download a single bbox from the COP DEM."""
     from osgeo import gdal
 
-    if keep_egm:
+    bounds = utils.align_bounds_to_pixel_grid(bbox)
+    copy = pixel_copy and target_shape is None and xrate == 1 and yrate == 1
+    # Add the undulation ourselves, instead of through PROJ in gdal.Warp
+    add_offset = not keep_egm and (copy or cache_geoid)
+    if add_offset and not _fetch_geoid(bounds, cache_dir, cache_geoid):
+        logger.warning("Converting the heights with gdal.Warp instead")
+        copy = add_offset = False
+    if copy:
+        # The grid doesn't change: copy the pixels, then shift the heights
+        _copy_single_bbox(
+            output_name,
+            bounds,
+            vrt_filename,
+            keep_egm,
+            output_format,
+            output_type,
+            cache_dir=cache_dir,
+            cache_geoid=cache_geoid,
+        )
+        return
+
+    if keep_egm or add_offset:
         t_srs = s_srs = None
     else:
         code = conversions.EPSG_CODES["egm08"]
@@ -150,39 +302,151 @@ def _download_single_bbox(
         t_srs = "epsg:4326"
     xres = DEFAULT_RES / xrate
     yres = DEFAULT_RES / yrate
-    resamp = "bilinear" if (xrate > 1 or yrate > 1) else "nearest"
+    resamp = utils.gdal_resample_alg(xrate, yrate)
 
     option_dict = dict(
         format=output_format,
-        outputBounds=utils.align_bounds_to_pixel_grid(bbox),
+        outputBounds=bounds,
         dstSRS=t_srs,
         srcSRS=s_srs,
-        xRes=xres,
-        yRes=yres,
         outputType=gdal.GetDataTypeByName(output_type.title()),
         resampleAlg=resamp,
         multithread=True,
         warpMemoryLimit=5000,
         warpOptions=["NUM_THREADS=4"],
     )
+    option_dict.update(utils.gdal_size_options(xres, yres, target_shape))
     # Preserve ocean (value=0) as nodata during geoid-to-ellipsoid conversion
     if not keep_egm:
         option_dict["srcNodata"] = 0
         option_dict["dstNodata"] = 0
 
-    logger.info("Creating {}".format(output_name))
-    logger.info("Fetching remote tiles...")
+    def _warp(filename, warp_format, warp_type):
+        opts = dict(
+            option_dict,
+            format=warp_format,
+            outputType=gdal.GetDataTypeByName(warp_type.title()),
+        )
+        logger.info("Creating {}".format(filename))
+        logger.info("Fetching remote tiles...")
+        try:
+            cmd = _gdal_cmd_from_options(vrt_filename, filename, opts)
+            logger.info("Running GDAL command:")
+            logger.info(cmd)
+        except Exception:
+            logger.info("Running gdal.Warp with options:")
+            logger.info(opts)
+            pass
+
+        opts["callback"] = gdal.TermProgress
+        with remote_io.gdal_config(builtin=_is_builtin_vrt(vrt_filename)):
+            gdal.Warp(filename, vrt_filename, options=gdal.WarpOptions(**opts))
+
+    if not add_offset:
+        _warp(output_name, output_format, output_type)
+        return
+    logger.info("Adding EGM2008 undulation for heights above WGS84")
+    conversions.write_with_geoid_offset(
+        _warp,
+        output_name,
+        output_format,
+        output_type,
+        geoid="egm08",
+        nodata=0,
+        cache_dir=cache_dir,
+        use_cache=cache_geoid,
+    )
+
+
+def _fetch_geoid(bounds, cache_dir=None, use_cache=False):
+    """Whether the EGM2008 grid (or its tiles) for `bounds` could be fetched"""
     try:
-        cmd = _gdal_cmd_from_options(vrt_filename, output_name, option_dict)
-        logger.info("Running GDAL command:")
-        logger.info(cmd)
-    except Exception:
-        logger.info("Running gdal.Warp with options:")
-        logger.info(option_dict)
-        pass
+        conversions.fetch_geoid(
+            "egm08", bounds, cache_dir=cache_dir, use_cache=use_cache
+        )
+    except (requests.RequestException, OSError):
+        logger.error("Failed to get the egm08 geoid grid:", exc_info=True)
+        return False
+    return True
+
+
+def _copy_single_bbox(
+    output_name,
+    bounds,
+    vrt_filename,
+    keep_egm,
+    output_format,
+    output_type,
+    cache_dir=None,
+    cache_geoid=False,
+):
+    """Pixel copy of `bounds` (see `download_and_stitch`), with the undulation
+
+    The heights are copied as float32 (the COP data type) and rounded to
+    an integer `output_type` only once, after adding the undulation, as in
+    gdal.Warp (see `conversions.write_with_geoid_offset`).
+    """
+    builtin = _is_builtin_vrt(vrt_filename)
+    if keep_egm:
+        with remote_io.gdal_config(builtin=builtin):
+            _translate_window(
+                output_name, vrt_filename, bounds, output_format, output_type
+            )
+        return
+
+    def _copy(filename, copy_format, copy_type):
+        with remote_io.gdal_config(builtin=builtin):
+            _translate_window(
+                filename, vrt_filename, bounds, copy_format, copy_type, nodata=0
+            )
+
+    logger.info("Adding EGM2008 undulation for heights above WGS84")
+    conversions.write_with_geoid_offset(
+        _copy,
+        output_name,
+        output_format,
+        output_type,
+        geoid="egm08",
+        nodata=0,
+        cache_dir=cache_dir,
+        use_cache=cache_geoid,
+    )
+
+
+def _is_builtin_vrt(vrt_filename):
+    """Whether `vrt_filename` is sardem's own COP VRT, not a user's
+
+    Examples:
+        >>> _is_builtin_vrt(COP_GLOBAL_VRT_URL)
+        True
+        >>> _is_builtin_vrt("my_dem.vrt")
+        False
+    """
+    return vrt_filename == COP_GLOBAL_VRT_URL or vrt_filename.startswith(
+        BBOX_VRT_PREFIX
+    )
+
+
+def _translate_window(
+    output_name, vrt_filename, bounds, output_format, output_type, nodata=None
+):
+    """Copy the pixels of `vrt_filename` within `bounds` (on its pixel edges)"""
+    from osgeo import gdal
 
-    option_dict["callback"] = gdal.TermProgress
-    gdal.Warp(output_name, vrt_filename, options=gdal.WarpOptions(**option_dict))
+    left, bottom, right, top = bounds
+    logger.info("Creating {}".format(output_name))
+    logger.info("Copying window of remote tiles...")
+    gdal.Translate(
+        output_name,
+        vrt_filename,
+        options=gdal.TranslateOptions(
+            format=output_format,
+            projWin=[left, top, right, bottom],
+            outputType=gdal.GetDataTypeByName(output_type.title()),
+            noData=nodata,
+            callback=gdal.TermProgress,
+        ),
+    )
 
 
 def _gdal_cmd_from_options(src, dst, option_dict):
@@ -218,9 +482,368 @@ def make_cop_vrt(outname="copernicus_GLO_30_dem.vrt"):
         outputSRS="EPSG:4326+3855",
     )
     logger.info("Building VRT {}".format(outname))
-    vrt_file = gdal.BuildVRT(outname, url_list, options=vrt_options)
-    vrt_file.FlushCache()
-    vrt_file = None
+    with remote_io.gdal_config(builtin=True):
+        vrt_file = gdal.BuildVRT(outname, url_list, options=vrt_options)
+        vrt_file.FlushCache()
+        vrt_file = None
+
+
+def cop_tile_name(lat, lon):
+    """Name of the COP tile with bottom-left corner (`lon`, `lat`)
+
+    Examples:
+        >>> cop_tile_name(19, -156)
+        'Copernicus_DSM_COG_10_N19_00_W156_00_DEM'
+        >>> cop_tile_name(-1, 5)
+        'Copernicus_DSM_COG_10_S01_00_E005_00_DEM'
+    """
+    lat_str = "{}{:02d}".format("N" if lat >= 0 else "S", abs(lat))
+    lon_str = "{}{:03d}".format("E" if lon >= 0 else "W", abs(lon))
+    return TILE_NAME_TEMPLATE.format(lat=lat_str, lon=lon_str)
+
+
+def _parse_tile_corner(filename):
+    match = re.search(r"_([NS])(\d+)_00_([EW])(\d+)_00_DEM", filename)
+    if match is None:
+        raise ValueError("Not a COP tile: {}".format(filename))
+    lat_str, lat, lon_str, lon = match.groups()
+    lat = int(lat) if lat_str == "N" else -int(lat)
+    lon = int(lon) if lon_str == "E" else -int(lon)
+    return lat, lon
+
+
+def _parse_rects(source):
+    rects = [source.find("SrcRect"), source.find("DstRect")]
+    return [float(r.get(k)) for r in rects for k in ("xOff", "yOff", "xSize", "ySize")]
+
+
+def make_cop_tile_index(vrt_dir=DATA_DIR, outfile=COP_TILE_INDEX_FILE):
+    """Save the compact index of the COP VRT tree used by `make_bbox_vrts`
+
+    Walks the VRTs from `vrt_dir`/cop_global.vrt down to the COG tiles, keeping
+    what decides which pixels GDAL reads: the size of each VRT, and the source
+    and destination rectangles of each of its sources.
+
+    Args:
+        vrt_dir (str): directory with cop_global.vrt and the VRTs it references
+        outfile (str): where to save the index (.npz)
+    """
+    root = ET.parse(os.path.join(vrt_dir, "cop_global.vrt")).getroot()
+    vrts = dict(names=[], parents=[], sizes=[], rects=[], overviews=[])
+    tiles = dict(tile_corners=[], tile_parents=[], tile_rects=[])
+    # Breadth first, so each VRT comes after the one referencing it
+    queue = [("cop_global.vrt", -1, [0.0] * 8)]
+    while queue:
+        name, parent, rect = queue.pop(0)
+        idx = len(vrts["names"])
+        vrt = ET.parse(os.path.join(vrt_dir, name)).getroot()
+        vrts["names"].append(name)
+        vrts["parents"].append(parent)
+        vrts["sizes"].append((int(vrt.get("rasterXSize")), int(vrt.get("rasterYSize"))))
+        vrts["rects"].append(rect)
+        vrts["overviews"].append(vrt.findtext("OverviewList", default=""))
+        for source in vrt.iter("SimpleSource"):
+            filename = source.find("SourceFilename")
+            if filename.get("relativeToVRT") == "1":
+                queue.append((filename.text, idx, _parse_rects(source)))
+                continue
+            lat, lon = _parse_tile_corner(filename.text)
+            if filename.text != _tile_url(lat, lon):
+                raise ValueError("Unexpected tile filename: {}".format(filename.text))
+            tiles["tile_corners"].append((lat, lon))
+            tiles["tile_parents"].append(idx)
+            tiles["tile_rects"].append(_parse_rects(source))
+
+    np.savez_compressed(
+        outfile,
+        names=np.array(vrts["names"]),
+        parents=np.array(vrts["parents"], dtype=np.int16),
+        sizes=np.array(vrts["sizes"], dtype=np.int32),
+        rects=np.array(vrts["rects"]),
+        overviews=np.array(vrts["overviews"]),
+        tile_corners=np.array(tiles["tile_corners"], dtype=np.int16),
+        tile_parents=np.array(tiles["tile_parents"], dtype=np.int16),
+        tile_rects=np.array(tiles["tile_rects"]),
+        srs=np.array(ET.tostring(root.find("SRS"), encoding="unicode").strip()),
+        geotransform=np.array(root.findtext("GeoTransform")),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def load_cop_tile_index(filename=COP_TILE_INDEX_FILE):
+    """Load the COP tile index as a dict of arrays, or None if it's not available"""
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def _tile_url(lat, lon):
+    return "/vsicurl/" + URL_TEMPLATE.format(t=cop_tile_name(lat, lon))
+
+
+def _source_window(window, rects):
+    """Pixels of each source within `window` (x0, y0, x1, y1) of its VRT
+
+    NaN where the source's destination rectangle misses the window.
+    """
+    sx, sy, sw, sh, dx, dy, dw, dh = np.moveaxis(rects, -1, 0)
+    x0 = np.maximum(window[..., 0], dx)
+    y0 = np.maximum(window[..., 1], dy)
+    x1 = np.minimum(window[..., 2], dx + dw)
+    y1 = np.minimum(window[..., 3], dy + dh)
+    out = np.stack(
+        [
+            sx + (x0 - dx) * sw / dw,
+            sy + (y0 - dy) * sh / dh,
+            sx + (x1 - dx) * sw / dw,
+            sy + (y1 - dy) * sh / dh,
+        ],
+        axis=-1,
+    )
+    out[~((x0 < x1) & (y0 < y1))] = np.nan
+    return out
+
+
+def _select_sources(index, bbox, margin):
+    """Masks of the VRTs and tiles read within `margin` degrees of `bbox`"""
+    gt = [float(v) for v in str(index["geotransform"]).replace(",", " ").split()]
+    keep_vrts = np.zeros(len(index["names"]), dtype=bool)
+    keep_tiles = np.zeros(len(index["tile_parents"]), dtype=bool)
+    for left, bottom, right, top in utils.check_dateline(bbox):
+        windows = np.full((len(keep_vrts), 4), np.nan)
+        windows[0] = [
+            (left - margin - gt[0]) / gt[1],
+            (top + margin - gt[3]) / gt[5],
+            (right + margin - gt[0]) / gt[1],
+            (bottom - margin - gt[3]) / gt[5],
+        ]
+        for idx in range(1, len(windows)):
+            parent = index["parents"][idx]
+            windows[idx] = _source_window(windows[parent], index["rects"][idx])
+        keep_vrts |= ~np.isnan(windows[:, 0])
+        tile_windows = _source_window(
+            windows[index["tile_parents"]], index["tile_rects"]
+        )
+        keep_tiles |= ~np.isnan(tile_windows[:, 0])
+    return keep_vrts, keep_tiles
+
+
+def bbox_tiles(bbox, margin=0.0):
+    """Corners (lat, lon) of the COP tiles within `margin` degrees of `bbox`"""
+    index = load_cop_tile_index()
+    _, keep_tiles = _select_sources(index, bbox, margin)
+    return [tuple(int(v) for v in c) for c in index["tile_corners"][keep_tiles]]
+
+
+_SOURCE_XML = """    <SimpleSource>
+      <SourceFilename relativeToVRT="{relative}">{filename}</SourceFilename>
+      <SourceBand>1</SourceBand>
+      <SourceProperties RasterXSize="{xsize}" RasterYSize="{ysize}" \
+DataType="Float32" BlockXSize="{block}" BlockYSize="{block}" />
+      <SrcRect xOff="{r[0]:.17g}" yOff="{r[1]:.17g}" \
+xSize="{r[2]:.17g}" ySize="{r[3]:.17g}" />
+      <DstRect xOff="{r[4]:.17g}" yOff="{r[5]:.17g}" \
+xSize="{r[6]:.17g}" ySize="{r[7]:.17g}" />
+    </SimpleSource>
+"""
+_OVERVIEW_XML = '  <OverviewList resampling="nearest">{}</OverviewList>\n'
+# Block sizes of the COP COGs, and of GDAL's VRTs
+COG_BLOCK_SIZE = 1024
+VRT_BLOCK_SIZE = 128
+
+
+def make_bbox_vrts(bbox, tile_filename=None, margin=COP_VRT_MARGIN):
+    """Make the VRTs to read the COP DEM around `bbox`, as {filename: XML}
+
+    They have the sizes and source rectangles of the bundled VRT tree, so they
+    read the same pixels as cop_global.vrt, but only keep the sources within
+    `margin` degrees of `bbox`. The first one, "cop_global.vrt", is the top
+    level VRT, referencing the others relative to its own directory.
+
+    Args:
+        bbox (tuple[float]): (left, bottom, right, top)
+        tile_filename (Callable[[int, int], str], optional): GDAL filename of
+            the tile with bottom-left corner (lat, lon). Defaults to the
+            /vsicurl/ URL of the COG on AWS.
+        margin (float): degrees around `bbox` to include, so resampling
+            kernels at the edges read the same pixels as the global VRT
+
+    Raises:
+        ValueError: if the bundled tile index is missing
+    """
+    index = load_cop_tile_index()
+    if index is None:
+        raise ValueError("Missing COP tile index {}".format(COP_TILE_INDEX_FILE))
+    if tile_filename is None:
+        tile_filename = _tile_url
+    keep_vrts, keep_tiles = _select_sources(index, bbox, margin)
+    logger.info("Using {} COP tiles around the bbox".format(keep_tiles.sum()))
+
+    sources = {idx: [] for idx in np.flatnonzero(keep_vrts)}
+    for idx in np.flatnonzero(keep_vrts)[1:]:
+        xsize, ysize = index["sizes"][idx]
+        sources[index["parents"][idx]].append(
+            _SOURCE_XML.format(
+                relative=1,
+                filename=escape(str(index["names"][idx])),
+                xsize=xsize,
+                ysize=ysize,
+                block=VRT_BLOCK_SIZE,
+                r=index["rects"][idx],
+            )
+        )
+    for idx in np.flatnonzero(keep_tiles):
+        lat, lon = (int(v) for v in index["tile_corners"][idx])
+        rect = index["tile_rects"][idx]
+        sources[index["tile_parents"][idx]].append(
+            _SOURCE_XML.format(
+                relative=0,
+                filename=escape(tile_filename(lat, lon)),
+                xsize=int(np.ceil(rect[2])),
+                ysize=int(np.ceil(rect[3])),
+                block=COG_BLOCK_SIZE,
+                r=rect,
+            )
+        )
+
+    vrts = {}
+    for idx, vrt_sources in sources.items():
+        xsize, ysize = index["sizes"][idx]
+        header = ""
+        if idx == 0:
+            header = "  {}\n  <GeoTransform>{}</GeoTransform>\n".format(
+                index["srs"], index["geotransform"]
+            )
+        overviews = str(index["overviews"][idx])
+        if overviews:
+            overviews = _OVERVIEW_XML.format(overviews)
+        vrts[str(index["names"][idx])] = (
+            '<VRTDataset rasterXSize="{}" rasterYSize="{}">\n'.format(xsize, ysize)
+            + header
+            + '  <VRTRasterBand dataType="Float32" band="1">\n'
+            + "    <ColorInterp>Gray</ColorInterp>\n"
+            + "".join(vrt_sources)
+            + "  </VRTRasterBand>\n"
+            + overviews
+            + "</VRTDataset>\n"
+        )
+    return vrts
+
+
+@contextmanager
+def bbox_vrt(bbox, tile_filename=None, margin=COP_VRT_MARGIN):
+    """Write the VRTs of `make_bbox_vrts` to /vsimem/, yielding the top one
+
+    The in-memory files are deleted on exit.
+    """
+    from osgeo import gdal
+
+    dirname = "{}{}".format(BBOX_VRT_PREFIX, uuid.uuid4().hex)
+    filenames = []
+    try:
+        for name, xml in make_bbox_vrts(bbox, tile_filename, margin).items():
+            filenames.append("{}/{}".format(dirname, name))
+            gdal.FileFromMemBuffer(filenames[-1], xml)
+        yield filenames[0]
+    finally:
+        for filename in filenames:
+            gdal.Unlink(filename)
+
+
+def cache_cop_tiles(bbox, cache_dir=None, max_workers=5, margin=TILE_CACHE_MARGIN):
+    """Download the COG tiles within `margin` degrees of `bbox` into the cache
+
+    Tiles are saved whole to `cache_dir`/cop/ (default `utils.get_cache_dir()`),
+    once: later calls reuse them. Tiles which fail to download are read
+    remotely instead.
+
+    Args:
+        bbox (tuple[float]): (left, bottom, right, top)
+        cache_dir (str): cache location
+        max_workers (int): number of tiles to download at once
+        margin (float): degrees around `bbox` to include
+
+    Returns:
+        Callable[[int, int], str]: the GDAL filename of the tile with
+            bottom-left corner (lat, lon), for `make_bbox_vrts`: the cached
+            file if there is one, otherwise the /vsicurl/ URL.
+    """
+    cache_dir = cache_dir or utils.get_cache_dir()
+    tile_dir = os.path.join(cache_dir, TILE_CACHE_DIR)
+    os.makedirs(tile_dir, exist_ok=True)
+    corners = bbox_tiles(bbox, margin=margin)
+    session = download.make_session(max_workers)
+    pool = ThreadPool(processes=max_workers)
+    filenames = pool.map(lambda c: _cache_tile(session, c, tile_dir), corners)
+    pool.close()
+    logger.info(
+        "{} of {} COP tiles cached in {}".format(
+            sum(f is not None for f in filenames), len(corners), tile_dir
+        )
+    )
+    # Only evict from sardem's own cache, not a user-chosen directory
+    if os.path.abspath(cache_dir) == os.path.abspath(utils.get_cache_dir()):
+        cache.prune(
+            cache_dir=cache_dir,
+            keep=filenames,
+            min_age=cache.RECENT_USE_SECONDS,
+        )
+
+    def tile_filename(lat, lon):
+        filename = _tile_cache_path(tile_dir, lat, lon)
+        return filename if os.path.exists(filename) else _tile_url(lat, lon)
+
+    return tile_filename
+
+
+def _tile_cache_path(tile_dir, lat, lon):
+    return os.path.join(tile_dir, cop_tile_name(lat, lon) + ".tif")
+
+
+def _cache_tile(session, corner, tile_dir):
+    """Download one tile to `tile_dir`, returning its path (None if it failed)"""
+    filename = _tile_cache_path(tile_dir, *corner)
+    if os.path.exists(filename):
+        cache.touch(filename)
+        return filename
+    # Only one process downloads a tile: the others wait, then reuse it
+    with cache.file_lock(filename):
+        if os.path.exists(filename):
+            return filename
+        url = URL_TEMPLATE.format(t=cop_tile_name(*corner))
+        try:
+            _download_file(session, url, filename)
+        except IOError as e:
+            # Includes requests' connection and HTTP errors
+            logger.warning("Failed to cache %s (%s), reading it remotely", url, e)
+            return None
+    return filename
+
+
+def _download_file(session, url, filename):
+    """Stream `url` to `filename`, which only appears once it is complete"""
+    logger.info("Downloading {}".format(url))
+    part_filename = filename + ".part"
+    with session.get(url, stream=True, timeout=download.TIMEOUT) as response:
+        response.raise_for_status()
+        expected_size = response.headers.get("Content-Length")
+        if "Content-Encoding" in response.headers:
+            expected_size = None
+        with open(part_filename, "wb") as f:
+            for chunk in response.iter_content(
+                chunk_size=download.DOWNLOAD_CHUNK_SIZE
+            ):
+                f.write(chunk)
+    size = os.path.getsize(part_filename)
+    if expected_size is not None and size != int(expected_size):
+        os.remove(part_filename)
+        raise IOError(
+            "Incomplete download of {}: got {} of {} bytes".format(
+                url, size, expected_size
+            )
+        )
+    os.replace(part_filename, filename)
 
 
 SARDEM_DATA_TARBALL = (
@@ -257,7 +880,6 @@ def download_local_vrt(dest_dir, branch="master"):
     >>> # sardem --bbox ... --vrt-filename /data/sardem_vrt/cop_global.vrt
     """
     import io
-    import os
     import tarfile
     import urllib.request
 
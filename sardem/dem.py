@@ -46,7 +46,7 @@ import os
 
 import numpy as np
 
-from sardem import conversions, loading, upsample, utils
+from sardem import cache, conversions, loading, upsample, utils
 from sardem.constants import DEFAULT_RES, NUM_PIXELS_SRTM1
 from sardem.download import Downloader, Tile
 
@@ -82,14 +82,24 @@ class Stitcher:
     """
 
     def __init__(
-        self, tile_names, filenames=[], data_source="NASA", num_pixels=NUM_PIXELS_SRTM1
+        self,
+        tile_names,
+        filenames=[],
+        data_source="NASA",
+        num_pixels=NUM_PIXELS_SRTM1,
+        void_value=0,
     ):
-        """List should come from Tile.srtm1_tile_names()"""
+        """List should come from Tile.srtm1_tile_names()
+
+        SRTM voids are loaded as `void_value`: 0 by default, or e.g.
+        `loading.SRTM_VOID` to tell them apart from sea level.
+        """
         self.tile_file_list = list(tile_names)
         self.filenames = filenames
         # Assuming SRTMGL1: 3601 x 3601 squares
         self.num_pixels = num_pixels
         self.data_source = data_source
+        self.void_value = void_value
         self.dtype = np.uint8 if data_source == "NASA_WATER" else np.int16
 
     @property
@@ -185,41 +195,93 @@ class Stitcher:
         return np.array(self.tile_file_list).reshape((nrows, ncols))
 
     def _load_tile(self, tile_name):
-        """Loads the tile, or returns a square of zeros if missing"""
+        """Memory-maps the tile, or returns None if there is no file for it
+
+        Raises:
+            IOError: if the tile's file was given, but no longer exists
+                (e.g. evicted from the cache by another job)
+        """
         idx = self.tile_file_list.index(tile_name)
-        filename = self.filenames[idx]
-        if filename and os.path.exists(filename):
-            if self.data_source == "NASA_WATER":
-                return loading.load_watermask(filename)
-            else:
-                return loading.load_elevation(filename)
+        filename = self.filenames[idx] if idx < len(self.filenames) else None
+        if not filename:
+            return None
+        if not os.path.exists(filename):
+            raise IOError("Tile {} is missing: {}".format(tile_name, filename))
+        cache.touch(filename)
+        if self.data_source == "NASA_WATER":
+            return loading.memmap_watermask(filename)
         else:
-            return np.zeros((NUM_PIXELS_SRTM1, NUM_PIXELS_SRTM1), dtype=self.dtype)
+            return loading.memmap_elevation(filename)
+
+    def _tile_offsets(self, tile_row, tile_col):
+        """Pixel (row, col) of the top-left of a tile within the stitched .dem
+
+        Neighboring SRTM tiles share one row/column of pixels along their edge.
+
+        Examples:
+            >>> s = Stitcher(['N19W156', 'N19W155', 'N18W156', 'N18W155'])
+            >>> s._tile_offsets(1, 1)
+            (3600, 3600)
+        """
+        step = self.num_pixels - 1
+        return tile_row * step, tile_col * step
 
     def load_and_stitch(self):
         """Function to load combine .hgt tiles
 
-        Uses hstack first on rows, then vstacks rows together.
-        Also handles the deleting of overlapped rows/columns of SRTM tiles
-        TODO: break this up to more testable chunks
+        Allocates the full output once, then copies each tile into its slot.
 
         Returns:
             ndarray: the stitched .hgt tiles in 2D np.array
         """
-        row_list = []
-        # ncols in the number of .hgt blocks wide
-        _, ncols = self.blockshape
+        nrows, ncols = self.shape
+        return self.read_window((0, nrows), (0, ncols))
+
+    def read_window(self, rows, cols):
+        """Load one window of the stitched .dem, reading only the tiles it touches
+
+        The overlapping first row/column of each tile (after the first tile
+        row/column) is skipped, since it duplicates the previous tile's edge.
+        Only the part of each tile inside the window is read and converted.
+        Missing tiles are left as zeros, and voids are set to `void_value`.
+
+        Args:
+            rows (tuple[int, int]): (start, stop) rows of the stitched .dem
+            cols (tuple[int, int]): (start, stop) columns of the stitched .dem
+
+        Returns:
+            ndarray: the window of stitched .hgt tiles in 2D np.array
+        """
+        row_start, row_stop = rows
+        col_start, col_stop = cols
+        out = np.zeros((row_stop - row_start, col_stop - col_start), dtype=self.dtype)
         tile_grid = self._create_file_array()
-        for idx, row in enumerate(tile_grid):
-            cur_row = np.hstack([self._load_tile(tile_name) for tile_name in row])
-            # Delete columns: 3601*[1, 2,... not-including last column]
-            delete_cols = self.num_pixels * np.arange(1, ncols)
-            cur_row = np.delete(cur_row, delete_cols, axis=1)
-            if idx > 0:
-                # For all except first block-row, delete repeated first row of data
-                cur_row = np.delete(cur_row, 0, axis=0)
-            row_list.append(cur_row)
-        return np.vstack(row_list)
+        for (tile_row, tile_col), tile_name in np.ndenumerate(tile_grid):
+            # Skip the first row/col of data if it's shared with the previous tile
+            skip_row = 1 if tile_row > 0 else 0
+            skip_col = 1 if tile_col > 0 else 0
+            top, left = self._tile_offsets(tile_row, tile_col)
+            # Intersect the tile's (non-overlapping) pixels with the window
+            r0 = max(top + skip_row, row_start)
+            r1 = min(top + self.num_pixels, row_stop)
+            c0 = max(left + skip_col, col_start)
+            c1 = min(left + self.num_pixels, col_stop)
+            if r0 >= r1 or c0 >= c1:
+                continue
+            tile = self._load_tile(tile_name)
+            if tile is None:
+                continue
+            tile_window = tile[r0 - top : r1 - top, c0 - left : c1 - left]
+            out_window = out[
+                r0 - row_start : r1 - row_start, c0 - col_start : c1 - col_start
+            ]
+            if self.data_source == "NASA_WATER":
+                out_window[...] = tile_window
+            else:
+                loading.fix_elevation(
+                    tile_window, out=out_window, void_value=self.void_value
+                )
+        return out
 
     def _find_step_sizes(self, ndigits=12):
         """Calculates the step size for the dem.rsc
@@ -301,6 +363,15 @@ def main(
     output_type="float32",
     output_format="GTiff",
     vrt_filename=None,
+    download_workers=5,
+    resample_method="bilinear",
+    target_res=None,
+    target_shape=None,
+    xlooks=1,
+    ylooks=1,
+    cache_tiles=False,
+    pixel_copy=False,
+    cache_geoid=False,
 ):
     """Function for entry point to create a DEM with `sardem`
 
@@ -311,8 +382,8 @@ def main(
         geojson (dict): geojson object outlining DEM (alternative to bbox)
         wkt_file (str): path to .wkt file outlining DEM (alternative to bbox)
         data_source (str): 'NASA' or 'AWS', where to download .hgt tiles from
-        xrate (int): x-rate (columns) to upsample DEM (positive int)
-        yrate (int): y-rate (rows) to upsample DEM (positive int)
+        xrate (float): x-rate (columns) to upsample DEM (usually a positive int)
+        yrate (float): y-rate (rows) to upsample DEM (usually a positive int)
         make_isce_xml (bool): whether to make an isce2-compatible XML file
         keep_egm (bool): Don't convert the DEM heights from geoid heights
             above EGM96 or EGM2008 to heights above WGS84 ellipsoid
@@ -326,6 +397,29 @@ def main(
         vrt_filename (str): Path or URL to a VRT to read tiles from. Applies to
             the COP and NISAR data sources only. Defaults to the remote VRT
             built into each module.
+        download_workers (int): number of tiles to download at once
+            (NASA and NASA_WATER data sources, and COP with `cache_tiles`)
+        resample_method (str): kernel used to crop/upsample the NASA and
+            NASA_WATER sources, one of `upsample.RESAMPLE_METHODS`
+            (default = bilinear)
+        target_res (tuple[float]): (x, y) output pixel size in degrees, as an
+            alternative to `xrate`/`yrate` (need not be a multiple of the
+            source pixel size)
+        target_shape (tuple[int]): (rows, cols) of the output, as an
+            alternative to `xrate`/`yrate` or `target_res`
+        xlooks (int): number of columns to average into one output pixel,
+            after any resampling (default = 1, no multilooking)
+        ylooks (int): number of rows to average into one output pixel
+        cache_tiles (bool): save the COP tiles to `cache_dir`/cop/ and read
+            them from there, instead of streaming them from AWS each run
+            (COP data source only, default = False)
+        pixel_copy (bool): without resampling, copy the COP pixels and add the
+            geoid undulation, instead of warping them with PROJ (COP data
+            source only, default = False). See `cop_dem.download_and_stitch`
+        cache_geoid (bool): add the geoid undulation from small per-tile geoid
+            grids saved in `cache_dir`/geoid/ (shared by the NASA, COP and 3DEP
+            sources), instead of reading the full geoid grid each run
+            (default = False). See `conversions.geoid_tile`
     """
     if bbox is None:
         if geojson:
@@ -337,6 +431,27 @@ def main(
         raise ValueError("Must provide either bbox or geojson or wkt_file")
     logger.info("Bounds: %s", " ".join(str(b) for b in bbox))
 
+    if target_res is not None or target_shape is not None:
+        if xrate != 1 or yrate != 1:
+            raise ValueError("Can't use xrate/yrate with target_res/target_shape")
+        # Non-integer rates: one resampling pass straight to the target grid.
+        # GDAL sources are warped over the bbox snapped to the source pixels
+        rate_bbox = bbox
+        if data_source in ("COP", "3DEP", "NISAR"):
+            rate_bbox = utils.align_bounds_to_pixel_grid(bbox)
+        xrate, yrate = utils.target_rates(
+            rate_bbox, target_res=target_res, target_shape=target_shape
+        )
+        logger.info("Resampling rates for the target grid: (%s, %s)", xrate, yrate)
+    if xlooks < 1 or ylooks < 1:
+        raise ValueError("xlooks and ylooks must be positive integers")
+    multilook = (xlooks, ylooks) != (1, 1)
+    # GDAL averages straight onto the multilooked grid
+    gdal_xrate, gdal_yrate = xrate / xlooks, yrate / ylooks
+    gdal_shape = target_shape
+    if multilook and target_shape is not None:
+        gdal_shape = (target_shape[0] // ylooks, target_shape[1] // xlooks)
+
     # if all(_float_is_on_bounds(b) for b in bbox):
     #     logger.info("Shifting bbox to nearest tile bounds")
     #     bbox = utils.shift_integer_bbox(bbox)
@@ -344,7 +459,7 @@ def main(
     # Now we're assuming that `bbox` refers to the edges of the desired bounding box
 
     # Print a warning if they're possibly requesting too-large a box by mistake
-    outrows, outcols = utils.get_output_size(bbox, xrate, yrate)
+    outrows, outcols = utils.get_output_size(bbox, gdal_xrate, gdal_yrate)
     if outrows * outcols > WARN_LIMIT:
         logger.warning(
             "Caution: Output size is {} x {} pixels.".format(outrows, outcols)
@@ -360,11 +475,17 @@ def main(
             output_name,
             bbox,
             keep_egm=keep_egm,
-            xrate=xrate,
-            yrate=yrate,
+            xrate=gdal_xrate,
+            yrate=gdal_yrate,
+            target_shape=gdal_shape,
             vrt_filename=vrt_filename,
             output_format=output_format,
             output_type=output_type,
+            cache_dir=cache_dir,
+            cache_tiles=cache_tiles,
+            download_workers=download_workers,
+            pixel_copy=pixel_copy,
+            cache_geoid=cache_geoid,
         )
         if make_isce_xml:
             logger.info("Creating ISCE2 XML file")
@@ -380,10 +501,13 @@ def main(
             output_name,
             bbox,
             keep_egm=keep_egm,
-            xrate=xrate,
-            yrate=yrate,
+            xrate=gdal_xrate,
+            yrate=gdal_yrate,
+            target_shape=gdal_shape,
             output_format=output_format,
             output_type=output_type,
+            cache_dir=cache_dir,
+            cache_geoid=cache_geoid,
         )
         if make_isce_xml:
             logger.info("Creating ISCE2 XML file")
@@ -402,8 +526,9 @@ def main(
         nisar_dem.download_and_stitch(
             output_name,
             bbox,
-            xrate=xrate,
-            yrate=yrate,
+            xrate=gdal_xrate,
+            yrate=gdal_yrate,
+            target_shape=gdal_shape,
             vrt_filename=vrt_filename,
             output_format=output_format,
             output_type=output_type,
@@ -420,6 +545,14 @@ def main(
             output_format,
         )
 
+    # SRTM voids are usually loaded as 0, which is also sea level: when
+    # multilooking, keep them as voids so they're left out of the averages,
+    # and set the looks with no valid pixels back to 0
+    looks_nodata = None
+    if multilook and data_source != "NASA_WATER":
+        looks_nodata = loading.SRTM_VOID
+    void_value = 0 if looks_nodata is None else looks_nodata
+
     # Check for dateline crossing
     bboxes = utils.check_dateline(bbox)
 
@@ -427,21 +560,52 @@ def main(
         # No dateline crossing, proceed normally
         tile_names = list(Tile(*bbox).srtm1_tile_names())
 
-        d = Downloader(tile_names, data_source=data_source, cache_dir=cache_dir)
+        d = Downloader(
+            tile_names,
+            data_source=data_source,
+            cache_dir=cache_dir,
+            max_workers=download_workers,
+        )
         local_filenames = d.download_all()
 
-        s = Stitcher(tile_names, filenames=local_filenames, data_source=data_source)
-        stitched_dem = s.load_and_stitch()
-
+        s = Stitcher(
+            tile_names,
+            filenames=local_filenames,
+            data_source=data_source,
+            void_value=void_value,
+        )
         rsc_dict_tiles = s.create_dem_rsc()
 
-        logger.info("Cropping stitched DEM to boundaries")
-        stitched_dem = upsample.resample(stitched_dem, rsc_dict_tiles, bbox)
+        def write_dem(filename, dtype):
+            # Crop (and upsample) in one pass over row blocks, never holding
+            # the full stitched DEM
+            logger.info("Resampling stitched DEM onto the output grid")
+            upsample.resample_by_blocks(
+                s.read_window,
+                s.shape,
+                rsc_dict_tiles,
+                bbox,
+                filename,
+                dtype,
+                xrate=xrate,
+                yrate=yrate,
+                method=resample_method,
+                xlooks=xlooks,
+                ylooks=ylooks,
+                nodata=looks_nodata,
+                fill_value=0,
+            )
+
+        out_rows, out_cols = upsample.resample_shape(
+            s.shape, rsc_dict_tiles, bbox, xrate, yrate, xlooks, ylooks
+        )
         rsc_dict = rsc_dict_tiles.copy()
         rsc_dict["X_FIRST"] = bbox[0]
         rsc_dict["Y_FIRST"] = bbox[3]
-        rsc_dict["FILE_LENGTH"] = stitched_dem.shape[0]
-        rsc_dict["WIDTH"] = stitched_dem.shape[1]
+        rsc_dict["X_STEP"] = rsc_dict_tiles["X_STEP"] / xrate * xlooks
+        rsc_dict["Y_STEP"] = rsc_dict_tiles["Y_STEP"] / yrate * ylooks
+        rsc_dict["FILE_LENGTH"] = out_rows
+        rsc_dict["WIDTH"] = out_cols
     else:
         # Dateline crossing: download each sub-bbox, merge via GDAL VRT
         import tempfile
@@ -463,12 +627,18 @@ def main(
 
                 tile_names = list(Tile(*sub_bbox).srtm1_tile_names())
                 d = Downloader(
-                    tile_names, data_source=data_source, cache_dir=cache_dir
+                    tile_names,
+                    data_source=data_source,
+                    cache_dir=cache_dir,
+                    max_workers=download_workers,
                 )
                 local_filenames = d.download_all()
 
                 s = Stitcher(
-                    tile_names, filenames=local_filenames, data_source=data_source
+                    tile_names,
+                    filenames=local_filenames,
+                    data_source=data_source,
+                    void_value=void_value,
                 )
                 dem_part = s.load_and_stitch()
 
@@ -534,73 +704,69 @@ def main(
                 x_first -= 360
             rsc_dict["X_FIRST"] = x_first
             rsc_dict["Y_FIRST"] = geotransform[3]
-            rsc_dict["X_STEP"] = geotransform[1]
-            rsc_dict["Y_STEP"] = geotransform[5]
-            rsc_dict["FILE_LENGTH"] = stitched_dem.shape[0]
-            rsc_dict["WIDTH"] = stitched_dem.shape[1]
+
+        # Resample the merged regions onto the output grid, described by the
+        # pixel centers of the merged array
+        rsc_dict_merged = {
+            "X_FIRST": geotransform[0] + geotransform[1] / 2,
+            "Y_FIRST": geotransform[3] + geotransform[5] / 2,
+            "X_STEP": geotransform[1],
+            "Y_STEP": geotransform[5],
+        }
+        merged_bbox = (
+            geotransform[0],
+            geotransform[3] + stitched_dem.shape[0] * geotransform[5],
+            geotransform[0] + stitched_dem.shape[1] * geotransform[1],
+            geotransform[3],
+        )
+
+        def write_dem(filename, dtype):
+            # Convert first, so upsampled pixels are interpolated in `dtype`
+            src = stitched_dem.astype(dtype)
+            if looks_nodata is not None:
+                # Voids become NaNs, which `take_looks` leaves out
+                src = stitched_dem.astype(np.result_type(dtype, np.float32))
+                src[stitched_dem == looks_nodata] = np.nan
+            dem = upsample.resample(
+                src,
+                rsc_dict_merged,
+                merged_bbox,
+                xrate,
+                yrate,
+                method=resample_method,
+            )
+            if multilook:
+                dem = upsample.take_looks(
+                    dem, ylooks, xlooks, dtype=dtype, fill_value=0
+                )
+            dem.tofile(filename)
+
+        out_rows, out_cols = upsample.resample_shape(
+            stitched_dem.shape,
+            rsc_dict_merged,
+            merged_bbox,
+            xrate,
+            yrate,
+            xlooks,
+            ylooks,
+        )
+        rsc_dict["X_STEP"] = geotransform[1] / xrate * xlooks
+        rsc_dict["Y_STEP"] = geotransform[5] / yrate * ylooks
+        rsc_dict["FILE_LENGTH"] = out_rows
+        rsc_dict["WIDTH"] = out_cols
 
     rsc_filename = output_name + ".rsc"
 
-    # Upsampling:
     dtype = np.dtype(output_type.lower())
-    if xrate == 1 and yrate == 1:
-        logger.info("Rate = 1: No upsampling to do")
-        logger.info("Writing DEM to %s", output_name)
-        stitched_dem.astype(dtype).tofile(output_name)
-        logger.info("Writing .dem.rsc file to %s", rsc_filename)
-        with open(rsc_filename, "w") as f:
-            f.write(loading.format_dem_rsc(rsc_dict))
-    else:
+    if xrate != 1 or yrate != 1:
         logger.info("Upsampling by ({}, {}) in (x, y) directions".format(xrate, yrate))
-        # dem_filename_small = output_name.replace(".dem", "_small.dem")
-        # rsc_filename_small = rsc_filename.replace(".dem.rsc", "_small.dem.rsc")
-        dem_filename_small = "small_" + output_name
-        rsc_filename_small = "small_" + rsc_filename
-
-        logger.info("Writing non-upsampled dem temporarily to %s", dem_filename_small)
-        stitched_dem.astype(dtype).tofile(dem_filename_small)
-        logger.info(
-            "Writing non-upsampled dem.rsc temporarily to %s", rsc_filename_small
-        )
-        with open(rsc_filename_small, "w") as f:
-            f.write(loading.format_dem_rsc(rsc_dict))
-
-        # Redo a new .rsc file for it
-        logger.info("Writing new upsampled dem.rsc to %s", rsc_filename)
-        with open(rsc_filename, "w") as f:
-            upsampled_rsc = upsample.upsample_dem_rsc(
-                xrate=xrate, yrate=yrate, rsc_dict=rsc_dict
-            )
-            f.write(upsampled_rsc)
-
-        # Now upsample using with GDAL or python
-        if utils._gdal_installed_correctly():
-            logger.info("Using GDAL Translate for upsampling")
-            upsample.upsample_with_gdal(
-                dem_filename_small,
-                output_name,
-                method="bilinear",  # make this an option?
-                xrate=xrate,
-                yrate=yrate,
-            )
-        else:
-            # Figure out size of row blocks to keep memory under 100 MB
-            nrows, ncols = stitched_dem.shape
-            block_rows = int(np.round(10e6 / ncols / 2, -2))  # round to 100s
-            logger.info("Upsampling by blocks of {} rows".format(block_rows))
-            upsample.upsample_by_blocks(
-                dem_filename_small,
-                output_name,
-                (nrows, ncols),
-                block_rows=block_rows,
-                dtype=dtype,
-                xrate=xrate,
-                yrate=yrate,
-            )
-        # Clean up the _small versions of dem and dem.rsc
-        logger.info("Cleaning up %s and %s", dem_filename_small, rsc_filename_small)
-        os.remove(dem_filename_small)
-        os.remove(rsc_filename_small)
+    if multilook:
+        logger.info("Taking ({}, {}) looks in (x, y) directions".format(xlooks, ylooks))
+    logger.info("Writing DEM to %s", output_name)
+    write_dem(output_name, dtype)
+    logger.info("Writing .dem.rsc file to %s", rsc_filename)
+    with open(rsc_filename, "w") as f:
+        f.write(loading.format_dem_rsc(rsc_dict))
 
     if make_isce_xml:
         logger.info("Creating ISCE2 XML file")
@@ -617,7 +783,13 @@ def main(
         logger.info("Keeping DEM as EGM96 geoid heights")
     else:
         logger.info("Correcting DEM to heights above WGS84 ellipsoid")
-        conversions.convert_dem_to_wgs84(output_name, geoid="egm96")
+        conversions.convert_dem_to_wgs84(
+            output_name,
+            geoid="egm96",
+            dtype=dtype,
+            cache_dir=cache_dir,
+            use_cache=cache_geoid,
+        )
 
     # If the user wants the .rsc file to point to pixel center:
     if shift_rsc:
@@ -1,16 +1,21 @@
+import functools
 import getpass
 import logging
 import math
 import netrc
 import os
 import re
-import subprocess
+import shutil
+import threading
+import zipfile
 from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from sardem import utils
+from sardem import cache, utils
 from sardem.constants import DEFAULT_RES
 
 try:
@@ -20,6 +25,26 @@ except NameError:
 
 logger = logging.getLogger("sardem")
 
+# Bitset over the 1x1 degree grid of which SRTM tiles exist (SRTMGL1 and SRTMSWBD
+# share the same tiles). Rows are latitudes -90 to 89, columns are longitudes
+# -180 to 179, for the tile's bottom-left corner. See `make_srtm_manifest`.
+# The bundled bitset was made from the 14280 granules of the LP DAAC SRTMGL1.003
+# collection, as listed by NASA's CMR.
+SRTM_MANIFEST_FILE = os.path.join(os.path.dirname(__file__), "data", "srtm_tiles.bin")
+MANIFEST_SHAPE = (180, 360)
+
+# Size of chunks to copy when inflating downloaded zip files
+UNZIP_CHUNK_SIZE = 1024 * 1024
+# Size of chunks to stream downloads to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Retry failed requests (5xx errors, connection errors and timeouts)
+# waiting BACKOFF_FACTOR * 2**(attempt - 1) seconds between attempts
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+# (connect, read) timeouts for each request, in seconds
+TIMEOUT = (10, 60)
+
 
 def _get_username_pass():
     """If netrc is not set up, get command line username and password"""
@@ -71,6 +96,62 @@ class Netrc(netrc.netrc):
         return repr(self)
 
 
+def make_session(max_workers, max_retries=MAX_RETRIES):
+    """Create a requests.Session with keep-alive and retries for all workers
+
+    The connection pool holds one connection per worker. Retries use
+    exponential backoff, and cover 5xx responses, connection errors and
+    timeouts.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=max_workers,
+        pool_maxsize=max_workers,
+        max_retries=retry,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def make_srtm_manifest(tile_names, outfile=SRTM_MANIFEST_FILE):
+    """Save the bitset of existing SRTM tiles used by `Tile.srtm1_tile_exists`
+
+    Args:
+        tile_names (Iterable[str]): names of all existing tiles, e.g. parsed
+            from the LP DAAC SRTMGL1 directory listing. Anything after the
+            tile name (e.g. '.SRTMGL1.hgt.zip') is ignored.
+        outfile (str): where to save the packed bitset
+    """
+    exists = np.zeros(MANIFEST_SHAPE, dtype=bool)
+    for tile_name in tile_names:
+        exists[_manifest_index(tile_name)] = True
+    np.packbits(exists).tofile(outfile)
+
+
+@functools.lru_cache(maxsize=None)
+def load_srtm_manifest(filename=SRTM_MANIFEST_FILE):
+    """Load the bitset of existing SRTM tiles, or None if it's not available"""
+    if not os.path.exists(filename):
+        return None
+    packed = np.fromfile(filename, dtype=np.uint8)
+    num_bits = MANIFEST_SHAPE[0] * MANIFEST_SHAPE[1]
+    return np.unpackbits(packed)[:num_bits].astype(bool).reshape(MANIFEST_SHAPE)
+
+
+def _manifest_index(tile_name):
+    lat_str, lat, lon_str, lon = Tile.get_tile_parts(tile_name)
+    lat = lat if lat_str == "N" else -lat
+    lon = lon if lon_str == "E" else -lon
+    return lat + 90, lon + 180
+
+
 class Tile:
     """class to handle tile name formation and parsing"""
 
@@ -127,6 +208,26 @@ class Tile:
         """
         return int(math.floor(lon)), int(math.floor(lat))
 
+    @staticmethod
+    def srtm1_tile_exists(tile_name):
+        """Check the bundled manifest for whether NASA has an SRTM1 tile
+
+        Tiles outside of the SRTM coverage (open ocean, above 60 degrees
+        latitude) don't exist. If no manifest is available, returns True.
+
+        Examples:
+            >>> Tile.srtm1_tile_exists('N19W156')
+            True
+            >>> Tile.srtm1_tile_exists('N30W140')  # Pacific Ocean
+            False
+            >>> Tile.srtm1_tile_exists('N70E020')  # Outside of SRTM coverage
+            False
+        """
+        manifest = load_srtm_manifest()
+        if manifest is None:
+            return True
+        return bool(manifest[_manifest_index(tile_name)])
+
     def srtm1_tile_names(self):
         """Iterator over all tiles needed to cover the requested bounds
 
@@ -185,6 +286,12 @@ class Downloader:
         data_source (str): choices: NASA, NASA_WATER, COP
             See module docstring for explanation of sources
         cache_dir (str): explcitly specify where to store .hgt files
+        max_workers (int): number of tiles to download at once, which is
+            also the size of the shared HTTP connection pool
+        max_retries (int): number of times to retry a failed tile request
+        use_manifest (bool): skip tiles which don't exist according to
+            `Tile.srtm1_tile_exists`. These are never requested or written to
+            the cache, and get None as their filename (zeros when stitching).
 
     Raises:
         ValueError: if data_source not a valid source string
@@ -210,7 +317,14 @@ class Downloader:
     NASAHOST = "urs.earthdata.nasa.gov"
 
     def __init__(
-        self, tile_names, data_source="NASA", netrc_file="~/.netrc", cache_dir=None
+        self,
+        tile_names,
+        data_source="NASA",
+        netrc_file="~/.netrc",
+        cache_dir=None,
+        max_workers=5,
+        max_retries=MAX_RETRIES,
+        use_manifest=True,
     ):
         self.tile_names = tile_names
         self.data_source = data_source
@@ -223,6 +337,14 @@ class Downloader:
         self.compress_type = self.COMPRESS_TYPES[data_source]
         self.netrc_file = os.path.expanduser(netrc_file)
         self.cache_dir = cache_dir or utils.get_cache_dir()
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.use_manifest = use_manifest
+        self._session = None
+        self._session_lock = threading.Lock()
+        # Bytes received over the network, summed across download threads
+        self.bytes_downloaded = 0
+        self._bytes_lock = threading.Lock()
 
     def _get_netrc_file(self):
         return Netrc(self.netrc_file)
@@ -298,29 +420,119 @@ class Downloader:
             )
         return url
 
-    def _download_hgt_tile(self, url):
-        """Example from https://lpdaac.usgs.gov/data_access/daac2disk "command line tips" """
+    def _make_session(self):
+        return make_session(self.max_workers, self.max_retries)
+
+    def _get_session(self):
+        """Return the session shared by the download threads, creating it once
+
+        Sharing one session also shares the Earthdata login cookies, so only
+        the first tile goes through the OAuth redirect.
+        """
+        with self._session_lock:
+            if self._session is None:
+                self._session = self._make_session()
+            return self._session
+
+    def _download_hgt_tile(self, url, headers=None):
+        """Example from https://lpdaac.usgs.gov/data_access/daac2disk "command line tips"
+
+        Returns a streaming response: the body is read by the caller.
+        """
+        session = self._get_session()
         # Using a netrc file is the easy cases
         logger.info("Downloading {}".format(url))
         if self.data_source.startswith("NASA") and self._has_nasa_netrc():
             logger.info("Using netrc file: %s", self.netrc_file)
-            response = requests.get(url)
+            response = session.get(url, headers=headers, stream=True, timeout=TIMEOUT)
         else:
-            # NASA without a netrc file needs special auth session handling
-            with requests.Session() as session:
-                session.auth = (self.username, self.password)
-                r1 = session.request("get", url)
+            # NASA without a netrc file needs special auth handling
+            auth = (self.username, self.password)
+            with session.get(url, auth=auth, stream=True, timeout=TIMEOUT) as r1:
                 # NASA then redirects to
                 # urs.earthdata.nasa.gov/oauth/authorize?scope=uid&app_type=401&client_id=...
-                response = session.get(r1.url, auth=(self.username, self.password))
+                redirect_url = r1.url
+            response = session.get(
+                redirect_url, auth=auth, headers=headers, stream=True, timeout=TIMEOUT
+            )
 
         return response
 
-    def _unzip_file(self, filepath):
-        """Unzips in place the .hgt files downloaded"""
-        # -o forces overwrite without prompt, -d specifices unzip directory
-        unzip_cmd = "unzip -o -d {}".format(self.cache_dir).split(" ")
-        subprocess.check_call(unzip_cmd + [filepath])
+    def _download_to_file(self, url, filename):
+        """Stream `url` to `filename`, resuming a previous partial download
+
+        Data is written to `filename`.part, which is renamed to `filename` only
+        once the full body has arrived. If the .part file exists, only the
+        missing bytes are requested with an HTTP Range header.
+
+        Returns:
+            bool: False if the url does not exist (404), True otherwise
+
+        Raises:
+            IOError: if the connection closed before the full file arrived
+                (the .part file is kept so the next attempt can resume)
+        """
+        part_filename = filename + ".part"
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        headers = {"Range": "bytes={}-".format(offset)} if offset else None
+        with self._download_hgt_tile(url, headers=headers) as response:
+            # Now check response for auth issues/ errors
+            if response.status_code == 404:
+                return False
+            if response.status_code == 416:
+                # The .part file doesn't match the remote file: start over
+                logger.warning("Cannot resume %s, restarting download", url)
+                os.remove(part_filename)
+                return self._download_to_file(url, filename)
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                logger.info("Resuming {} from byte {}".format(url, offset))
+                mode = "ab"
+            else:
+                # Server sent the whole file
+                offset, mode = 0, "wb"
+            expected_size = response.headers.get("Content-Length")
+            if "Content-Encoding" in response.headers:
+                # Length is of the encoded body, not what we write out
+                expected_size = None
+            logger.info("Writing to {}".format(part_filename))
+            with open(part_filename, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    with self._bytes_lock:
+                        self.bytes_downloaded += len(chunk)
+
+        if expected_size is not None:
+            size = os.path.getsize(part_filename)
+            if size != offset + int(expected_size):
+                raise IOError(
+                    "Incomplete download of {}: got {} of {} bytes".format(
+                        url, size, offset + int(expected_size)
+                    )
+                )
+        os.replace(part_filename, filename)
+        return True
+
+    def _unzip_file(self, filepath, outpath):
+        """Inflates the .hgt/.raw file inside the downloaded zip to `outpath`
+
+        Decompresses in-process (zlib releases the GIL, so this overlaps with
+        the other download threads). Writes to a temporary name first so that
+        `outpath` only appears once it is complete.
+        """
+        tmp_path = outpath + ".tmp"
+        with zipfile.ZipFile(filepath) as zf:
+            member = next(
+                (n for n in zf.namelist() if n.endswith("." + self.ext_type)), None
+            )
+            if member is None:
+                raise ValueError(
+                    "No .{} file found in {}".format(self.ext_type, filepath)
+                )
+            with zf.open(member) as src, open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, UNZIP_CHUNK_SIZE)
+        os.replace(tmp_path, outpath)
 
     def download_and_save(self, tile_name):
         """Download and save one single tile
@@ -330,54 +542,77 @@ class Downloader:
             e.g. N06W001.SRTMGL1.hgt.zip (usgs)
 
         Returns:
-            bool: True/False for Success/Failure of download
+            str: path to the downloaded tile, or None if the tile doesn't exist
         """
+        if not self._tile_exists(tile_name):
+            logger.info("No SRTM tile exists for {}, using zeros.".format(tile_name))
+            return None
         # keep all in one folder, compressed
         local_filename = self._filepath(tile_name)
         if os.path.exists(local_filename):
             logger.info("{} already exists, skipping.".format(local_filename))
-        else:
-            # download, then unzip
-            local_filename += ".{}".format(self.compress_type)
-            with open(local_filename, "wb") as f:
-                url = self._form_tile_url(tile_name)
-                response = self._download_hgt_tile(url)
-                # Now check response for auth issues/ errors
-                if response.status_code == 404:
-                    logger.warning("Cannot find url %s, using zeros for tile." % url)
-                    # Raise only if we want to kill everything
-                    # response.raise_for_status()
-                    local_filename = os.path.splitext(local_filename)[0]
-                    self._write_zeros(local_filename)
-                    return local_filename
-
-                f.write(response.content)
-                logger.info("Writing to {}".format(local_filename))
-            logger.info("Unzipping {}".format(local_filename))
-            self._unzip_file(local_filename)
-            # Now get rid of the .zip again
-            local_filename = os.path.splitext(local_filename)[0]
+            cache.touch(local_filename)
+            return local_filename
+
+        # Only one process downloads a tile: the others wait, then reuse it
+        with cache.file_lock(local_filename):
+            if os.path.exists(local_filename):
+                logger.info("{} was downloaded by another job.".format(local_filename))
+                return local_filename
+            return self._download_and_unzip(tile_name, local_filename)
+
+    def _download_and_unzip(self, tile_name, local_filename):
+        # download, then unzip
+        # A finished .zip may be left over if a previous run stopped before unzipping
+        zip_filename = local_filename + ".{}".format(self.compress_type)
+        if not os.path.exists(zip_filename):
+            url = self._form_tile_url(tile_name)
+            if not self._download_with_resume(url, zip_filename):
+                # Zeros are filled in when stitching: nothing is cached
+                logger.warning("Cannot find url %s, using zeros for tile." % url)
+                return None
+
+        logger.info("Unzipping {}".format(zip_filename))
+        self._unzip_file(zip_filename, local_filename)
+        # Now get rid of the .zip again
+        os.remove(zip_filename)
         # True indicates success for this tile_name
         return local_filename
 
+    def _download_with_resume(self, url, filename):
+        """Call `_download_to_file`, resuming if the transfer is interrupted"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._download_to_file(url, filename)
+            except requests.exceptions.HTTPError:
+                raise
+            except IOError as e:
+                # Includes requests' connection errors, which subclass IOError
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("Download of %s interrupted (%s), resuming", url, e)
+
     def _filepath(self, tile_name):
         return os.path.join(self.cache_dir, tile_name + "." + self.ext_type)
 
+    def _tile_exists(self, tile_name):
+        return not self.use_manifest or Tile.srtm1_tile_exists(tile_name)
+
     def _all_files_exist(self):
-        filepaths = [self._filepath(tile_name) for tile_name in self.tile_names]
+        filepaths = [
+            self._filepath(tile_name)
+            for tile_name in self.tile_names
+            if self._tile_exists(tile_name)
+        ]
         return all(os.path.exists(f) for f in filepaths)
 
-    def _write_zeros(self, local_filename):
-        shape = (3601, 3601)
-        if self.data_source == "NASA_WATER":
-            dtype = np.uint8
-        else:
-            dtype = np.int16
-        data = np.zeros(shape, dtype=dtype)
-        data.tofile(local_filename)
+    def download_all(self, keep=()):
+        """Downloads and saves all tiles from tile list
 
-    def download_all(self):
-        """Downloads and saves all tiles from tile list"""
+        Args:
+            keep (Iterable[str]): other cached files which the cache pruning
+                after the download must not evict
+        """
         # Only need to get credentials for this case:
         if (
             not self._all_files_exist()
@@ -386,9 +621,16 @@ class Downloader:
         ):
             self.handle_credentials()
 
-        pool = ThreadPool(processes=5)
+        pool = ThreadPool(processes=self.max_workers)
         local_filenames = pool.map(self.download_and_save, self.tile_names)
         pool.close()
+        # Only evict from sardem's own cache, not a user-chosen directory
+        if os.path.abspath(self.cache_dir) == os.path.abspath(utils.get_cache_dir()):
+            cache.prune(
+                cache_dir=self.cache_dir,
+                keep=[f for f in local_filenames if f] + list(keep),
+                min_age=cache.RECENT_USE_SECONDS,
+            )
         if not any(local_filenames):
             raise ValueError(
                 "No successful .hgt tiles found and downloaded:"
@@ -28,6 +28,11 @@ DEFAULT_KEYS = {
 }
 
 
+# SRTM voids are INT_MIN (-32768); anything below this is treated as a void
+MIN_VALID_ELEVATION = -1000
+SRTM_VOID = -32768
+
+
 def load_elevation(filename):
     """Loads a digital elevation map from either .hgt file or .dem
 
@@ -44,41 +49,65 @@ def load_elevation(filename):
     """
     import numpy as np
 
-    INT_16_LE = np.dtype("<i2")
-    INT_16_BE = np.dtype(">i2")
     ext = os.path.splitext(filename)[1]
-    data_type = INT_16_LE if ext == ".dem" else INT_16_BE
-    data = np.fromfile(filename, dtype=data_type)
-    # Make sure we're working with little endian
-    if data_type == INT_16_BE:
-        data = data.astype(INT_16_LE)
-
-    # Reshape to correct size.
-    # Either get info from .dem.rsc
-    if ext == ".dem":
-        info = load_dem_rsc(filename)
-        dem_img = data.reshape((info["file_length"], info["width"]))
-
-    # Or check if we are using STRM1 (3601x3601) or SRTM3 (1201x1201)
+    if ext != ".dem":
+        # Read .hgt through the memmap, converting the full tile once
+        return fix_elevation(memmap_elevation(filename))
+
+    # Get shape info from .dem.rsc
+    data = np.fromfile(filename, dtype=np.dtype("<i2"))
+    info = load_dem_rsc(filename)
+    return data.reshape((info["file_length"], info["width"]))
+
+
+def memmap_elevation(filename):
+    """Opens a .hgt tile as a read-only, memory-mapped array
+
+    No data is read until the array is sliced. Values are still the raw
+    big-endian 16-bit integers, with voids marked by -32768: pass the slice
+    you need through `fix_elevation` to get native-endian, void-free data.
+
+    Raises:
+        ValueError: if the file is not a square SRTM1 (3601) or SRTM3 (1201) tile
+    """
+    import numpy as np
+
+    INT_16_BE = np.dtype(">i2")
+    num_values = os.path.getsize(filename) // INT_16_BE.itemsize
+    # Check if we are using STRM1 (3601x3601) or SRTM3 (1201x1201)
+    for size in (3601, 1201):
+        if num_values == size * size:
+            break
     else:
-        if (data.shape[0] / 3601) == 3601:
-            # STRM1- 1 arc second data, 30 meter data
-            dem_img = data.reshape((3601, 3601))
-        elif (data.shape[0] / 1201) == 1201:
-            # STRM3- 3 arc second data, 90 meter data
-            dem_img = data.reshape((1201, 1201))
-        else:
-            raise ValueError(
-                "Invalid .hgt in {} data size: must be square size 1201 or 3601".format(
-                    filename
-                )
+        raise ValueError(
+            "Invalid .hgt in {} data size: must be square size 1201 or 3601".format(
+                filename
             )
-        # TODO: Verify that the min real value will be above -1000
-        min_valid = -1000
-        # Set NaN values to 0
-        dem_img[dem_img < min_valid] = 0
+        )
+    return np.memmap(filename, dtype=INT_16_BE, mode="r", shape=(size, size))
 
-    return dem_img
+
+def fix_elevation(data, out=None, void_value=0):
+    """Converts (a window of) raw .hgt data to native int16 with voids set to 0
+
+    Args:
+        data (ndarray): big-endian elevation data, e.g. a slice of `memmap_elevation`
+        out (ndarray): optional int16 array to write into, same shape as `data`
+        void_value (int): value given to the voids instead of 0, e.g. `SRTM_VOID`
+            to tell them apart from sea level
+
+    Returns:
+        ndarray: `out`, or a new array if `out` was not passed
+    """
+    import numpy as np
+
+    if out is None:
+        out = np.empty(data.shape, dtype=np.int16)
+    # Assigning into the native int16 array does the byteswap
+    out[...] = data
+    # TODO: Verify that the min real value will be above -1000
+    out[out < MIN_VALID_ELEVATION] = void_value
+    return out
 
 
 def load_watermask(filename):
@@ -91,6 +120,13 @@ def load_watermask(filename):
     return np.fromfile(filename, dtype=np.uint8).reshape((3601, 3601))
 
 
+def memmap_watermask(filename):
+    """Opens a .raw waterbody data file mask as a read-only, memory-mapped array"""
+    import numpy as np
+
+    return np.memmap(filename, dtype=np.uint8, mode="r", shape=(3601, 3601))
+
+
 def load_dem_rsc(filename, lower=False, **kwargs):
     """Loads and parses the .dem.rsc file
 
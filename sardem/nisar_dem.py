@@ -3,7 +3,7 @@ import netrc
 import os
 from copy import deepcopy
 
-from sardem import utils
+from sardem import remote_io, utils
 from sardem.constants import DEFAULT_RES
 
 _NISAR_BASE_URL = "https://nisar.asf.earthdatacloud.nasa.gov/NISAR/DEM/v1.2"
@@ -93,6 +93,7 @@ def download_and_stitch(
     bbox: tuple,
     xrate: int = 1,
     yrate: int = 1,
+    target_shape: tuple | None = None,
     vrt_filename: str | None = None,
     output_format: str = "GTiff",
     output_type: str = "float32",
@@ -109,10 +110,12 @@ def download_and_stitch(
         Path for the output DEM file.
     bbox : tuple
         (left, bottom, right, top) in degrees.
-    xrate : int
-        Column upsampling rate.
-    yrate : int
+    xrate : float
+        Column upsampling rate (need not be an integer).
+    yrate : float
         Row upsampling rate.
+    target_shape : tuple, optional
+        (rows, cols) of the output. Overrides the rates if given.
     vrt_filename : str, optional
         Override the VRT source (for testing). Defaults to the NISAR VRT URL.
     output_format : str
@@ -129,21 +132,20 @@ def download_and_stitch(
     gdal.UseExceptions()
 
     dst_srs = None
-    if vrt_filename is None:
+    builtin = vrt_filename is None
+    if builtin:
         _check_earthdata_credentials()
         _configure_gdal_auth()
         vrt_filename, dst_srs = _select_vrt(bbox)
 
     xres = DEFAULT_RES / xrate
     yres = DEFAULT_RES / yrate
-    resamp = "bilinear" if (xrate > 1 or yrate > 1) else "nearest"
+    resamp = utils.gdal_resample_alg(xrate, yrate)
 
     option_dict = dict(
         format=output_format,
         outputBounds=utils.align_bounds_to_pixel_grid(bbox),
         dstSRS=dst_srs,
-        xRes=xres,
-        yRes=yres,
         outputType=gdal.GetDataTypeByName(output_type.title()),
         resampleAlg=resamp,
         multithread=True,
@@ -151,6 +153,8 @@ def download_and_stitch(
         warpOptions=["NUM_THREADS=4"],
     )
 
+    option_dict.update(utils.gdal_size_options(xres, yres, target_shape))
+
     logger.info("Creating %s", output_name)
     logger.info("Fetching remote tiles...")
     try:
@@ -162,7 +166,8 @@ def download_and_stitch(
         logger.info(option_dict)
 
     option_dict["callback"] = gdal.TermProgress
-    gdal.Warp(output_name, vrt_filename, options=gdal.WarpOptions(**option_dict))
+    with remote_io.gdal_config(builtin=builtin):
+        gdal.Warp(output_name, vrt_filename, options=gdal.WarpOptions(**option_dict))
 
 
 def _gdal_cmd_from_options(src: str, dst: str, option_dict: dict) -> str:
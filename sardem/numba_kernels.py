@@ -0,0 +1,85 @@
+"""Numba versions of the interpolation kernels in `upsample`
+
+Needs numba, an optional dependency: `numba` is None if it's not installed.
+`upsample.separable_resample` uses these when the interpolation backend is
+"numba" (see `upsample.set_backend`).
+
+Instead of NumPy's passes over temporary arrays, the same operations are done
+in fused loops, parallelized over chunks of output rows with `prange`. Each
+chunk interpolates along its source rows once, into a small per-thread buffer.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+    prange = range
+else:
+    prange = numba.prange
+
+
+def _resample_separable(
+    arr, y_idxs, y_weights, x_idxs, x_weights, out, round_output, lo, hi, chunk_rows
+):
+    """Apply a separable kernel to `arr`, writing into `out`
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        2D source array (native byte order)
+    y_idxs, y_weights : np.ndarray
+        (num_taps, out_rows) source row indices and weights of each output row
+    x_idxs, x_weights : np.ndarray
+        (num_taps, out_cols) source column indices and weights of each column.
+        Everything is computed in the dtype of the weights.
+    out : np.ndarray
+        (out_rows, out_cols) output array
+    round_output : bool
+        Round to the nearest integer, and clip to [`lo`, `hi`]
+        (for integer `out` arrays)
+    lo, hi : float
+        Range of the output dtype, if `round_output`
+    chunk_rows : int
+        Number of output rows computed at a time by each thread
+    """
+    num_y_taps, out_rows = y_idxs.shape
+    num_x_taps, out_cols = x_idxs.shape
+    num_chunks = (out_rows + chunk_rows - 1) // chunk_rows
+    for c in prange(num_chunks):
+        start = c * chunk_rows
+        stop = min(start + chunk_rows, out_rows)
+        src_start = y_idxs[:, start:stop].min()
+        src_stop = y_idxs[:, start:stop].max() + 1
+        # Interpolate along each source row used by the chunk, once
+        lines = np.empty((src_stop - src_start, out_cols), dtype=x_weights.dtype)
+        for r in range(src_start, src_stop):
+            line = lines[r - src_start]
+            for j in range(out_cols):
+                line[j] = x_weights[0, j] * arr[r, x_idxs[0, j]]
+            for tx in range(1, num_x_taps):
+                for j in range(out_cols):
+                    line[j] += x_weights[tx, j] * arr[r, x_idxs[tx, j]]
+        # Then between those lines, for each output row
+        row = np.empty(out_cols, dtype=x_weights.dtype)
+        for i in range(start, stop):
+            line = lines[y_idxs[0, i] - src_start]
+            weight = y_weights[0, i]
+            for j in range(out_cols):
+                row[j] = weight * line[j]
+            for ty in range(1, num_y_taps):
+                line = lines[y_idxs[ty, i] - src_start]
+                weight = y_weights[ty, i]
+                for j in range(out_cols):
+                    row[j] += weight * line[j]
+            for j in range(out_cols):
+                if round_output:
+                    out[i, j] = min(max(np.rint(row[j]), lo), hi)
+                else:
+                    out[i, j] = row[j]
+
+
+if numba is not None:
+    resample_separable = numba.njit(parallel=True, nogil=True, cache=True)(
+        _resample_separable
+    )
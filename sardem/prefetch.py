@@ -0,0 +1,162 @@
+"""Fill the download cache ahead of time for a set of areas of interest
+
+Running `sardem prefetch` before a processing campaign downloads every SRTM
+tile the campaign will need, so the DEM jobs only read from the cache and
+never block on the network.
+
+Usage:
+    sardem prefetch --bbox -156 18.8 -154.7 20.3 --bbox -120 34 -118 36
+    sardem prefetch --aoi-file frames.geojson --data-source NASA_WATER
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from sardem import cache, utils
+from sardem.constants import NUM_PIXELS_SRTM1
+from sardem.download import Downloader, Tile
+
+logger = logging.getLogger("sardem")
+
+# Tiles are independent and mostly wait on the network, so prefetching can
+# use many more connections than a single DEM job
+DEFAULT_WORKERS = 16
+
+
+def aoi_file_bboxes(filename):
+    """Bounding boxes of every feature in a geojson file
+
+    Args:
+        filename (str): geojson with a FeatureCollection, Feature, or geometry
+
+    Returns:
+        list[tuple[float]]: (left, bottom, right, top) of each feature
+    """
+    with open(filename) as f:
+        geojson = json.load(f)
+    if geojson.get("type") == "FeatureCollection":
+        geometries = [feature["geometry"] for feature in geojson["features"]]
+    elif geojson.get("type") == "Feature":
+        geometries = [geojson["geometry"]]
+    else:
+        geometries = [geojson]
+    return [_geometry_bounds(g) for g in geometries]
+
+
+def _geometry_bounds(geometry):
+    """(left, bottom, right, top) of a geojson geometry of any type"""
+    if "coordinates" not in geometry:
+        raise ValueError("Invalid geojson geometry: {}".format(geometry))
+    # Polygons, MultiPolygons, etc. only differ in how deeply points are nested
+    points = np.array(_flatten_points(geometry["coordinates"]))
+    left, bottom = points[:, :2].min(axis=0)
+    right, top = points[:, :2].max(axis=0)
+    return (float(left), float(bottom), float(right), float(top))
+
+
+def _flatten_points(coordinates):
+    if not isinstance(coordinates[0], (list, tuple)):
+        return [coordinates]
+    return [p for c in coordinates for p in _flatten_points(c)]
+
+
+def tile_names_for_bboxes(bboxes):
+    """All unique tiles needed to cover `bboxes`, in first-seen order
+
+    Bounding boxes crossing the antimeridian are split first, as in `dem.main`.
+    """
+    tile_names = []
+    seen = set()
+    for bbox in bboxes:
+        for sub_bbox in utils.check_dateline(bbox):
+            for tile_name in Tile(*sub_bbox).srtm1_tile_names():
+                if tile_name not in seen:
+                    seen.add(tile_name)
+                    tile_names.append(tile_name)
+    return tile_names
+
+
+def prefetch(
+    bboxes,
+    data_source="NASA",
+    cache_dir=None,
+    max_workers=DEFAULT_WORKERS,
+    netrc_file="~/.netrc",
+):
+    """Download all tiles covering `bboxes` into the cache
+
+    Args:
+        bboxes (Iterable[tuple[float]]): (left, bottom, right, top) of each AOI
+        data_source (str): "NASA" or "NASA_WATER"
+        cache_dir (str): where to save tiles. Defaults to `utils.get_cache_dir()`
+        max_workers (int): number of tiles to download at once
+        netrc_file (str): location of the NASA Earthdata credentials
+
+    Returns:
+        dict: summary with keys "tiles" (unique tiles covering the AOIs),
+            "nonexistent" (ocean tiles with no SRTM data), "cached" (already
+            in the cache), "downloaded", "bytes" (received over the network),
+            "seconds", and "bytes_per_second"
+    """
+    if data_source not in ("NASA", "NASA_WATER"):
+        raise ValueError("Can only prefetch NASA or NASA_WATER tiles")
+    tile_names = tile_names_for_bboxes(bboxes)
+    downloader = Downloader(
+        [],
+        data_source=data_source,
+        netrc_file=netrc_file,
+        cache_dir=cache_dir,
+        max_workers=max_workers,
+    )
+    existing = [t for t in tile_names if downloader._tile_exists(t)]
+    filepaths = [downloader._filepath(t) for t in existing]
+    missing = [t for t, f in zip(existing, filepaths) if not os.path.exists(f)]
+    # Mark the cached tiles as recently used. They are also kept by the cache
+    # pruning after the download, which only evicts files from other campaigns.
+    for filepath in filepaths:
+        cache.touch(filepath)
+    _check_cache_size(len(existing), data_source)
+    logger.info(
+        "%d tiles cover the AOIs: %d have no SRTM data, %d already cached",
+        len(tile_names),
+        len(tile_names) - len(existing),
+        len(existing) - len(missing),
+    )
+
+    t0 = time.time()
+    downloaded = []
+    if missing:
+        downloader.tile_names = missing
+        downloaded = downloader.download_all(keep=filepaths)
+    elapsed = time.time() - t0
+
+    return {
+        "tiles": len(tile_names),
+        "nonexistent": len(tile_names) - len(existing),
+        "cached": len(existing) - len(missing),
+        # Tiles NASA doesn't have (404) aren't saved
+        "downloaded": sum(1 for f in downloaded if f),
+        "bytes": downloader.bytes_downloaded,
+        "seconds": elapsed,
+        "bytes_per_second": downloader.bytes_downloaded / elapsed if elapsed else 0.0,
+    }
+
+
+def _check_cache_size(num_tiles, data_source):
+    """Warn if `num_tiles` tiles would not fit in the cache budget"""
+    bytes_per_pixel = 1 if data_source == "NASA_WATER" else 2
+    needed = num_tiles * NUM_PIXELS_SRTM1**2 * bytes_per_pixel
+    max_bytes = cache.get_max_size()
+    if needed > max_bytes:
+        logger.warning(
+            "The %d tiles need %s, more than the %s cache budget: raise %s, or"
+            " the DEM jobs will download evicted tiles again",
+            num_tiles,
+            cache.format_size(needed),
+            cache.format_size(max_bytes),
+            cache.MAX_SIZE_ENV,
+        )
+    return needed
@@ -0,0 +1,162 @@
+"""GDAL settings for reading remote rasters through /vsicurl/
+
+GDAL's defaults are made for local files: opening a /vsicurl/ file first lists
+its "directory" and probes for sidecar files (.aux.xml, .ovr, ...), every
+block read is its own HTTP/1.1 request, and little of what was read is kept.
+`gdal_config` sets GDAL config options tuned for the remote COG tiles and VRTs
+around the remote reads in `cop_dem` and `nisar_dem`, and restores the
+previous values afterwards. Options which assume sardem's own sources (e.g.
+that only .tif and .vrt files exist) are only set for those, not for a
+user's --vrt-filename.
+
+The options come from one of the PRESETS (DEFAULT_PRESET unless chosen with
+`set_profile` or the SARDEM_REMOTE_IO environment variable), plus overrides,
+e.g. from `sardem --gdal-config KEY=VALUE`.
+Options the user already set (in the environment, or with
+gdal.SetConfigOption) take precedence over the preset, but not the overrides.
+"""
+import contextlib
+import logging
+import os
+
+from sardem import download
+
+logger = logging.getLogger("sardem")
+
+PROFILE_ENV = "SARDEM_REMOTE_IO"
+DEFAULT_PRESET = "tuned"
+
+_TUNED = {
+    # Many block requests at once, over one connection where the server
+    # speaks HTTP/2 (GDAL's default HTTP version negotiates it over TLS)
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    # One request for adjacent blocks instead of one per block
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    # No listing of the remote directory, and no probing for sidecar files
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    # Only for the built-in sources, which have no other files
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff,.vrt",
+    # Keep what was read: per open file, and across all /vsicurl/ files
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(64 * 1024**2),
+    "CPL_VSIL_CURL_CACHE_SIZE": str(256 * 1024**2),
+    # Retry 429 and 5xx errors, as the SRTM downloads do
+    "GDAL_HTTP_MAX_RETRY": str(download.MAX_RETRIES),
+    "GDAL_HTTP_RETRY_DELAY": "1",
+}
+PRESETS = {
+    # GDAL's own defaults: set nothing
+    "gdal": {},
+    "tuned": _TUNED,
+    # For servers and proxies without HTTP/2
+    "http1": dict(_TUNED, GDAL_HTTP_VERSION="1.1", GDAL_HTTP_MULTIPLEX="NO"),
+}
+# Preset options only set when reading sardem's own COP/NISAR files
+BUILTIN_ONLY_OPTIONS = ("CPL_VSIL_CURL_ALLOWED_EXTENSIONS",)
+
+_profile = None
+
+
+def set_profile(preset=DEFAULT_PRESET, overrides=None):
+    """Choose the GDAL config options set by `gdal_config`
+
+    Args:
+        preset (str): name of one of the PRESETS
+        overrides (dict[str, str]): options to set on top of the preset,
+            even if the user already set them. A value of None leaves the
+            option to GDAL instead.
+
+    Returns:
+        tuple[dict[str, str], dict[str, str]]: the preset's options, and the
+            overrides, now in use
+    """
+    global _profile
+    if preset not in PRESETS:
+        raise ValueError(
+            "Unknown remote I/O preset {}: choices are {}".format(
+                preset, ", ".join(PRESETS)
+            )
+        )
+    overrides = dict(overrides or {})
+    options = {k: v for k, v in PRESETS[preset].items() if k not in overrides}
+    _profile = (options, {k: v for k, v in overrides.items() if v is not None})
+    return _profile
+
+
+def get_profile():
+    """The options in use, from the preset in $SARDEM_REMOTE_IO at first"""
+    if _profile is None:
+        set_profile(os.getenv(PROFILE_ENV, DEFAULT_PRESET))
+    return _profile
+
+
+def parse_overrides(items):
+    """Parse KEY=VALUE strings into a dict of GDAL config options
+
+    An empty value (KEY=) leaves the option to GDAL.
+
+    Examples:
+        >>> parse_overrides(["GDAL_HTTP_MAX_RETRY=10", "VSI_CACHE="])
+        {'GDAL_HTTP_MAX_RETRY': '10', 'VSI_CACHE': None}
+    """
+    overrides = {}
+    for item in items or []:
+        key, sep, value = item.partition("=")
+        if not sep or not key:
+            raise ValueError("Expected KEY=VALUE, got {}".format(item))
+        overrides[key.strip()] = value or None
+    return overrides
+
+
+def resolve_options(get_option=None, builtin=False):
+    """The GDAL config options `gdal_config` would set now
+
+    Args:
+        get_option (Callable[[str], str]): current value of an option, or
+            None if unset. Defaults to gdal.GetConfigOption.
+        builtin (bool): whether the files read are sardem's own COP/NISAR
+            sources. If not, the BUILTIN_ONLY_OPTIONS of the preset are left out.
+
+    Returns:
+        dict[str, str]
+    """
+    if get_option is None:
+        from osgeo import gdal
+
+        get_option = gdal.GetConfigOption
+    preset_options, overrides = get_profile()
+    options = {
+        k: v
+        for k, v in preset_options.items()
+        if get_option(k) is None and (builtin or k not in BUILTIN_ONLY_OPTIONS)
+    }
+    options.update(overrides)
+    return options
+
+
+@contextlib.contextmanager
+def gdal_config(builtin=False, **extra):
+    """Set the remote I/O options as GDAL config options, restoring them on exit
+
+    Args:
+        builtin (bool): whether the files read are sardem's own COP/NISAR
+            sources (see `resolve_options`)
+        **extra: more options to set, e.g. for authentication
+
+    Yields:
+        dict[str, str]: the options which were set
+    """
+    from osgeo import gdal
+
+    options = resolve_options(gdal.GetConfigOption, builtin=builtin)
+    options.update(extra)
+    previous = {key: gdal.GetConfigOption(key) for key in options}
+    logger.debug("Remote I/O GDAL options: %s", options)
+    try:
+        for key, value in options.items():
+            gdal.SetConfigOption(key, value)
+        yield options
+    finally:
+        for key, value in previous.items():
+            # None unsets the option again
+            gdal.SetConfigOption(key, value)
@@ -0,0 +1,62 @@
+import os
+import time
+
+import pytest
+
+from sardem import cache
+
+
+def _make_file(path, size, atime):
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    os.utime(path, (atime, atime))
+    return str(path)
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    now = time.time()
+    _make_file(tmp_path / "old.hgt", 100, now - 300)
+    _make_file(tmp_path / "mid.hgt", 100, now - 200)
+    _make_file(tmp_path / "new.hgt", 100, now - 100)
+    # Downloads in progress are ignored
+    _make_file(tmp_path / "partial.hgt.zip.part", 1000, now - 1000)
+    return tmp_path
+
+
+def test_stats(cache_dir):
+    info = cache.stats(str(cache_dir))
+    assert info["num_files"] == 3
+    assert info["total_bytes"] == 300
+
+
+def test_prune_lru(cache_dir):
+    removed = cache.prune(max_bytes=200, cache_dir=str(cache_dir))
+    assert [os.path.basename(p) for p in removed] == ["old.hgt"]
+
+    # A recent access protects "mid" from being evicted next
+    cache.touch(str(cache_dir / "mid.hgt"))
+    removed = cache.prune(max_bytes=100, cache_dir=str(cache_dir))
+    assert [os.path.basename(p) for p in removed] == ["new.hgt"]
+
+
+def test_prune_keep(cache_dir):
+    keep = [str(cache_dir / "old.hgt")]
+    removed = cache.prune(max_bytes=100, cache_dir=str(cache_dir), keep=keep)
+    assert sorted(os.path.basename(p) for p in removed) == ["mid.hgt", "new.hgt"]
+
+
+def test_prune_min_age(cache_dir):
+    # Only "old" was last used more than 250 seconds ago
+    removed = cache.prune(max_bytes=0, cache_dir=str(cache_dir), min_age=250)
+    assert [os.path.basename(p) for p in removed] == ["old.hgt"]
+
+
+def test_clear(cache_dir):
+    cache.clear(str(cache_dir))
+    assert os.listdir(cache_dir) == ["partial.hgt.zip.part"]
+
+
+def test_max_size_env(monkeypatch):
+    monkeypatch.setenv(cache.MAX_SIZE_ENV, "512M")
+    assert cache.get_max_size() == 512 * 1024**2
@@ -0,0 +1,203 @@
+import os
+
+import numpy as np
+import pytest
+import requests
+import responses
+from numpy.testing import assert_allclose
+
+from sardem import conversions, loading
+
+
+def _write_gtx(filename, grid, lat0=-90.0, lon0=-180.0, dlat=1.0, dlon=1.0):
+    header = np.array(
+        [(lat0, lon0, dlat, dlon, grid.shape[0], grid.shape[1])],
+        dtype=conversions.GTX_HEADER,
+    )
+    with open(filename, "wb") as f:
+        f.write(header.tobytes())
+        f.write(grid.astype(">f4").tobytes())
+
+
+def _linear_geoid(lats, lons):
+    # Bilinear interpolation reproduces this exactly (away from the dateline)
+    return 0.5 * lats[:, np.newaxis] - 0.25 * lons[np.newaxis, :] + 20
+
+
+@pytest.fixture
+def egm96_file(tmp_path):
+    # 1 degree global grid, without the repeated 180 degree column
+    lats = -90.0 + np.arange(181)
+    lons = -180.0 + np.arange(360)
+    filename = tmp_path / os.path.basename(conversions.EGM_FILES["egm96"])
+    _write_gtx(filename, _linear_geoid(lats, lons))
+    return filename
+
+
+def _write_dem(tmp_path, dem, x_first, y_first, step):
+    filename = str(tmp_path / "elevation.dem")
+    dem.tofile(filename)
+    rsc_dict = {
+        "width": dem.shape[1],
+        "file_length": dem.shape[0],
+        "x_first": x_first,
+        "y_first": y_first,
+        "x_step": step,
+        "y_step": -step,
+    }
+    with open(filename + ".rsc", "w") as f:
+        f.write(loading.format_dem_rsc(rsc_dict))
+    return filename
+
+
+def test_read_gtx(egm96_file):
+    grid, header = conversions.read_gtx(egm96_file)
+    assert grid.shape == (181, 360)
+    assert (header["lat0"], header["lon0"], header["dlon"]) == (-90, -180, 1)
+    assert_allclose(grid[90, 180], 20)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "int16"])
+@pytest.mark.parametrize("use_cache", [True, False])
+def test_convert_dem_to_wgs84(tmp_path, egm96_file, dtype, use_cache):
+    step = 0.05
+    x_first, y_first = -156.0, 20.3
+    rng = np.random.default_rng(0)
+    dem = rng.integers(0, 4000, size=(37, 53)).astype(dtype)
+    filename = _write_dem(tmp_path, dem, x_first, y_first, step)
+
+    # Nothing is saved to the cache unless asked for
+    kwargs = {"use_cache": True} if use_cache else {}
+    conversions.convert_dem_to_wgs84(
+        filename, cache_dir=str(tmp_path), num_threads=3, **kwargs
+    )
+
+    lons = x_first + (np.arange(53) + 0.5) * step
+    lats = y_first - (np.arange(37) + 0.5) * step
+    expected = dem + _linear_geoid(lats, lons)
+    # Converted in place, with no leftover files
+    out = np.fromfile(filename, dtype=dtype).reshape(dem.shape)
+    assert_allclose(out, expected, atol=1e-3 if dtype == "float32" else 0.5)
+    assert sorted(os.listdir(tmp_path)) == [
+        "egm96_15.gtx",
+        "elevation.dem",
+        "elevation.dem.rsc",
+    ] + (["geoid"] if use_cache else [])
+
+
+def test_geoid_tile(tmp_path, egm96_file):
+    cache_dir = str(tmp_path)
+    grid, header = conversions.geoid_tile("egm96", 45, 10, cache_dir=cache_dir)
+    # The nodes of the tile, and one more on each side
+    assert grid.shape == (4, 4)
+    assert (header["lat0"], header["lon0"]) == (44, 9)
+    assert os.listdir(tmp_path / "geoid" / "egm96") == ["N45E010.npz"]
+
+    lons = 10.0 + (np.arange(40) + 0.5) / 30
+    lats = 46.0 - (np.arange(30) + 0.5) / 30
+    und = conversions.geoid_undulation(lons, lats, cache_dir=cache_dir, use_cache=True)
+    assert_allclose(und, _linear_geoid(lats, lons), atol=1e-4)
+
+    # Later runs only need the saved tile
+    os.remove(egm96_file)
+    conversions._load_geoid_tile.cache_clear()
+    assert_allclose(
+        conversions.geoid_undulation(
+            lons, lats, cache_dir=cache_dir, use_cache=True
+        ),
+        und,
+    )
+
+
+def test_geoid_tile_wraps_dateline(egm96_file):
+    cache_dir = str(egm96_file.parent)
+    lons = np.array([179.25, 179.75, -179.5])
+    lats = np.array([0.5, -0.5])
+    assert_allclose(
+        conversions.geoid_undulation(lons, lats, cache_dir=cache_dir, use_cache=True),
+        conversions.geoid_undulation(lons, lats, cache_dir=cache_dir),
+        atol=1e-5,
+    )
+    assert sorted(os.listdir(egm96_file.parent / "geoid" / "egm96")) == [
+        "N00E179.npz",
+        "N00W180.npz",
+        "S01E179.npz",
+        "S01W180.npz",
+    ]
+
+
+def test_geoid_tile_outside_grid(tmp_path):
+    # A regional grid, over 30-40 N and 100-110 W
+    lats = 30.0 + np.arange(11)
+    lons = -110.0 + np.arange(11)
+    _write_gtx(tmp_path / "egm96_15.gtx", _linear_geoid(lats, lons), 30, -110)
+    grid, _ = conversions.geoid_tile("egm96", 39, -101, cache_dir=str(tmp_path))
+    assert grid.shape == (2 + 1, 2 + 1)
+    with pytest.raises(ValueError):
+        conversions.geoid_tile("egm96", 40, -105, cache_dir=str(tmp_path))
+    with pytest.raises(ValueError):
+        conversions.fetch_geoid("egm96", (-111.5, 35, -109, 36), str(tmp_path))
+
+
+def test_undulation_wraps_dateline(egm96_file):
+    # Halfway between the last column (179) and the first (-180 = 180)
+    und = conversions.geoid_undulation(
+        np.array([179.5, -179.5, 180.5]),
+        np.array([0.0]),
+        cache_dir=str(egm96_file.parent),
+    )
+    west, east = 20 - 0.25 * 179, 20 + 0.25 * 180
+    assert_allclose(
+        und, [[(west + east) / 2, east - 0.125, east - 0.125]], atol=1e-5
+    )
+
+
+@responses.activate
+def test_download_geoid(tmp_path):
+    grid = np.zeros((181, 361), dtype="float32")
+    body = tmp_path / "remote.gtx"
+    _write_gtx(body, grid)
+    url = conversions.EGM_URLS["egm96"]
+    responses.add(responses.GET, url, body=body.read_bytes())
+
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    filename = conversions.download_geoid("egm96", cache_dir=str(cache_dir))
+    assert filename == str(cache_dir / "egm96_15.gtx")
+    assert conversions.read_gtx(filename)[0].shape == (181, 361)
+    # Second call uses the cached file
+    conversions.download_geoid("egm96", cache_dir=str(cache_dir))
+    assert len(responses.calls) == 1
+    assert sorted(os.listdir(cache_dir)) == ["egm96_15.gtx"]
+
+
+@responses.activate
+def test_download_geoid_failure(tmp_path, monkeypatch):
+    url = conversions.EGM_URLS["egm96"]
+    responses.add(responses.GET, url, body=b"\0" * 100)
+
+    def _broken_stream(self, chunk_size=1):
+        yield b"\0" * 10
+        raise requests.ConnectionError("Connection reset")
+
+    monkeypatch.setattr(requests.Response, "iter_content", _broken_stream)
+    with pytest.raises(requests.ConnectionError):
+        conversions.download_geoid("egm96", cache_dir=str(tmp_path))
+    # The partial download is removed
+    assert [f for f in os.listdir(tmp_path) if not f.endswith(".lock")] == []
+
+
+@responses.activate
+def test_convert_dem_to_wgs84_download_failure(tmp_path, monkeypatch, caplog):
+    url = conversions.EGM_URLS["egm96"]
+    responses.add(responses.GET, url, status=503)
+    monkeypatch.setattr(conversions.utils, "_gdal_installed_correctly", lambda: False)
+    dem = np.arange(12, dtype="int16").reshape(3, 4)
+    filename = _write_dem(tmp_path, dem, -156.0, 20.0, 0.1)
+
+    conversions.convert_dem_to_wgs84(filename, cache_dir=str(tmp_path))
+    # No GDAL to fall back on: the DEM is kept, with a warning
+    assert "keeping" in caplog.text
+    assert np.fromfile(filename, dtype="int16").tobytes() == dem.tobytes()
+    files = [f for f in os.listdir(tmp_path) if not f.endswith(".lock")]
+    assert sorted(files) == ["elevation.dem", "elevation.dem.rsc"]
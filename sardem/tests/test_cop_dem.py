@@ -2,9 +2,11 @@ import os
 import zipfile
 
 import numpy as np
+import pytest
 import rasterio as rio
+import responses
 
-from sardem import cop_dem
+from sardem import conversions, cop_dem
 from sardem.constants import DEFAULT_RES
 
 HALF_PIXEL = 0.5 * DEFAULT_RES
@@ -58,3 +60,209 @@ def test_main_cop(tmp_path):
 
     np.testing.assert_allclose(expected, output, atol=1.0)
     os.remove(temp_absolute_vrt)
+
+
+def _write_egm08_grid(directory):
+    """Synthetic 1 degree EGM2008 grid, varying linearly in lat/lon"""
+    lats = -90.0 + np.arange(181)
+    lons = -180.0 + np.arange(360)
+    grid = 0.5 * lats[:, np.newaxis] - 0.25 * lons[np.newaxis, :] + 20
+    header = np.array(
+        [(-90.0, -180.0, 1.0, 1.0, 181, 360)], dtype=conversions.GTX_HEADER
+    )
+    with open(os.path.join(directory, "egm08_25.gtx"), "wb") as f:
+        f.write(header.tobytes() + grid.astype(">f4").tobytes())
+
+
+def test_add_geoid_offset(tmp_path):
+    from osgeo import gdal
+
+    _write_egm08_grid(tmp_path)
+    dem = np.full((30, 40), 1000, dtype=np.float32)
+    dem[:5] = 0  # ocean
+    filename = str(tmp_path / "cop.tif")
+    ds = gdal.GetDriverByName("GTiff").Create(filename, 40, 30, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform([-156.0, DEFAULT_RES, 0, 20.0, 0, -DEFAULT_RES])
+    ds.GetRasterBand(1).WriteArray(dem)
+    ds = None
+
+    conversions.add_geoid_offset(filename, nodata=0, cache_dir=str(tmp_path))
+
+    ds = gdal.Open(filename)
+    output = ds.GetRasterBand(1).ReadAsArray()
+    ds = None
+    x = -156.0 + (np.arange(40) + 0.5) * DEFAULT_RES
+    y = 20.0 - (np.arange(30) + 0.5) * DEFAULT_RES
+    expected = 1000 + 0.5 * y[:, np.newaxis] - 0.25 * x[np.newaxis, :] + 20
+    expected[:5] = 0
+    np.testing.assert_allclose(output, expected, atol=1e-3)
+
+
+@pytest.mark.parametrize("output_type, atol", [("float32", 1e-3), ("int16", 0)])
+def test_pixel_copy_matches_warp(tmp_path, output_type, atol):
+    # The Translate + undulation path against the gdal.Warp from
+    # EPSG:4326+3855 to EPSG:4326, with PROJ using the same synthetic geoid.
+    # Both round integer outputs once, after adding the undulation.
+    from osgeo import gdal, osr
+
+    gdal.UseExceptions()
+    _write_egm08_grid(tmp_path)
+    rng = np.random.default_rng(0)
+    # Land heights which never round to the nodata value 0
+    dem = rng.uniform(1, 3000, size=(120, 150)).astype(np.float32)
+    dem[:20] = 0  # ocean
+    src = str(tmp_path / "cop_src.tif")
+    ds = gdal.GetDriverByName("GTiff").Create(src, 150, 120, 1, gdal.GDT_Float32)
+    # Pixel centers on multiples of the pixel size, as in the COP tiles
+    ds.SetGeoTransform(
+        [-156.0 - HALF_PIXEL, DEFAULT_RES, 0, 20.0 + HALF_PIXEL, 0, -DEFAULT_RES]
+    )
+    ds.SetProjection(osr.SRS_WKT_WGS84_LAT_LONG)
+    ds.GetRasterBand(1).WriteArray(dem)
+    ds = None
+    # Snapped to the pixel edges around source rows 0-100 and columns 10-108
+    bbox = (-156.0 + 10 * DEFAULT_RES, 20.0 - 100 * DEFAULT_RES, -155.97, 20.0)
+    window = dem[:101, 10:109]
+
+    outputs = []
+    search_paths = osr.GetPROJSearchPaths()
+    osr.SetPROJSearchPaths([str(tmp_path)] + list(search_paths))
+    gdal.SetConfigOption("PROJ_NETWORK", "OFF")
+    try:
+        # The PROJ warp last; the others add the undulation themselves, from
+        # the full grid or from the cached geoid tiles
+        for pixel_copy, cache_geoid in [
+            (True, False),
+            (True, True),
+            (False, True),
+            (False, False),
+        ]:
+            output = str(tmp_path / "out_{}_{}.tif".format(pixel_copy, cache_geoid))
+            cop_dem._download_single_bbox(
+                output,
+                bbox,
+                src,
+                False,
+                1,
+                1,
+                "GTiff",
+                output_type,
+                pixel_copy=pixel_copy,
+                cache_dir=str(tmp_path),
+                cache_geoid=cache_geoid,
+            )
+            ds = gdal.Open(output)
+            outputs.append((ds.GetGeoTransform(), ds.GetRasterBand(1).ReadAsArray()))
+            ds = None
+    finally:
+        osr.SetPROJSearchPaths(search_paths)
+        gdal.SetConfigOption("PROJ_NETWORK", None)
+
+    assert os.path.isdir(tmp_path / "geoid" / "egm08")
+    gt_warp, out_warp = outputs[-1]
+    assert out_warp.shape == window.shape
+    # The undulation is about 69 m here: PROJ must have used the synthetic grid
+    assert np.abs(out_warp[20:] - window[20:]).min() > 50
+    assert np.all(out_warp[:20] == 0)
+    for gt_copy, out_copy in outputs[:-1]:
+        np.testing.assert_allclose(gt_copy, gt_warp)
+        assert out_copy.shape == out_warp.shape
+        # Ocean stays 0 (nodata), without the undulation
+        assert np.all(out_copy[:20] == 0)
+        np.testing.assert_array_equal(out_copy == 0, out_warp == 0)
+        np.testing.assert_allclose(out_copy, out_warp, atol=atol)
+
+
+def test_bbox_tiles():
+    # Big Island of Hawaii; the tile edges are half a pixel north of the degree
+    assert cop_dem.bbox_tiles([-156.0, 19.0, -155.0, 20.0]) == [
+        (18, -156),
+        (19, -156),
+        (19, -155),
+    ]
+    assert cop_dem.bbox_tiles([-140.5, 30.1, -140.2, 30.4]) == []  # Pacific Ocean
+
+
+def test_make_bbox_vrts():
+    bbox = [-155.8, 19.2, -155.6, 19.4]
+    vrts = cop_dem.make_bbox_vrts(bbox, margin=0)
+    assert list(vrts) == ["cop_global.vrt", "cop_NW.vrt", "N10_W160.vrt"]
+    assert vrts["N10_W160.vrt"].count("<SimpleSource>") == 1
+    assert cop_dem.cop_tile_name(19, -156) in vrts["N10_W160.vrt"]
+
+    # Same size, georeferencing and source rectangles as the bundled tree
+    with open(os.path.join(cop_dem.DATA_DIR, "cop_global.vrt")) as f:
+        global_header = f.read().split("<VRTRasterBand")[0]
+    assert vrts["cop_global.vrt"].startswith(global_header)
+    with open(os.path.join(cop_dem.DATA_DIR, "N10_W160.vrt")) as f:
+        assert '<DstRect xOff="14400" yOff="0" xSize="3600" ySize="3600" />' in f.read()
+    assert '<DstRect xOff="14400" yOff="0" xSize="3600" ySize="3600" />' in (
+        vrts["N10_W160.vrt"]
+    )
+
+
+def test_bbox_vrt_matches_global(tmp_path):
+    bbox = [
+        -156.0 - HALF_PIXEL,
+        19.0 + HALF_PIXEL,
+        -155.0 - HALF_PIXEL,
+        20.0 + HALF_PIXEL,
+    ]
+    tile = "/vsizip/{}/cop_tile_hawaii.dem.zip/cop_tile_hawaii.dem".format(DATA_PATH)
+    for name, xml in cop_dem.make_bbox_vrts(
+        bbox, tile_filename=lambda lat, lon: tile, margin=0
+    ).items():
+        (tmp_path / name).write_text(xml)
+
+    temp_absolute_vrt = _write_absolute_vrt()
+    outputs = []
+    for vrt_filename in [
+        os.path.join(DATA_PATH, "cop_global.vrt"),
+        str(tmp_path / "cop_global.vrt"),
+    ]:
+        output_name = str(tmp_path / "output.tif")
+        cop_dem.download_and_stitch(
+            output_name,
+            bbox,
+            keep_egm=True,
+            output_type="int16",
+            vrt_filename=vrt_filename,
+        )
+        with rio.open(output_name) as src:
+            outputs.append(src.read(1))
+    os.remove(temp_absolute_vrt)
+    np.testing.assert_array_equal(outputs[0], outputs[1])
+
+
+@responses.activate
+def test_cache_cop_tiles(tmp_path):
+    bbox = [-155.8, 19.2, -155.6, 19.4]
+    name = cop_dem.cop_tile_name(19, -156)
+    url = cop_dem.URL_TEMPLATE.format(t=name)
+    responses.add(responses.GET, url, body=b"tile")
+
+    tile_filename = cop_dem.cache_cop_tiles(bbox, cache_dir=str(tmp_path))
+    cached = str(tmp_path / "cop" / (name + ".tif"))
+    assert tile_filename(19, -156) == cached
+    with open(cached, "rb") as f:
+        assert f.read() == b"tile"
+    # Tiles which aren't cached are read remotely
+    assert tile_filename(20, -156) == "/vsicurl/" + cop_dem.URL_TEMPLATE.format(
+        t=cop_dem.cop_tile_name(20, -156)
+    )
+    assert cached in cop_dem.make_bbox_vrts(bbox, tile_filename)["N10_W160.vrt"]
+
+    # The next run reuses the tile
+    cop_dem.cache_cop_tiles(bbox, cache_dir=str(tmp_path))
+    assert len(responses.calls) == 1
+    assert os.listdir(tmp_path / "cop") == [name + ".tif"]
+
+
+@responses.activate
+def test_cache_cop_tiles_failure(tmp_path):
+    bbox = [-155.8, 19.2, -155.6, 19.4]
+    url = cop_dem.URL_TEMPLATE.format(t=cop_dem.cop_tile_name(19, -156))
+    responses.add(responses.GET, url, status=404)
+
+    tile_filename = cop_dem.cache_cop_tiles(bbox, cache_dir=str(tmp_path))
+    assert tile_filename(19, -156) == "/vsicurl/" + url
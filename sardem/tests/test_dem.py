@@ -1,12 +1,16 @@
+import io
 import os
 import shutil
 import tempfile
 import unittest
+import zipfile
 from os.path import dirname, join
 
 import numpy as np
+import pytest
 import responses
 
+import sardem.loading
 from sardem import dem, download, utils
 
 
@@ -67,6 +71,42 @@ SRTMGL1.003/2000.02.11/N19W156.SRTMGL1.hgt.zip"
         self.assertTrue(os.path.exists(d._filepath(self.test_tile)))
 
 
+def _make_hgt_zip(tile_name, data):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(tile_name + ".hgt", data.astype(">i2").tobytes())
+    return buf.getvalue()
+
+
+@responses.activate
+def test_download_unzips_in_process(tmp_path):
+    tile_name = "N19W156"
+    data = np.arange(1201 * 1201, dtype=np.int16).reshape(1201, 1201)
+    d = download.Downloader([tile_name], netrc_file=NETRC_PATH, cache_dir=str(tmp_path))
+    responses.add(
+        responses.GET,
+        d._form_tile_url(tile_name),
+        body=_make_hgt_zip(tile_name, data),
+        status=200,
+    )
+    (local_filename,) = d.download_all()
+
+    assert local_filename == d._filepath(tile_name)
+    assert os.listdir(tmp_path) == [tile_name + ".hgt"]
+    np.testing.assert_array_equal(
+        np.fromfile(local_filename, dtype=">i2").reshape(data.shape), data
+    )
+
+
+def test_unzip_missing_member(tmp_path):
+    zip_filename = str(tmp_path / "N19W156.hgt.zip")
+    with zipfile.ZipFile(zip_filename, "w") as zf:
+        zf.writestr("README.txt", "no tile here")
+    d = download.Downloader(["N19W156"], netrc_file=NETRC_PATH, cache_dir=str(tmp_path))
+    with pytest.raises(ValueError, match="N19W156.hgt.zip"):
+        d._unzip_file(zip_filename, str(tmp_path / "N19W156.hgt"))
+
+
 class TestBounds:
     coords = [
         [-156.0, 18.7],
@@ -103,3 +143,373 @@ def test_main_srtm(tmp_path, srtm_tile_path, srtm_tile, srtm_tile_bbox):
     )
     output = np.fromfile(tmp_output, dtype=np.int16).reshape(3600, 3600)
     np.testing.assert_allclose(srtm_tile[:-1, :-1], output, atol=1)
+
+
+def test_main_srtm_upsampled(tmp_path, monkeypatch):
+    # Cropping and upsampling happen in one pass, with no temporary files
+    monkeypatch.chdir(tmp_path)
+    rows, cols = np.mgrid[:3601, :3601]
+    tile = (cols + 2 * rows).astype(">i2")
+    tile.tofile(tmp_path / "N19W156.hgt")
+    step = 1 / 3600
+    left, top = -156 + 9.5 * step, 20 - 9.5 * step
+    bbox = (left, top - 100 * step, left + 100 * step, top)
+
+    dem.main(
+        output_name="output.dem",
+        bbox=bbox,
+        xrate=2,
+        yrate=2,
+        keep_egm=True,
+        data_source="NASA",
+        output_type="float32",
+        output_format="ENVI",
+        cache_dir=str(tmp_path),
+    )
+    assert sorted(os.listdir(tmp_path)) == [
+        "N19W156.hgt",
+        "output.dem",
+        "output.dem.rsc",
+    ]
+    rsc_dict = sardem.loading.load_dem_rsc("output.dem.rsc")
+    assert (rsc_dict["file_length"], rsc_dict["width"]) == (200, 200)
+    np.testing.assert_allclose(rsc_dict["x_step"], step / 2)
+    np.testing.assert_allclose(rsc_dict["y_step"], -step / 2)
+
+    output = np.fromfile("output.dem", dtype=np.float32).reshape(200, 200)
+    # Output pixel centers are a quarter source pixel in from the bbox edges
+    src_coords = 9.75 + np.arange(200) / 2
+    expected = src_coords[np.newaxis, :] + 2 * src_coords[:, np.newaxis]
+    np.testing.assert_allclose(output, expected, atol=1e-3)
+
+
+def test_main_srtm_target_shape(tmp_path, monkeypatch):
+    # A grid which isn't a multiple of the SRTM grid, in one resampling pass
+    monkeypatch.chdir(tmp_path)
+    rows, cols = np.mgrid[:3601, :3601]
+    (cols + 2 * rows).astype(">i2").tofile(tmp_path / "N19W156.hgt")
+    step = 1 / 3600
+    left, top = -156 + 9.5 * step, 20 - 9.5 * step
+    bbox = (left, top - 100 * step, left + 100 * step, top)
+
+    dem.main(
+        output_name="output.dem",
+        bbox=bbox,
+        target_shape=(130, 70),
+        keep_egm=True,
+        data_source="NASA",
+        output_type="float32",
+        output_format="ENVI",
+        cache_dir=str(tmp_path),
+    )
+    rsc_dict = sardem.loading.load_dem_rsc("output.dem.rsc")
+    assert (rsc_dict["file_length"], rsc_dict["width"]) == (130, 70)
+    np.testing.assert_allclose(rsc_dict["x_step"], 100 * step / 70)
+    np.testing.assert_allclose(rsc_dict["y_step"], -100 * step / 130)
+
+    output = np.fromfile("output.dem", dtype=np.float32).reshape(130, 70)
+    x = 9.5 + (np.arange(70) + 0.5) * 100 / 70
+    y = 9.5 + (np.arange(130) + 0.5) * 100 / 130
+    expected = x[np.newaxis, :] + 2 * y[:, np.newaxis]
+    np.testing.assert_allclose(output, expected, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        dem.main(output_name="x.dem", bbox=bbox, xrate=2, target_shape=(130, 70))
+
+
+def test_main_cop_target_shape_rates(monkeypatch):
+    # GDAL warps over the bbox snapped outward to the COP pixel edges, so the
+    # rates must come from those bounds, not from the requested bbox
+    from sardem import cop_dem
+
+    calls = []
+    monkeypatch.setattr(utils, "_gdal_installed_correctly", lambda: True)
+    monkeypatch.setattr(
+        cop_dem, "download_and_stitch", lambda *args, **kwargs: calls.append(kwargs)
+    )
+    dem.main(
+        output_name="x.tif",
+        bbox=(0, 0, 1, 1),
+        target_shape=(3601, 3601),
+        data_source="COP",
+        pixel_copy=True,
+        cache_geoid=True,
+    )
+    assert calls[0]["target_shape"] == (3601, 3601)
+    assert calls[0]["pixel_copy"] and calls[0]["cache_geoid"]
+    # 1 + 1/3600 degrees at 1/3600 degrees per pixel: 3601 pixels, a rate of 1
+    np.testing.assert_allclose((calls[0]["xrate"], calls[0]["yrate"]), (1, 1))
+
+
+def test_main_srtm_looks(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rows, cols = np.mgrid[:3601, :3601]
+    tile = (cols + 2 * rows).astype(">i2")
+    # 0 is a real height (sea level, e.g. on a coastline): it is averaged
+    tile[10, 10] = 0
+    # Voids are left out of the averages, and all-void looks are set to 0
+    tile[10, 14] = -32768
+    tile[15:20, 14:18] = -32768
+    tile.tofile(tmp_path / "N19W156.hgt")
+    step = 1 / 3600
+    left, top = -156 + 9.5 * step, 20 - 9.5 * step
+    bbox = (left, top - 100 * step, left + 100 * step, top)
+
+    dem.main(
+        output_name="output.dem",
+        bbox=bbox,
+        xlooks=4,
+        ylooks=5,
+        keep_egm=True,
+        data_source="NASA",
+        output_type="float32",
+        output_format="ENVI",
+        cache_dir=str(tmp_path),
+    )
+    rsc_dict = sardem.loading.load_dem_rsc("output.dem.rsc")
+    assert (rsc_dict["file_length"], rsc_dict["width"]) == (20, 25)
+    np.testing.assert_allclose(rsc_dict["x_step"], 4 * step)
+    np.testing.assert_allclose(rsc_dict["y_step"], -5 * step)
+    np.testing.assert_allclose(rsc_dict["x_first"], left)
+
+    output = np.fromfile("output.dem", dtype=np.float32).reshape(20, 25)
+    # The mean of the ramp over each block is its value at the block center
+    x = 10 + 1.5 + 4 * np.arange(25)
+    y = 10 + 2 + 5 * np.arange(20)
+    expected = x[np.newaxis, :] + 2 * y[:, np.newaxis]
+    expected[0, 0] = (expected[0, 0] * 20 - 30) / 20
+    expected[0, 1] = (expected[0, 1] * 20 - (14 + 2 * 10)) / 19
+    expected[1, 1] = 0
+    np.testing.assert_allclose(output, expected, atol=1e-3)
+
+
+def test_main_srtm_cache_geoid(tmp_path, monkeypatch):
+    from sardem import conversions
+
+    monkeypatch.chdir(tmp_path)
+    rows, cols = np.mgrid[:3601, :3601]
+    (cols + 2 * rows).astype(">i2").tofile(tmp_path / "N19W156.hgt")
+    # Synthetic 1 degree EGM96 grid, varying linearly in lat/lon
+    lats = -90.0 + np.arange(181)
+    lons = -180.0 + np.arange(360)
+    grid = 0.5 * lats[:, np.newaxis] - 0.25 * lons[np.newaxis, :] + 20
+    header = np.array(
+        [(-90.0, -180.0, 1.0, 1.0, 181, 360)], dtype=conversions.GTX_HEADER
+    )
+    gtx_file = tmp_path / "egm96_15.gtx"
+    gtx_file.write_bytes(header.tobytes() + grid.astype(">f4").tobytes())
+    step = 1 / 3600
+    left, top = -156 + 9.5 * step, 20 - 9.5 * step
+    bbox = (left, top - 100 * step, left + 100 * step, top)
+    kwargs = dict(
+        output_name="output.dem",
+        bbox=bbox,
+        data_source="NASA",
+        output_type="float32",
+        output_format="ENVI",
+        cache_dir=str(tmp_path),
+        cache_geoid=True,
+    )
+
+    dem.main(**kwargs)
+    output = np.fromfile("output.dem", dtype=np.float32).reshape(100, 100)
+    src = 10.0 + np.arange(100)
+    x = left + (np.arange(100) + 0.5) * step
+    y = top - (np.arange(100) + 0.5) * step
+    expected = src[np.newaxis, :] + 2 * src[:, np.newaxis]
+    expected += 0.5 * y[:, np.newaxis] - 0.25 * x[np.newaxis, :] + 20
+    np.testing.assert_allclose(output, expected, atol=1e-3)
+    assert os.listdir(tmp_path / "geoid" / "egm96") == ["N19W156.npz"]
+
+    # The next run only needs the saved geoid tile
+    os.remove(gtx_file)
+    conversions._load_geoid_tile.cache_clear()
+    dem.main(**kwargs)
+    output = np.fromfile("output.dem", dtype=np.float32).reshape(100, 100)
+    np.testing.assert_allclose(output, expected, atol=1e-3)
+
+
+def _write_hgt_tiles(tmp_path, tile_names, num_pixels=1201, seed=0):
+    rng = np.random.default_rng(seed)
+    tiles, filenames = [], []
+    for name in tile_names:
+        tile = rng.integers(0, 4000, size=(num_pixels, num_pixels)).astype(">i2")
+        filename = str(tmp_path / (name + ".hgt"))
+        tile.tofile(filename)
+        tiles.append(tile.astype(np.int16))
+        filenames.append(filename)
+    return tiles, filenames
+
+
+def test_stitcher_load_and_stitch(tmp_path):
+    tile_names = ["N19W156", "N19W155", "N18W156", "N18W155"]
+    tiles, filenames = _write_hgt_tiles(tmp_path, tile_names)
+    # Drop one tile to check that missing tiles are filled with zeros
+    filenames[3] = None
+    tiles[3] = np.zeros_like(tiles[3])
+
+    s = dem.Stitcher(tile_names, filenames=filenames, num_pixels=1201)
+    stitched = s.load_and_stitch()
+    assert stitched.shape == s.shape == (2401, 2401)
+    assert stitched.dtype == np.int16
+
+    # Later tiles drop their first row/column, which overlaps the earlier tile
+    top = np.hstack([tiles[0], tiles[1][:, 1:]])
+    bottom = np.hstack([tiles[2], tiles[3][:, 1:]])[1:]
+    expected = np.vstack([top, bottom])
+    np.testing.assert_array_equal(stitched, expected)
+
+
+def test_stitcher_missing_file(tmp_path):
+    # A tile which was downloaded, then removed (e.g. evicted by another job)
+    tile_names = ["N19W156", "N19W155"]
+    _, filenames = _write_hgt_tiles(tmp_path, tile_names)
+    os.remove(filenames[1])
+    s = dem.Stitcher(tile_names, filenames=filenames, num_pixels=1201)
+    with pytest.raises(IOError, match="N19W155"):
+        s.load_and_stitch()
+
+
+def test_stitcher_read_window(tmp_path):
+    tile_names = ["N19W156", "N19W155", "N18W156", "N18W155"]
+    _, filenames = _write_hgt_tiles(tmp_path, tile_names)
+    s = dem.Stitcher(tile_names, filenames=filenames, num_pixels=1201)
+    full = s.load_and_stitch()
+    # Windows inside one tile, and crossing the tile seams
+    for rows, cols in [((5, 20), (7, 30)), ((1190, 1210), (1195, 1300))]:
+        window = s.read_window(rows, cols)
+        np.testing.assert_array_equal(window, full[slice(*rows), slice(*cols)])
+
+
+@responses.activate(registry=responses.registries.OrderedRegistry)
+def test_download_retries_server_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(download, "BACKOFF_FACTOR", 0)
+    tile_name = "N19W156"
+    data = np.ones((1201, 1201), dtype=np.int16)
+    d = download.Downloader([tile_name], netrc_file=NETRC_PATH, cache_dir=str(tmp_path))
+    url = d._form_tile_url(tile_name)
+    responses.add(responses.GET, url, status=503)
+    responses.add(responses.GET, url, status=502)
+    responses.add(responses.GET, url, body=_make_hgt_zip(tile_name, data), status=200)
+
+    (local_filename,) = d.download_all()
+    assert len(responses.calls) == 3
+    assert os.path.exists(local_filename)
+    # All workers share one session
+    assert d._get_session() is d._get_session()
+
+
+@responses.activate
+def test_download_resumes_partial_file(tmp_path):
+    tile_name = "N19W156"
+    data = np.arange(1201 * 1201, dtype=np.int16).reshape(1201, 1201)
+    zip_bytes = _make_hgt_zip(tile_name, data)
+    d = download.Downloader([tile_name], netrc_file=NETRC_PATH, cache_dir=str(tmp_path))
+    url = d._form_tile_url(tile_name)
+
+    # Simulate an earlier run which was interrupted partway through
+    zip_filename = d._filepath(tile_name) + ".zip"
+    offset = len(zip_bytes) // 3
+    with open(zip_filename + ".part", "wb") as f:
+        f.write(zip_bytes[:offset])
+
+    responses.add(
+        responses.GET,
+        url,
+        body=zip_bytes[offset:],
+        status=206,
+        match=[responses.matchers.header_matcher({"Range": "bytes={}-".format(offset)})],
+    )
+    (local_filename,) = d.download_all()
+
+    assert os.listdir(tmp_path) == [tile_name + ".hgt"]
+    np.testing.assert_array_equal(
+        np.fromfile(local_filename, dtype=">i2").reshape(data.shape), data
+    )
+
+
+@responses.activate
+def test_download_missing_tile(tmp_path):
+    tile_names = ["N19W156", "N19W155"]
+    data = np.ones((1201, 1201), dtype=np.int16)
+    d = download.Downloader(tile_names, netrc_file=NETRC_PATH, cache_dir=str(tmp_path))
+    url = d._form_tile_url(tile_names[0])
+    responses.add(responses.GET, url, body=_make_hgt_zip(tile_names[0], data))
+    responses.add(responses.GET, d._form_tile_url(tile_names[1]), status=404)
+
+    local_filenames = d.download_all()
+    # The missing tile is zeros when stitching, but nothing is saved for it,
+    # and no partial or empty .zip files are left behind
+    assert local_filenames == [d._filepath("N19W156"), None]
+    files = [f for f in os.listdir(tmp_path) if not f.endswith(".lock")]
+    assert files == ["N19W156.hgt"]
+
+
+@responses.activate
+def test_download_skips_nonexistent_tiles(tmp_path):
+    # N18W157 is open ocean, so no request should be made for it
+    tile_names = ["N18W157", "N19W156"]
+    data = np.ones((1201, 1201), dtype=np.int16)
+    d = download.Downloader(tile_names, netrc_file=NETRC_PATH, cache_dir=str(tmp_path))
+    responses.add(
+        responses.GET,
+        d._form_tile_url("N19W156"),
+        body=_make_hgt_zip("N19W156", data),
+    )
+    local_filenames = d.download_all()
+
+    assert local_filenames == [None, d._filepath("N19W156")]
+    assert len(responses.calls) == 1
+    assert os.listdir(tmp_path) == ["N19W156.hgt"]
+
+    d = download.Downloader(["N18W157"], netrc_file=NETRC_PATH, cache_dir=str(tmp_path))
+    with pytest.raises(ValueError):
+        d.download_all()
+
+
+def _download_tile(cache_dir, base_url, tile_name):
+    d = download.Downloader([tile_name], netrc_file=NETRC_PATH, cache_dir=cache_dir)
+    d.data_url = base_url
+    return d.download_and_save(tile_name)
+
+
+def test_download_locking_across_processes(tmp_path):
+    import multiprocessing
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    tile_name = "N19W156"
+    data = np.arange(1201 * 1201, dtype=np.int16).reshape(1201, 1201)
+    zip_bytes = _make_hgt_zip(tile_name, data)
+    requests_seen = []
+
+    class SlowTileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+            # Give the other processes time to pile up on the lock
+            time.sleep(0.5)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(zip_bytes)))
+            self.end_headers()
+            self.wfile.write(zip_bytes)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowTileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+    try:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(4) as pool:
+            args = [(str(tmp_path), base_url, tile_name)] * 4
+            results = pool.starmap(_download_tile, args)
+    finally:
+        server.shutdown()
+
+    assert len(requests_seen) == 1
+    assert len(set(results)) == 1
+    np.testing.assert_array_equal(
+        np.fromfile(results[0], dtype=">i2").reshape(data.shape), data
+    )
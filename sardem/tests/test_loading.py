@@ -38,3 +38,21 @@ class TestRsc(unittest.TestCase):
         zip_ref.close()
         hgt_file = join(self.extract_path, 'N19W156.hgt')
         loading.load_elevation(hgt_file)
+
+
+def test_memmap_elevation(tmp_path):
+    import numpy as np
+
+    data = np.arange(1201 * 1201).reshape(1201, 1201) % 3000
+    data[0, 0] = -32768
+    hgt_file = str(tmp_path / 'N19W156.hgt')
+    data.astype('>i2').tofile(hgt_file)
+
+    mm = loading.memmap_elevation(hgt_file)
+    assert mm.shape == (1201, 1201)
+    assert not mm.flags.writeable
+
+    window = loading.fix_elevation(mm[:10, 5:20])
+    assert window.dtype == np.int16
+    np.testing.assert_array_equal(window, data[:10, 5:20].clip(0, None))
+    np.testing.assert_array_equal(loading.load_elevation(hgt_file), data.clip(0, None))
@@ -0,0 +1,89 @@
+import io
+import json
+import logging
+import os
+import zipfile
+from os.path import dirname, join
+
+import numpy as np
+import responses
+
+from sardem import cache, download, prefetch
+
+NETRC_PATH = join(dirname(__file__), "data", "netrc")
+
+
+def test_aoi_file_bboxes(tmp_path):
+    aoi_file = tmp_path / "aois.geojson"
+    polygon = [[[-156.0, 18.7], [-154.6, 18.7], [-154.6, 20.3], [-156.0, 18.7]]]
+    multi = [[[[-120.0, 34.0], [-119.0, 34.0], [-119.0, 35.5], [-120.0, 34.0]]]]
+    features = [
+        {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": polygon}},
+        {"type": "Feature", "geometry": {"type": "MultiPolygon", "coordinates": multi}},
+    ]
+    aoi_file.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+
+    assert prefetch.aoi_file_bboxes(str(aoi_file)) == [
+        (-156.0, 18.7, -154.6, 20.3),
+        (-120.0, 34.0, -119.0, 35.5),
+    ]
+
+
+def test_tile_names_deduplicated():
+    bboxes = [(-156.0, 19.0, -154.0, 20.0), (-155.0, 19.0, -154.0, 21.0)]
+    assert prefetch.tile_names_for_bboxes(bboxes) == [
+        "N19W156",
+        "N19W155",
+        "N20W155",
+    ]
+
+
+@responses.activate
+def test_prefetch(tmp_path):
+    d = download.Downloader([], netrc_file=NETRC_PATH, cache_dir=str(tmp_path))
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("N19W155.hgt", np.zeros(1201 * 1201, dtype=">i2").tobytes())
+    body = buf.getvalue()
+    responses.add(responses.GET, d._form_tile_url("N19W155"), body=body)
+    # Already cached, so never requested
+    np.zeros(10, dtype=np.int16).tofile(d._filepath("N19W156"))
+
+    # N18W157 is open ocean, with no SRTM tile
+    bboxes = [(-156.0, 19.0, -154.0, 20.0), (-157.0, 18.0, -156.0, 19.0)]
+    result = prefetch.prefetch(bboxes, cache_dir=str(tmp_path), netrc_file=NETRC_PATH)
+
+    assert len(responses.calls) == 1
+    assert result["tiles"] == 3
+    assert result["nonexistent"] == 1
+    assert result["cached"] == 1
+    assert result["downloaded"] == 1
+    assert result["bytes"] == len(body)
+    assert os.path.exists(d._filepath("N19W155"))
+
+
+@responses.activate
+def test_prefetch_keeps_campaign_tiles(tmp_path, monkeypatch, caplog):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setenv(cache.MAX_SIZE_ENV, "1K")
+    # Only the `keep` list protects files from the prune here
+    monkeypatch.setattr(cache, "RECENT_USE_SECONDS", 0)
+    d = download.Downloader([], netrc_file=NETRC_PATH)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        # Bigger than the whole budget
+        zf.writestr("N19W155.hgt", np.zeros(600, dtype=">i2").tobytes())
+    responses.add(responses.GET, d._form_tile_url("N19W155"), body=buf.getvalue())
+    np.zeros(10, dtype=np.int16).tofile(d._filepath("N19W156"))
+    other = d._filepath("N40W120")
+    np.zeros(10, dtype=np.int16).tofile(other)
+
+    bboxes = [(-156.0, 19.0, -154.0, 20.0)]
+    with caplog.at_level(logging.WARNING, logger="sardem"):
+        prefetch.prefetch(bboxes, netrc_file=NETRC_PATH)
+
+    assert "more than the 1.0K cache budget" in caplog.text
+    # Tiles from other campaigns are evicted, this campaign's are all kept
+    assert not os.path.exists(other)
+    assert os.path.exists(d._filepath("N19W156"))
+    assert os.path.exists(d._filepath("N19W155"))
@@ -0,0 +1,161 @@
+import os
+import re
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from sardem import remote_io
+
+
+@pytest.fixture(autouse=True)
+def reset_profile(monkeypatch):
+    monkeypatch.setattr(remote_io, "_profile", None)
+    monkeypatch.delenv(remote_io.PROFILE_ENV, raising=False)
+
+
+def test_presets():
+    options, overrides = remote_io.get_profile()
+    assert options == remote_io.PRESETS[remote_io.DEFAULT_PRESET]
+    assert overrides == {}
+    assert options["GDAL_HTTP_MULTIPLEX"] == "YES"
+    # The HTTP version is left to GDAL and the server
+    assert "GDAL_HTTP_VERSION" not in options
+    assert remote_io.set_profile("gdal") == ({}, {})
+    with pytest.raises(ValueError):
+        remote_io.set_profile("fast")
+
+
+def test_profile_from_env(monkeypatch):
+    monkeypatch.setenv(remote_io.PROFILE_ENV, "http1")
+    options, _ = remote_io.get_profile()
+    assert options["GDAL_HTTP_VERSION"] == "1.1"
+
+
+def test_resolve_options():
+    remote_io.set_profile(
+        "tuned",
+        remote_io.parse_overrides(
+            ["GDAL_HTTP_MAX_RETRY=10", "VSI_CACHE=", "GDAL_HTTP_TIMEOUT=30"]
+        ),
+    )
+    # Options the user already set are kept, unless overridden explicitly
+    user_options = {"VSI_CACHE_SIZE": "1000", "GDAL_HTTP_TIMEOUT": "5"}
+    options = remote_io.resolve_options(user_options.get)
+    assert "VSI_CACHE_SIZE" not in options
+    assert options["GDAL_HTTP_TIMEOUT"] == "30"
+    assert options["GDAL_HTTP_MAX_RETRY"] == "10"
+    assert "VSI_CACHE" not in options
+    assert options["GDAL_HTTP_MERGE_CONSECUTIVE_RANGES"] == "YES"
+
+
+def test_builtin_only_options():
+    # A user's VRT may point to files of any extension
+    options = remote_io.resolve_options(lambda key: None)
+    assert "CPL_VSIL_CURL_ALLOWED_EXTENSIONS" not in options
+    options = remote_io.resolve_options(lambda key: None, builtin=True)
+    assert options["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"] == ".tif,.tiff,.vrt"
+    # Unless the user asks for it
+    remote_io.set_profile("tuned", {"CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif"})
+    options = remote_io.resolve_options(lambda key: None)
+    assert options["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"] == ".tif"
+
+
+def test_parse_overrides():
+    with pytest.raises(ValueError):
+        remote_io.parse_overrides(["VSI_CACHE"])
+
+
+def test_gdal_config_restores():
+    gdal = pytest.importorskip("osgeo.gdal")
+    gdal.SetConfigOption("VSI_CACHE_SIZE", "1000")
+    try:
+        with remote_io.gdal_config(GDAL_HTTP_AUTH="BASIC") as options:
+            assert gdal.GetConfigOption("GDAL_HTTP_MULTIPLEX") == "YES"
+            assert gdal.GetConfigOption("GDAL_HTTP_AUTH") == "BASIC"
+            assert gdal.GetConfigOption("VSI_CACHE_SIZE") == "1000"
+            assert "VSI_CACHE_SIZE" not in options
+        assert gdal.GetConfigOption("GDAL_HTTP_MULTIPLEX") is None
+        assert gdal.GetConfigOption("GDAL_HTTP_AUTH") is None
+        assert gdal.GetConfigOption("VSI_CACHE_SIZE") == "1000"
+    finally:
+        gdal.SetConfigOption("VSI_CACHE_SIZE", None)
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """Serves files with single "bytes=start-end" ranges, logging each request"""
+
+    requests = []
+
+    def send_head(self):
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        self.requests.append((self.command, self.path, self.headers.get("Range")))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, "_remaining", None)
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        outputfile.write(source.read(remaining))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def range_server(tmp_path):
+    handler = partial(RangeHandler, directory=str(tmp_path))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("preset", ["gdal", "tuned"])
+def test_remote_read(tmp_path, range_server, preset):
+    gdal = pytest.importorskip("osgeo.gdal")
+    gdal.UseExceptions()
+    data = np.arange(512 * 512, dtype=np.float32).reshape(512, 512)
+    # A fresh name for each preset, so nothing comes from GDAL's /vsicurl/ cache
+    name = "tile_{}.tif".format(preset)
+    ds = gdal.GetDriverByName("GTiff").Create(
+        str(tmp_path / name),
+        512,
+        512,
+        1,
+        gdal.GDT_Float32,
+        options=["TILED=YES", "BLOCKXSIZE=128", "BLOCKYSIZE=128"],
+    )
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+
+    RangeHandler.requests = []
+    remote_io.set_profile(preset)
+    url = "/vsicurl/{}/{}".format(range_server, name)
+    with remote_io.gdal_config(builtin=True):
+        ds = gdal.Open(url)
+        out = ds.GetRasterBand(1).ReadAsArray()
+        ds = None
+    np.testing.assert_array_equal(out, data)
+
+    paths = [path for _, path, _ in RangeHandler.requests]
+    if preset == "tuned":
+        # Only the tile itself: no directory listing, no sidecar files
+        assert all(p == "/" + name for p in paths), paths
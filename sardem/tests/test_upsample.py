@@ -25,6 +25,31 @@ def test_upsample(tmp_path):
     assert_allclose(d_up2, d_up.round().astype(dtype))
 
 
+@pytest.mark.parametrize("method", upsample.RESAMPLE_METHODS)
+@pytest.mark.parametrize("dtype", ["int16", "float32"])
+def test_upsample_by_blocks_seam_free(tmp_path, dtype, method):
+    rng = np.random.default_rng(2)
+    a = rng.integers(-100, 3000, size=(53, 41)).astype(dtype)
+    infile = tmp_path / "in.dem"
+    a.tofile(infile)
+    outfile = tmp_path / "out.dem"
+    upsample.upsample_by_blocks(
+        infile,
+        outfile,
+        a.shape,
+        4,
+        dtype,
+        xrate=3,
+        yrate=2,
+        num_threads=4,
+        method=method,
+    )
+    # Identical to upsampling the whole array at once
+    expected = upsample.upsample(a, 3, 2, dtype=dtype, method=method)
+    out = np.fromfile(outfile, dtype=dtype).reshape(expected.shape)
+    assert out.tobytes() == expected.tobytes()
+
+
 def test_resample():
     a = np.arange(16).reshape(4, 4).astype("float32")
     expected = np.array([[2.5, 3.5, 4.5], [6.5, 7.5, 8.5], [10.5, 11.5, 12.5]])
@@ -115,3 +140,288 @@ Z_SCALE       1
 PROJECTION    LL
 """
     assert expected == up_rsc
+
+
+def test_resample_by_blocks(tmp_path):
+    rng = np.random.default_rng(1)
+    a = rng.integers(-100, 3000, size=(301, 401)).astype("int16")
+    step = 1 / 300
+    rsc_dict = {"x_first": -156.0, "x_step": step, "y_first": 20.0, "y_step": -step}
+    # Not aligned with the source pixels, and clipping the array edges
+    bbox = (-155.91234, 19.1234, -154.70001, 19.98765)
+    expected = upsample.resample(a, rsc_dict, bbox).astype("float32")
+
+    def read_window(rows, cols):
+        return a[slice(*rows), slice(*cols)]
+
+    outfile = tmp_path / "out.dem"
+    out_shape = upsample.resample_by_blocks(
+        read_window, a.shape, rsc_dict, bbox, outfile, "float32", block_rows=7
+    )
+    assert out_shape == expected.shape == upsample.resample_shape(a.shape, rsc_dict, bbox)
+    out = np.fromfile(outfile, dtype="float32").reshape(out_shape)
+    assert out.tobytes() == expected.tobytes()
+
+
+def test_separable_bilinear():
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=(37, 53))
+    # Includes coordinates past the array edges, which are clipped
+    xi = np.linspace(-0.3, 53.2, 151)
+    yi = np.linspace(0, 36, 100)
+    expected = upsample.bilinear_interpolate(a, xi.reshape(1, -1), yi.reshape(-1, 1))
+    out = upsample.separable_bilinear(a, xi, yi, block_pixels=1000)
+    assert_allclose(out, expected, rtol=1e-12, atol=1e-12)
+
+
+def test_separable_bilinear_float32():
+    rng = np.random.default_rng(0)
+    a = rng.integers(-400, 8849, size=(120, 130)).astype("int16")
+    xi = np.linspace(0, 129, 391)
+    yi = np.linspace(0, 119, 361)
+    expected = upsample.bilinear_interpolate(
+        a.astype(float), xi.reshape(1, -1), yi.reshape(-1, 1)
+    )
+    # float64 unless asked for a smaller output
+    assert upsample.separable_bilinear(a, xi, yi).dtype == np.float64
+    assert upsample.upsample(a, 2, 2).dtype == np.float64
+    out = upsample.separable_bilinear(
+        a, xi, yi, out=np.empty((len(yi), len(xi)), dtype="float32")
+    )
+    # The documented error bound against the float64 reference
+    assert np.abs(out - expected).max() < 1e-6 * np.abs(a).max()
+
+    out_int = np.empty(out.shape, dtype="int16")
+    upsample.separable_bilinear(a, xi, yi, out=out_int)
+    assert np.abs(out_int - np.round(expected)).max() <= 1
+
+
+def test_resample_aligned_is_view():
+    a = np.arange(100, dtype="int16").reshape(10, 10)
+    step = 1 / 3600
+    rsc_dict = {"x_first": 10.0, "x_step": step, "y_first": 20.0, "y_step": -step}
+    # Pixel centers 2-6 in x and 3-7 in y, as snapped by align_bounds_to_pixel_grid
+    hp = step / 2
+    left, right = 10 + 2 * step - hp, 10 + 7 * step - hp
+    bbox = (left, 20 - 8 * step + hp, right, 20 - 3 * step + hp)
+    out = upsample.resample(a, rsc_dict, bbox)
+    assert np.shares_memory(out, a)
+    np.testing.assert_array_equal(out, a[3:8, 2:7])
+
+
+def test_resample_by_blocks_aligned(tmp_path):
+    a = np.arange(100, dtype="int16").reshape(10, 10)
+    rsc_dict = {"x_first": 0.0, "x_step": 1.0, "y_first": 10.0, "y_step": -1.0}
+    bbox = (1.5, 1.5, 8.5, 8.5)
+    calls = []
+
+    def read_window(rows, cols):
+        calls.append((rows, cols))
+        return a[slice(*rows), slice(*cols)]
+
+    outfile = tmp_path / "out.dem"
+    out_shape = upsample.resample_by_blocks(
+        read_window, a.shape, rsc_dict, bbox, outfile, "float32", block_rows=3
+    )
+    out = np.fromfile(outfile, dtype="float32").reshape(out_shape)
+    np.testing.assert_array_equal(out, a[2:9, 2:9])
+    # Only the pixels of the bbox are read, with no halo
+    assert sorted(calls) == [((2, 5), (2, 9)), ((5, 8), (2, 9)), ((8, 9), (2, 9))]
+
+
+@pytest.mark.parametrize("method", ["cubic", "lanczos"])
+def test_kernels_interpolate(method):
+    rng = np.random.default_rng(3)
+    a = rng.normal(size=(20, 30))
+    # At the source pixel centers, interpolating kernels give the source values
+    out = upsample.separable_resample(a, np.arange(30.0), np.arange(20.0), method)
+    assert_allclose(out, a, atol=1e-12)
+    # ... and follow linear ramps between them (exactly, for cubic)
+    ramp = np.add.outer(np.arange(20.0), 2 * np.arange(30.0))
+    xi, yi = np.linspace(3, 25, 50), np.linspace(3, 15, 40)
+    out = upsample.separable_resample(ramp, xi, yi, method)
+    atol = 0.1 if method == "lanczos" else 1e-9
+    assert_allclose(out, np.add.outer(yi, 2 * xi), atol=atol)
+
+
+def test_cubicspline_smooths():
+    a = np.zeros((9, 9))
+    a[4, 4] = 36
+    out = upsample.separable_resample(a, np.arange(9.0), np.arange(9.0), "cubicspline")
+    # B-spline weights at the pixel centers are 1/6, 4/6, 1/6
+    assert_allclose(out[3:6, 3:6], [[1, 4, 1], [4, 16, 4], [1, 4, 1]], atol=1e-12)
+    assert_allclose(out.sum(), 36)
+
+
+def test_resample_by_blocks_methods(tmp_path):
+    rng = np.random.default_rng(1)
+    a = rng.integers(-100, 3000, size=(101, 121)).astype("int16")
+    step = 1 / 100
+    rsc_dict = {"x_first": 0.0, "x_step": step, "y_first": 1.0, "y_step": -step}
+    bbox = (0.1234, 0.2345, 1.0123, 0.9123)
+
+    def read_window(rows, cols):
+        return a[slice(*rows), slice(*cols)]
+
+    for method in upsample.RESAMPLE_METHODS:
+        expected = upsample.resample(
+            a.astype("float32"), rsc_dict, bbox, 2, 3, method=method
+        )
+        outfile = tmp_path / "out_{}.dem".format(method)
+        out_shape = upsample.resample_by_blocks(
+            read_window,
+            a.shape,
+            rsc_dict,
+            bbox,
+            outfile,
+            "float32",
+            block_rows=7,
+            xrate=2,
+            yrate=3,
+            method=method,
+        )
+        out = np.fromfile(outfile, dtype="float32").reshape(out_shape)
+        assert out.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("rates", [(1.7, 2.5), (0.6, 0.8), (1.234, 0.77)])
+def test_resample_by_blocks_fractional_rates(tmp_path, rates):
+    # e.g. matching a target grid which isn't a multiple of the source grid.
+    # (1.234, 0.77) don't divide the bbox: the step is kept, not stretched
+    a = np.add.outer(2 * np.arange(101), np.arange(121)).astype("float32")
+    step = 1 / 100
+    rsc_dict = {"x_first": 0.0, "x_step": step, "y_first": 1.0, "y_step": -step}
+    bbox = (0.1, 0.2, 1.1, 0.9)
+    xrate, yrate = rates
+
+    out_shape = upsample.resample_shape(a.shape, rsc_dict, bbox, xrate, yrate)
+    assert out_shape == (round(70 * yrate), round(100 * xrate))
+
+    def read_window(rows, cols):
+        return a[slice(*rows), slice(*cols)]
+
+    outfile = tmp_path / "out.dem"
+    upsample.resample_by_blocks(
+        read_window,
+        a.shape,
+        rsc_dict,
+        bbox,
+        outfile,
+        "float32",
+        block_rows=5,
+        xrate=xrate,
+        yrate=yrate,
+    )
+    out = np.fromfile(outfile, dtype="float32").reshape(out_shape)
+    expected = upsample.resample(a, rsc_dict, bbox, xrate, yrate)
+    assert out.tobytes() == expected.tobytes()
+
+    # Bilinear reproduces the ramp at the output pixel centers
+    out_step_x, out_step_y = step / xrate, step / yrate
+    x = (bbox[0] + out_step_x * (np.arange(out_shape[1]) + 0.5)) / step
+    y = (rsc_dict["y_first"] - bbox[3] + out_step_y * (np.arange(out_shape[0]) + 0.5))
+    assert_allclose(out, np.add.outer(2 * y / step, x), atol=1e-3)
+
+
+def test_take_looks():
+    a = np.arange(30, dtype="float32").reshape(5, 6)
+    # The last partial row of looks is dropped
+    expected = np.array([[3.5, 5.5, 7.5], [15.5, 17.5, 19.5]])
+    assert_allclose(upsample.take_looks(a, 2, 2), expected)
+
+    a[0, 0] = np.nan
+    a[2:4, 4:6] = -1
+    looked = upsample.take_looks(a, 2, 2, nodata=-1)
+    # Voids are left out of the means, and all-void blocks stay voids
+    assert_allclose(looked[0, 0], np.mean([1, 6, 7]))
+    assert looked[1, 2] == -1
+    assert upsample.take_looks(a, 2, 2, nodata=-1, fill_value=0)[1, 2] == 0
+
+    b = np.array([[0, 1, 1, 0], [0, 1, 0, 0]], dtype="uint8")
+    assert upsample.take_looks(b, 2, 2, dtype="uint8").tolist() == [[0, 0]]
+    assert upsample.take_looks(b[:1], 1, 2, dtype="uint8").dtype == np.uint8
+
+
+@pytest.mark.parametrize("rates", [(1, 1), (2, 3)])
+@pytest.mark.parametrize(
+    "bbox", [(0.1234, 0.2345, 1.0123, 0.9123), (0.105, 0.205, 1.005, 0.905)]
+)
+def test_resample_by_blocks_looks(tmp_path, rates, bbox):
+    rng = np.random.default_rng(3)
+    a = rng.integers(-100, 3000, size=(101, 121)).astype("int16")
+    a[40:50, 30:45] = 0
+    step = 1 / 100
+    rsc_dict = {"x_first": 0.0, "x_step": step, "y_first": 1.0, "y_step": -step}
+    xrate, yrate = rates
+
+    def read_window(rows, cols):
+        return a[slice(*rows), slice(*cols)]
+
+    outfile = tmp_path / "out.dem"
+    out_shape = upsample.resample_by_blocks(
+        read_window,
+        a.shape,
+        rsc_dict,
+        bbox,
+        outfile,
+        "float32",
+        block_rows=3,
+        xrate=xrate,
+        yrate=yrate,
+        xlooks=4,
+        ylooks=5,
+        nodata=0,
+    )
+    assert out_shape == upsample.resample_shape(
+        a.shape, rsc_dict, bbox, xrate, yrate, xlooks=4, ylooks=5
+    )
+    # Pixels interpolated from a void are left out too
+    src = a.astype("float32")
+    src[a == 0] = np.nan
+    full = upsample.resample(src, rsc_dict, bbox, xrate, yrate)
+    expected = upsample.take_looks(full, 5, 4, nodata=0, dtype="float32")
+    out = np.fromfile(outfile, dtype="float32").reshape(out_shape)
+    assert out.tobytes() == expected.tobytes()
+
+
+@pytest.fixture
+def reset_backend(monkeypatch):
+    monkeypatch.setattr(upsample, "_backend", None)
+
+
+def test_set_backend(reset_backend, monkeypatch):
+    assert upsample.set_backend("numpy") == upsample.get_backend() == "numpy"
+    with pytest.raises(ValueError):
+        upsample.set_backend("fortran")
+
+    monkeypatch.setattr(upsample, "_backend", None)
+    monkeypatch.setenv(upsample.BACKEND_ENV, "numpy")
+    assert upsample.get_backend() == "numpy"
+
+
+@pytest.mark.parametrize("method", upsample.RESAMPLE_METHODS)
+@pytest.mark.parametrize("dtype", ["int16", "uint8", "float32", "float64"])
+def test_numba_backend_matches_numpy(reset_backend, method, dtype):
+    pytest.importorskip("numba")
+    rng = np.random.default_rng(4)
+    a = rng.integers(0, 250, size=(47, 59)).astype(dtype)
+    xi = np.linspace(-0.4, 58.3, 171)
+    yi = np.linspace(0.2, 46.9, 133)
+
+    def run(out_dtype):
+        out = np.empty((len(yi), len(xi)), dtype=out_dtype)
+        return upsample.separable_resample(a, xi, yi, method, out=out)
+
+    # Same operations in the same dtype: identical results, in float32 too
+    out_dtypes = ["float64", "float32", "int16"]
+    assert upsample.set_backend() == "numpy"
+    expected = [run(out_dtype) for out_dtype in out_dtypes]
+    upsample.set_backend("numba")
+    for out_dtype, exp in zip(out_dtypes, expected):
+        np.testing.assert_array_equal(run(out_dtype), exp)
+    out = upsample.separable_resample(a, xi, yi, method)
+    if method == "bilinear":
+        reference = upsample.bilinear_interpolate(
+            a.astype(float), xi.reshape(1, -1), yi.reshape(-1, 1)
+        )
+        assert_allclose(out, reference, atol=1e-6 * 250)
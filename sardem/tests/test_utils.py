@@ -11,6 +11,23 @@ def test_shift_integer_bbox():
     assert utils.shift_integer_bbox(bbox) == pytest.approx(expected)
 
 
+def test_target_rates():
+    bbox = (-156.0, 19.0, -155.0, 19.5)
+    xrate, yrate = utils.target_rates(bbox, target_res=(0.0002, DEFAULT_RES / 0.7))
+    assert xrate == pytest.approx(DEFAULT_RES / 0.0002)
+    assert yrate == pytest.approx(0.7)
+    # The shape is the output size over the bbox
+    xrate, yrate = utils.target_rates(bbox, target_shape=(900, 4000))
+    assert (xrate * 3600, yrate * 1800) == pytest.approx((4000, 900))
+
+    with pytest.raises(ValueError):
+        utils.target_rates(bbox)
+    with pytest.raises(ValueError):
+        utils.target_rates(bbox, target_res=(1, 1), target_shape=(1, 1))
+    with pytest.raises(ValueError):
+        utils.target_rates(bbox, target_res=(0, 1))
+
+
 class TestCheckDateline:
     """Tests for the check_dateline function."""
 
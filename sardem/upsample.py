@@ -1,4 +1,6 @@
 import logging
+import os
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
@@ -7,6 +9,59 @@ from sardem import loading, utils
 logger = logging.getLogger("sardem")
 utils.set_logger_handler(logger)
 
+# Interpolation backend for `separable_resample`: "numpy" (the default),
+# "numba", or "auto" to use numba when it's installed.
+# Set with `set_backend`, or this env variable
+BACKEND_ENV = "SARDEM_INTERP_BACKEND"
+INTERP_BACKENDS = ("auto", "numba", "numpy")
+DEFAULT_BACKEND = "numpy"
+_backend = None
+
+
+def set_backend(name=DEFAULT_BACKEND):
+    """Choose the interpolation backend used by `separable_resample`
+
+    Parameters
+    ----------
+    name : str
+        "numba" for the fused, multithreaded numba kernel (raises ImportError
+        if numba isn't installed), "numpy" for the vectorized NumPy passes,
+        or "auto" to use numba if it can be imported. Default "numpy".
+        Both give the same results. The numba kernel must not be called from
+        several threads at once.
+
+    Returns
+    -------
+    str
+        The backend now in use, "numba" or "numpy"
+    """
+    global _backend
+    if name not in INTERP_BACKENDS:
+        raise ValueError(
+            "Unknown backend {}: choices are {}".format(
+                name, ", ".join(INTERP_BACKENDS)
+            )
+        )
+    if name == "numpy":
+        _backend = "numpy"
+        return _backend
+    from sardem import numba_kernels
+
+    if numba_kernels.numba is not None:
+        _backend = "numba"
+    elif name == "numba":
+        raise ImportError("numba is not installed")
+    else:
+        _backend = "numpy"
+    return _backend
+
+
+def get_backend():
+    """The interpolation backend in use, set from $SARDEM_INTERP_BACKEND at first"""
+    if _backend is None:
+        set_backend(os.getenv(BACKEND_ENV, DEFAULT_BACKEND))
+    return _backend
+
 
 def upsample_with_gdal(filename, outfile, method="cubic", xrate=1, yrate=1):
     """Perform upsampling on a raster using gdal
@@ -42,9 +97,24 @@ def upsample_with_gdal(filename, outfile, method="cubic", xrate=1, yrate=1):
 
 
 def upsample_by_blocks(
-    filename, outfile, input_shape, block_rows, dtype, xrate=1, yrate=1
+    filename,
+    outfile,
+    input_shape,
+    block_rows,
+    dtype,
+    xrate=1,
+    yrate=1,
+    num_threads=None,
+    method="bilinear",
 ):
-    """Perform bilinear upsampling on a raster by blocks
+    """Perform upsampling on a raster by blocks
+
+    Gives the same output as `upsample` on the whole raster: each block of
+    output rows is interpolated at the same coordinates as in the full-array
+    path, reading its source rows plus the neighboring (halo) rows its kernel
+    needs from a memmap, so there are no seams between blocks.
+    Blocks run in parallel threads, each writing into its own rows of the
+    preallocated output file.
 
     Parameters
     ----------
@@ -55,39 +125,47 @@ def upsample_by_blocks(
     input_shape : tuple[int, int]
         Shape of input raster `filename`
     block_rows : int
-        Number of rows to read in at a time per block
+        Number of input rows per block (not counting the halo)
     dtype : str, np.dtype
-        data type of input raster
+        data type of input raster (and of the output)
     xrate : int, optional.
         Rate to upsample in the x/column direction
         Default = 1, no upsampling
     yrate : int, optional
         Rate to upsample in the y/row direction
         Default = 1, no upsampling
+    num_threads : int, optional
+        Number of blocks to upsample at once. Default = number of CPUs
+    method : str, optional
+        One of `RESAMPLE_METHODS` (see `separable_resample`). Default bilinear
     """
-    _, total_cols = input_shape
-    block_shape = (block_rows, total_cols)
-
     dtype = np.dtype(dtype)
-    with open(outfile, "wb") as f:
-        for rows, _ in _block_iterator(input_shape, block_shape):
-            offset = total_cols * rows[0] * dtype.itemsize
-            cur_block_shape = (rows[1] - rows[0], total_cols)
-            logging.info("Upsampling rows {}".format(rows))
-            print("Upsampling rows {}".format(rows))
-            cur_block = np.memmap(
-                filename,
-                mode="r",
-                dtype=dtype,
-                offset=offset,
-                shape=cur_block_shape,
-            )
-            # always upsample as a float
-            cur_block_upsampled = upsample(cur_block.astype("float32"), xrate, yrate)
-            # then convert back to the original dtype
-            if np.issubdtype(dtype, np.integer):
-                cur_block_upsampled = np.round(cur_block_upsampled)
-            cur_block_upsampled.astype(dtype).tofile(f)
+    radius = kernel_radius(method)
+    ny, nx = input_shape
+    src = np.memmap(filename, mode="r", dtype=dtype, shape=input_shape)
+    # Coordinates of every output pixel in the full input, as in `upsample`
+    xi = np.linspace(0, nx - 1, round(nx * xrate))
+    yi = np.linspace(0, ny - 1, round(ny * yrate))
+    out = np.memmap(outfile, mode="w+", dtype=dtype, shape=(len(yi), len(xi)))
+
+    def _upsample_block(rows):
+        y = yi[rows[0] : rows[1]]
+        row_start, row_stop = _source_span(y, ny, radius)
+        logger.debug("Upsampling rows {}".format((row_start, row_stop)))
+        # Shifting by an integer offset is exact: same result as the full array
+        separable_resample(
+            src[row_start:row_stop],
+            xi,
+            y - row_start,
+            method=method,
+            out=out[rows[0] : rows[1]],
+        )
+
+    out_block_rows = max(1, int(round(block_rows * yrate)))
+    blocks = [rows for rows, _ in _block_iterator(out.shape, (out_block_rows, None))]
+    _map_blocks(_upsample_block, blocks, num_threads)
+    out.flush()
+    del out
 
 
 def bilinear_interpolate(arr, x, y):
@@ -117,57 +195,615 @@ def bilinear_interpolate(arr, x, y):
     return wa * Ia + wb * Ib + wc * Ic + wd * Id
 
 
-def upsample(arr, xrate, yrate):
-    """Upsample an array by a factor of xrate and yrate"""
+def separable_bilinear(arr, xi, yi, out=None, block_pixels=None):
+    """Bilinear interpolation of `arr` on the grid of `yi` rows x `xi` columns
+
+    Same result as `bilinear_interpolate(arr, xi.reshape(1, -1), yi.reshape(-1, 1))`
+    (up to floating point rounding). See `separable_resample`.
+    """
+    return separable_resample(
+        arr, xi, yi, method="bilinear", out=out, block_pixels=block_pixels
+    )
+
+
+def separable_resample(arr, xi, yi, method="bilinear", out=None, block_pixels=None):
+    """Resample `arr` on the grid of `yi` rows x `xi` columns with a separable kernel
+
+    Done as two 1-D convolution passes: first along each source row (once
+    per source row, shared by the output rows between them), then between
+    rows. The indices and weights are computed once per axis, and output rows
+    are filled a block at a time into reused buffers, so the temporaries stay
+    small compared to the output.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        2D array to interpolate
+    xi : np.ndarray
+        1D (fractional) column coordinates of the output columns
+    yi : np.ndarray
+        1D (fractional) row coordinates of the output rows
+    method : str
+        One of `RESAMPLE_METHODS`, named as in GDAL's `resampleAlg`:
+        "bilinear", "cubic" (Keys cubic convolution, a = -0.5),
+        "cubicspline" (cubic B-spline, which smooths the data), or
+        "lanczos" (3-lobed windowed sinc). Default "bilinear".
+    out : np.ndarray, optional
+        Array of shape (len(yi), len(xi)) to write the result into. If it has
+        an integer dtype, the result is rounded to the nearest integer (and
+        clipped to the dtype's range).
+        Default creates a float64 array.
+    block_pixels : int, optional
+        Number of output pixels to compute at a time
+        (default `INTERP_BLOCK_PIXELS`)
+
+    Returns
+    -------
+    np.ndarray
+        `out`, or a new array of shape (len(yi), len(xi))
+
+    Notes
+    -----
+    Source pixels past the edges of `arr` take the value of the edge pixel.
+
+    Computes in float64 by default. With an `out` array of an integer dtype
+    or float32, computes in float32 for inputs of up to 16 bit integers and
+    for float32 (`np.result_type(arr.dtype, np.float32)`), and in float64
+    otherwise. For bilinear in float32, every output pixel is within
+    1e-6 * max(abs(arr)) of the float64 result: under 0.01 m for any elevation
+    on Earth. After rounding to integers, this can only change pixels lying
+    within that distance of a half-integer, by 1.
+
+    The "numba" backend (see `set_backend`) does the same operations in the
+    same order and dtype, in fused loops over chunks of output rows, so both
+    backends give identical results.
+    """
+    xi = np.asarray(xi, dtype=float).ravel()
+    yi = np.asarray(yi, dtype=float).ravel()
+    if out is None:
+        out = np.empty((len(yi), len(xi)), dtype=np.float64)
+    round_output = np.issubdtype(out.dtype, np.integer)
+    if round_output:
+        compute_dtype = np.result_type(arr.dtype, np.float32)
+    else:
+        compute_dtype = np.result_type(arr.dtype, np.float32, out.dtype)
+    x_idxs, x_weights = _kernel_weights(xi, arr.shape[1], method, compute_dtype)
+    y_idxs, y_weights = _kernel_weights(yi, arr.shape[0], method, compute_dtype)
+    # numba only handles native byte order (e.g. not raw big-endian .hgt data)
+    if get_backend() == "numba" and arr.dtype.isnative and out.dtype.isnative:
+        return _numba_resample(arr, x_idxs, x_weights, y_idxs, y_weights, out)
+
+    block_rows = _get_block_rows(max(len(xi), 1), block_pixels or INTERP_BLOCK_PIXELS)
+    block_rows = max(min(block_rows, len(yi)), 1)
+    blocks = [slice(i, i + block_rows) for i in range(0, len(yi), block_rows)]
+    # Range of source rows used by each block of output rows
+    spans = [
+        (min(idx[rows].min() for idx in y_idxs), max(idx[rows].max() for idx in y_idxs))
+        for rows in blocks
+    ]
+    max_span = max([hi - lo + 1 for lo, hi in spans] or [1])
+    row_buf = np.empty((2, max_span, len(xi)), dtype=compute_dtype)
+    col_buf = np.empty((2, block_rows, len(xi)), dtype=compute_dtype)
+    for rows, (src_start, src_stop) in zip(blocks, spans):
+        n = len(yi[rows])
+        src = arr[src_start : src_stop + 1]
+        # Pass 1: interpolate along each source row, once for all output rows
+        tmp, tmp1 = row_buf[0, : len(src)], row_buf[1, : len(src)]
+        np.multiply(src[:, x_idxs[0]], x_weights[0], out=tmp)
+        for idx, weight in zip(x_idxs[1:], x_weights[1:]):
+            np.multiply(src[:, idx], weight, out=tmp1)
+            tmp += tmp1
+        # Pass 2: interpolate between the column-interpolated source rows
+        block, block1 = col_buf[0, :n], col_buf[1, :n]
+        np.take(tmp, y_idxs[0][rows] - src_start, axis=0, out=block)
+        block *= y_weights[0][rows, np.newaxis]
+        for idx, weight in zip(y_idxs[1:], y_weights[1:]):
+            np.take(tmp, idx[rows] - src_start, axis=0, out=block1)
+            block1 *= weight[rows, np.newaxis]
+            block += block1
+        if round_output:
+            np.rint(block, out=block)
+            info = np.iinfo(out.dtype)
+            np.clip(block, info.min, info.max, out=block)
+        out[rows] = block
+    return out
+
+
+def _numba_resample(arr, x_idxs, x_weights, y_idxs, y_weights, out):
+    from sardem import numba_kernels
+
+    if np.issubdtype(out.dtype, np.integer):
+        info = np.iinfo(out.dtype)
+        round_output, lo, hi = True, float(info.min), float(info.max)
+    else:
+        round_output, lo, hi = False, -np.inf, np.inf
+    # One row per tap, contiguous along the output for the inner loops
+    numba_kernels.resample_separable(
+        np.asarray(arr),
+        np.array(y_idxs),
+        np.array(y_weights),
+        np.array(x_idxs),
+        np.array(x_weights),
+        np.asarray(out),
+        round_output,
+        lo,
+        hi,
+        NUMBA_CHUNK_ROWS,
+    )
+    return out
+
+
+def _linear_weights(coords, size, dtype=float):
+    """Neighbor indices and weights for 1D linear interpolation at `coords`
+
+    Returns (i0, i1, w0, w1), so that the value at `coords` is
+    w0 * a[i0] + w1 * a[i1]. Indices are clipped to the array, as in
+    `bilinear_interpolate`. Weights are computed in float64, then cast to `dtype`.
+    """
+    i0 = np.floor(coords).astype(int)
+    i1 = i0 + 1
+    w0 = (i1 - coords).astype(dtype)
+    w1 = (coords - i0).astype(dtype)
+    return np.clip(i0, 0, size - 1), np.clip(i1, 0, size - 1), w0, w1
+
+
+def _cubic_kernel(x, a=-0.5):
+    """Keys cubic convolution kernel (GDAL's "cubic")"""
+    x = np.abs(x)
+    x2, x3 = x**2, x**3
+    near = (a + 2) * x3 - (a + 3) * x2 + 1
+    far = a * x3 - 5 * a * x2 + 8 * a * x - 4 * a
+    return np.where(x <= 1, near, np.where(x < 2, far, 0.0))
+
+
+def _cubic_spline_kernel(x):
+    """Cubic B-spline kernel (GDAL's "cubicspline")"""
+    x = np.abs(x)
+    near = (4 - 6 * x**2 + 3 * x**3) / 6
+    far = (2 - x) ** 3 / 6
+    return np.where(x < 1, near, np.where(x < 2, far, 0.0))
+
+
+def _lanczos_kernel(x, lobes=3):
+    """Lanczos windowed sinc kernel (GDAL's "lanczos")"""
+    return np.where(np.abs(x) < lobes, np.sinc(x) * np.sinc(x / lobes), 0.0)
+
+
+# Kernel function and radius (in source pixels) of each method
+_KERNELS = {
+    "bilinear": (None, 1),
+    "cubic": (_cubic_kernel, 2),
+    "cubicspline": (_cubic_spline_kernel, 2),
+    "lanczos": (_lanczos_kernel, 3),
+}
+RESAMPLE_METHODS = tuple(_KERNELS)
+# Methods which return the source pixel values at the source pixel centers
+INTERPOLATING_METHODS = ("bilinear", "cubic", "lanczos")
+
+
+def kernel_radius(method):
+    """Number of source pixels on each side of a point that `method` uses"""
+    try:
+        return _KERNELS[method][1]
+    except KeyError:
+        raise ValueError(
+            "Unknown resampling method {}: choices are {}".format(
+                method, ", ".join(RESAMPLE_METHODS)
+            )
+        )
+
+
+def _kernel_weights(coords, size, method, dtype=float):
+    """Source indices and weights of each tap of `method`'s kernel at `coords`
+
+    Returns (indices, weights): lists with one array per kernel tap, so that
+    the value at `coords` is sum(w * a[i] for i, w in zip(indices, weights)).
+    Indices are clipped to the array. Weights are computed in float64,
+    normalized to sum to 1, then cast to `dtype`.
+    """
+    radius = kernel_radius(method)
+    if method == "bilinear":
+        i0, i1, w0, w1 = _linear_weights(coords, size, dtype)
+        return [i0, i1], [w0, w1]
+    kernel = _KERNELS[method][0]
+    base = np.floor(coords).astype(int)
+    offsets = np.arange(1 - radius, radius + 1)[:, np.newaxis]
+    indices = base + offsets
+    weights = kernel(coords - indices)
+    weights /= weights.sum(axis=0)
+    return list(np.clip(indices, 0, size - 1)), list(weights.astype(dtype))
+
+
+def upsample(arr, xrate, yrate, dtype=None, method="bilinear"):
+    """Upsample an array by a factor of xrate and yrate
+
+    The output has `dtype` if given (rounded for integer types, and computed
+    in float32 for inputs of up to 16 bits), otherwise float64.
+    `method` is one of `RESAMPLE_METHODS` (see `separable_resample`).
+    """
     ny, nx = arr.shape
 
-    xi = np.linspace(0, arr.shape[1] - 1, round(nx * xrate)).reshape((1, -1))
-    yi = np.linspace(0, arr.shape[0] - 1, round(ny * yrate)).reshape((-1, 1))
-    return bilinear_interpolate(arr, xi, yi)
+    xi = np.linspace(0, arr.shape[1] - 1, round(nx * xrate))
+    yi = np.linspace(0, arr.shape[0] - 1, round(ny * yrate))
+    out = None if dtype is None else np.empty((len(yi), len(xi)), dtype=dtype)
+    return separable_resample(arr, xi, yi, method=method, out=out)
+
+
+def resample(arr, rsc_dict, bbox, xrate=1, yrate=1, method="bilinear"):
+    """Resample an array described by rsc_dict to a new bounding box
+
+    The output has `xrate`/`yrate` times the resolution of `arr`: its pixel
+    edges are the edges of `bbox`, and its pixel size is the source pixel
+    size divided by the rates (the same grid as `upsample_dem_rsc` describes).
+    The rates may be non-integer, to reach any output pixel size.
+    `method` is one of `RESAMPLE_METHODS` (see `separable_resample`).
+
+    If the output pixel centers land on the source pixel centers (e.g. for
+    integer-degree tile crops, or bounds from `utils.align_bounds_to_pixel_grid`),
+    this returns a view of `arr` without interpolating. Otherwise, only the
+    window of `arr` covering the bbox is interpolated.
+    """
+    xi, yi = _resample_coords(arr.shape, rsc_dict, bbox, xrate, yrate)
+    aligned = _aligned_window(xi, yi, arr.shape, method)
+    if aligned is not None:
+        return arr[aligned]
+
+    radius = kernel_radius(method)
+    row_start, row_stop = _source_span(yi, arr.shape[0], radius)
+    col_start, col_stop = _source_span(xi, arr.shape[1], radius)
+    window = arr[row_start:row_stop, col_start:col_stop]
+    return _resample_window(
+        window, xi - col_start, yi - row_start, arr.dtype, method=method
+    )
+
 
+def resample_by_blocks(
+    read_window,
+    input_shape,
+    rsc_dict,
+    bbox,
+    outfile,
+    dtype,
+    block_rows=None,
+    xrate=1,
+    yrate=1,
+    method="bilinear",
+    num_threads=None,
+    xlooks=1,
+    ylooks=1,
+    nodata=None,
+    fill_value=None,
+):
+    """Resample a raster onto a bounding box, writing to `outfile` by row blocks
+
+    Without upsampling, produces the same output as `resample` followed by
+    `.astype(dtype)`, but only reads the source rows/columns each block of
+    output rows needs (plus the halo of the `method`'s kernel).
+    Cropping and upsampling happen in this one pass; when upsampling, pixels
+    are interpolated directly in `dtype`.
+    Blocks run in parallel threads, each writing into its own rows of the
+    preallocated output file.
+    With `xlooks`/`ylooks`, each block is also averaged down (see `take_looks`)
+    before being written, so the full resolution grid is never stored.
+
+    Parameters
+    ----------
+    read_window : Callable[[tuple[int, int], tuple[int, int]], np.ndarray]
+        Function taking (row_start, row_stop), (col_start, col_stop) and
+        returning that window of the source raster (e.g. `Stitcher.read_window`)
+    input_shape : tuple[int, int]
+        Shape of the full source raster
+    rsc_dict : dict
+        .rsc info of the source raster
+    bbox : tuple[float]
+        (left, bottom, right, top) edges of the output
+    outfile : str
+        Name of output file
+    dtype : str, np.dtype
+        data type of output raster
+    block_rows : int, optional
+        Number of output rows to compute at a time.
+        Default picks a size keeping each block around `BLOCK_PIXELS` pixels.
+    xrate : float, optional
+        Rate to upsample in the x/column direction (default 1, no upsampling).
+        Need not be an integer, e.g. from `utils.target_rates`
+    yrate : float, optional
+        Rate to upsample in the y/row direction (default 1, no upsampling)
+    method : str, optional
+        One of `RESAMPLE_METHODS` (see `separable_resample`). Default bilinear
+    num_threads : int, optional
+        Number of blocks to resample at once. Default = number of CPUs
+    xlooks : int, optional
+        Number of (resampled) columns to average into one output pixel
+        (default 1, no multilooking)
+    ylooks : int, optional
+        Number of (resampled) rows to average into one output pixel
+    nodata : float, optional
+        Value of voids, left out of the averages when multilooking. When also
+        upsampling, the output pixels interpolated from a void are left out.
+    fill_value : float, optional
+        Value of the multilooked pixels with no valid pixels (see `take_looks`)
+
+    Returns
+    -------
+    tuple[int, int]
+        Shape of the output raster
+    """
+    xi, yi = _resample_coords(input_shape, rsc_dict, bbox, xrate, yrate)
+    # Partial looks past the last full one are dropped
+    xi = xi[: len(xi) // xlooks * xlooks]
+    yi = yi[: len(yi) // ylooks * ylooks]
+    out_shape = (len(yi) // ylooks, len(xi) // xlooks)
+    if block_rows is None:
+        # Keep the blocks before multilooking around `BLOCK_PIXELS`
+        block_rows = _get_block_rows(len(xi) * ylooks)
+    radius = kernel_radius(method)
+    multilook = (xlooks, ylooks) != (1, 1)
+
+    # On the source grid, each block is a plain copy of the source window
+    aligned = _aligned_window(xi, yi, input_shape, method)
+
+    # Crops keep the source dtype, like `resample`. Upsampled pixels are
+    # interpolated straight into the output dtype, so they aren't rounded
+    # to integers for float outputs
+    interp_dtype = None if (xrate, yrate) == (1, 1) else dtype
+    if multilook and interp_dtype is not None:
+        # Don't round before averaging
+        interp_dtype = np.result_type(dtype, np.float32)
+
+    # The columns needed are the same for every block
+    col_start, col_stop = _source_span(xi, input_shape[1], radius)
+    out = np.memmap(outfile, mode="w+", dtype=dtype, shape=out_shape)
+
+    def _resample_block(rows):
+        # Rows of the resampled grid, before multilooking
+        full_rows = (rows[0] * ylooks, rows[1] * ylooks)
+        if aligned is not None:
+            row_slice, col_slice = aligned
+            block = read_window(
+                (row_slice.start + full_rows[0], row_slice.start + full_rows[1]),
+                (col_slice.start, col_slice.start + len(xi)),
+            )
+        else:
+            y = yi[full_rows[0] : full_rows[1]]
+            row_start, row_stop = _source_span(y, input_shape[0], radius)
+            window = read_window((row_start, row_stop), (col_start, col_stop))
+            if multilook and nodata is not None:
+                # Voids become NaNs, which `take_looks` leaves out
+                voids = window == nodata
+                window = window.astype(np.result_type(window.dtype, np.float32))
+                window[voids] = np.nan
+            # Shifting by an integer offset is exact, so the output is identical
+            # to resampling the full array at once
+            block = _resample_window(
+                window,
+                xi - col_start,
+                y - row_start,
+                interp_dtype or window.dtype,
+                method=method,
+            )
+        if multilook:
+            block = take_looks(
+                block,
+                ylooks,
+                xlooks,
+                nodata=nodata,
+                dtype=dtype,
+                fill_value=fill_value,
+            )
+        out[rows[0] : rows[1]] = block
+
+    blocks = [rows for rows, _ in _block_iterator(out_shape, (block_rows, None))]
+    _map_blocks(_resample_block, blocks, num_threads)
+    out.flush()
+    del out
+    return out_shape
+
+
+def resample_shape(input_shape, rsc_dict, bbox, xrate=1, yrate=1, xlooks=1, ylooks=1):
+    """Shape of the output of `resample`/`resample_by_blocks` for `bbox`"""
+    xi, yi = _resample_coords(input_shape, rsc_dict, bbox, xrate, yrate)
+    return len(yi) // ylooks, len(xi) // xlooks
+
+
+def take_looks(arr, row_looks, col_looks, nodata=None, dtype=None, fill_value=None):
+    """Average `arr` over blocks of `row_looks` x `col_looks` pixels
+
+    Rows/columns past the last full block are dropped. NaNs, and pixels equal
+    to `nodata`, are left out of the averages; blocks with no valid pixels
+    are set to `fill_value` (`nodata` if not given, or NaN without either).
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        2D array to multilook
+    row_looks : int
+        Number of rows to average into one output pixel
+    col_looks : int
+        Number of columns to average into one output pixel
+    nodata : float, optional
+        Value of voids in `arr`
+    dtype : str, np.dtype, optional
+        Output dtype (rounded for integer types). Default is the compute
+        dtype: float32, or float64 for float64/wide integer inputs.
+    fill_value : float, optional
+        Value of the output pixels with no valid pixels
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (rows // row_looks, cols // col_looks)
+
+    Examples:
+    >>> take_looks(np.arange(16).reshape(4, 4), 2, 2)
+    array([[ 2.5,  4.5],
+           [10.5, 12.5]])
+    >>> take_looks(np.array([[0, 4, 0, 0]], dtype="int16"), 1, 2, nodata=0)
+    array([[4., 0.]], dtype=float32)
+    """
+    rows, cols = arr.shape[0] // row_looks, arr.shape[1] // col_looks
+    arr = arr[: rows * row_looks, : cols * col_looks]
+    compute_dtype = np.result_type(arr.dtype, np.float32)
+    data = arr.astype(compute_dtype)
+    valid = ~np.isnan(data)
+    if nodata is not None:
+        valid &= arr != nodata
+    data[~valid] = 0
+
+    looks_shape = (rows, row_looks, cols, col_looks)
+    sums = data.reshape(looks_shape).sum(axis=(1, 3))
+    counts = valid.reshape(looks_shape).sum(axis=(1, 3)).astype(compute_dtype)
+    empty = counts == 0
+    counts[empty] = 1
+    out = sums / counts
+    if fill_value is None:
+        fill_value = np.nan if nodata is None else nodata
+    out[empty] = fill_value
+    if dtype is None:
+        return out
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        info = np.iinfo(dtype)
+        np.clip(np.rint(out, out=out), info.min, info.max, out=out)
+    return out.astype(dtype)
+
+
+# Number of output pixels per block when resampling by blocks
+BLOCK_PIXELS = 2**22
+# Number of output pixels interpolated at a time within an array: small enough
+# that the temporaries of `separable_bilinear` stay in the CPU cache
+INTERP_BLOCK_PIXELS = 2**18
+# Number of output rows each numba thread computes at a time, sharing the
+# column-interpolated source rows
+NUMBA_CHUNK_ROWS = 32
+
+
+def _map_blocks(func, blocks, num_threads=None):
+    """Run `func` on each block, in `num_threads` threads (default: all CPUs)
+
+    The numba backend already runs each block on all CPUs, and can't be
+    called from several threads at once: its blocks run one at a time.
+    """
+    if get_backend() == "numba":
+        for block in blocks:
+            func(block)
+        return
+    pool = ThreadPool(processes=num_threads or os.cpu_count())
+    try:
+        pool.map(func, blocks)
+    finally:
+        pool.close()
+
+
+def _get_block_rows(ncols, block_pixels=BLOCK_PIXELS):
+    return max(1, block_pixels // ncols)
+
+
+# Coordinates within this many pixels of a source pixel center count as on it
+ALIGN_TOLERANCE = 1e-6
+
+
+def _aligned_start(coords, size, tol=ALIGN_TOLERANCE):
+    """Source index of `coords[0]` if `coords` are consecutive source pixels
+
+    Returns None if the coordinates fall between pixels, have a step other
+    than one pixel, or go outside the `size` source pixels.
+
+    Examples:
+    >>> _aligned_start(np.array([2.0, 3.0, 4.0]), 10)
+    2
+    >>> _aligned_start(np.array([2.5, 3.5]), 10) is None
+    True
+    """
+    if len(coords) == 0:
+        return None
+    start = int(np.round(coords[0]))
+    expected = np.arange(start, start + len(coords))
+    if start < 0 or expected[-1] >= size:
+        return None
+    if np.abs(coords - expected).max() > tol:
+        return None
+    return start
+
+
+def _aligned_window(xi, yi, shape, method):
+    """Slices of the source which are exactly the output, or None
 
-def resample(arr, rsc_dict, bbox):
-    """Resample an array described by rsc_dict to a new bounding box"""
+    Only for `INTERPOLATING_METHODS` when `xi`/`yi` land on source pixels.
+    """
+    if method not in INTERPOLATING_METHODS:
+        return None
+    col_start = _aligned_start(xi, shape[1])
+    row_start = _aligned_start(yi, shape[0])
+    if col_start is None or row_start is None:
+        return None
+    return (
+        slice(row_start, row_start + len(yi)),
+        slice(col_start, col_start + len(xi)),
+    )
+
+
+def _source_span(coords, size, radius=1):
+    """(start, stop) of the source pixels needed to interpolate at `coords`
+
+    `radius` is the kernel radius (see `kernel_radius`): 1 for bilinear.
+    """
+    start = max(int(np.floor(coords.min())) - (radius - 1), 0)
+    # Include the `radius` pixels past the last for interpolation
+    stop = min(int(np.floor(coords.max())) + radius + 1, size)
+    return start, stop
+
+
+def _resample_coords(input_shape, rsc_dict, bbox, xrate=1, yrate=1):
+    """Source (column, row) coordinates of the output pixel centers within `bbox`
+
+    The output grid starts at the top left corner of `bbox`, with pixels
+    `xrate`/`yrate` times smaller than the source pixels. The rates can be any
+    positive float (below 1 for a coarser grid than the source). As with
+    ``gdalwarp -tr``, the output step is kept exactly: when it doesn't divide
+    `bbox`, the right/bottom edge moves to the nearest whole pixel.
+    """
     rdict_lower = {k.lower(): v for k, v in rsc_dict.items()}
     x_first, x_step = rdict_lower["x_first"], rdict_lower["x_step"]
     y_first, y_step = rdict_lower["y_first"], rdict_lower["y_step"]
+    out_x_step, out_y_step = x_step / xrate, y_step / yrate
 
     # `bbox` should refer to the edges of the bounding box
-    # shift by half pixel so they point to the pixel centers for index finding
+    # shift by half (output) pixel so they point to the pixel centers for index finding
     # hp = 0.5 * DEFAULT_RES  # half pixel
-    hp = x_step / 2
+    hpx = x_step / 2 / xrate
+    hpy = y_step / 2 / yrate
     left, bot, right, top = bbox
-    left += hp
-    bot += hp
-    # Shift these two inward to be the final pixel centers
-    right -= hp
-    top -= hp
-
-    out_rows = int(round((bot - top) / y_step)) + 1
-    out_cols = int(round((right - left) / x_step)) + 1
-
-    xspan = x_step * (arr.shape[1] - 1)
-    yspan = y_step * (arr.shape[0] - 1)
-    x0, x1 = (left - x_first) / xspan, (right - x_first) / xspan
-    y0, y1 = (top - y_first) / yspan, (bot - y_first) / yspan
-
-    # if any(arg < 0 for arg in (left_idx, right_idx, top_idx, bot_idx)):
-    if any(arg < -1e-8 for arg in (x0, x1, y0, y1)):
+    out_rows = max(int(round((bot - top) / out_y_step)), 1)
+    out_cols = max(int(round((right - left) / out_x_step)), 1)
+
+    # Shift the top left corner to the first pixel center (y_step is negative)
+    left += hpx
+    top += hpy
+    rows, cols = input_shape
+    # Index of the first output pixel center, in source pixels
+    x0 = (left - x_first) / x_step
+    y0 = (top - y_first) / y_step
+
+    # When upsampling, the outermost output pixel centers may be up to half a
+    # source pixel outside the first source pixel center: they take its value
+    x_tol = 1e-8 + max(0.5 - 0.5 / xrate, 0)
+    y_tol = 1e-8 + max(0.5 - 0.5 / yrate, 0)
+    if x0 < -x_tol or y0 < -y_tol:
         raise ValueError(
             "x_first/y_first ({}, {}) must be within the bbox {}".format(
                 x_first, y_first, bbox
             )
         )
 
-    rows, cols = arr.shape
-    xi = (cols - 1) * np.linspace(x0, x1, out_cols, endpoint=True).reshape((1, -1))
-    yi = (rows - 1) * np.linspace(y0, y1, out_rows, endpoint=True).reshape((-1, 1))
-    dtype = arr.dtype
-    resampled = bilinear_interpolate(arr.astype(float), xi, yi)
-    if np.issubdtype(dtype, np.integer):
-        return np.round(resampled).astype(dtype)
-    else:
-        return resampled.astype(dtype)
+    xi = x0 + np.arange(out_cols) / xrate
+    yi = y0 + np.arange(out_rows) / yrate
+    return xi, yi
+
+
+def _resample_window(arr, xi, yi, dtype, method="bilinear"):
+    """Interpolate `arr` at the grid of `xi` x `yi`, cast to `dtype`"""
+    out = np.empty((len(yi), len(xi)), dtype=dtype)
+    return separable_resample(arr, xi, yi, method=method, out=out)
 
 
 def _block_iterator(arr_shape, block_shape):
@@ -7,7 +7,9 @@ Data is accessed via the ArcGIS ImageServer exportImage endpoint, which
 dynamically resamples multi-resolution 3DEP sources for a given bounding box.
 
 Vertical datum: 3DEP data is in NAVD88 (EPSG:5703). When keep_egm=False
-(the default), heights are converted to WGS84 ellipsoidal heights using GDAL.
+(the default), heights are converted to WGS84 ellipsoidal heights using GDAL,
+or with cache_geoid=True, by adding the GEOID18 undulation from the geoid tiles
+saved in the cache (see `conversions.geoid_tile`).
 
 Coverage: US and territories only (CONUS, Alaska, Hawaii, etc.)
 
@@ -23,7 +25,7 @@ import tempfile
 
 import requests
 
-from sardem import utils
+from sardem import conversions, utils
 from sardem.constants import DEFAULT_RES
 
 logger = logging.getLogger("sardem")
@@ -35,6 +37,8 @@ EXPORT_URL = (
 )
 # ArcGIS ImageServer typically limits exports; use a safe chunk size
 MAX_EXPORT_SIZE = 4000
+# Value requested for pixels without data
+NODATA = -999999
 
 
 def download_and_stitch(
@@ -43,8 +47,11 @@ def download_and_stitch(
     keep_egm=False,
     xrate=1,
     yrate=1,
+    target_shape=None,
     output_format="GTiff",
     output_type="float32",
+    cache_dir=None,
+    cache_geoid=False,
 ):
     """Download USGS 3DEP DEM data and optionally convert to WGS84 heights.
 
@@ -56,10 +63,19 @@ def download_and_stitch(
         bbox (tuple): (left, bottom, right, top) in decimal degrees
         keep_egm (bool): if True, keep NAVD88 geoid heights; if False (default),
             convert to WGS84 ellipsoidal heights
-        xrate (int): upsample factor in x (longitude) direction
-        yrate (int): upsample factor in y (latitude) direction
+        xrate (float): upsample factor in x (longitude) direction
+        yrate (float): upsample factor in y (latitude) direction
+        target_shape (tuple[int]): (rows, cols) of the output. Overrides
+            the rates if given
         output_format (str): GDAL output format (default GTiff)
         output_type (str): output pixel type (default float32)
+        cache_dir (str): where to save the downloaded chunks and geoid grids.
+            Defaults to `utils.get_cache_dir()`
+        cache_geoid (bool): warp only horizontally, then add the GEOID18
+            undulation from the geoid tiles in `cache_dir`/geoid/ (see
+            `conversions.geoid_tile`), taking NAD83 and WGS84 heights as equal
+            like PROJ's default transformation. Falls back to the PROJ warp
+            outside of the GEOID18 grid (CONUS), or if it can't be downloaded
     """
     from osgeo import gdal
 
@@ -69,12 +85,17 @@ def download_and_stitch(
     xres = DEFAULT_RES / xrate
     yres = DEFAULT_RES / yrate
 
-    total_width = int(round((right - left) / xres))
-    total_height = int(round((top - bottom) / yres))
+    if target_shape is not None:
+        total_height, total_width = target_shape
+    else:
+        total_width = int(round((right - left) / xres))
+        total_height = int(round((top - bottom) / yres))
 
     logger.info("Requesting 3DEP DEM: %d x %d pixels", total_width, total_height)
 
-    cache_dir = utils.get_cache_dir()
+    cache_dir = cache_dir or utils.get_cache_dir()
+    bounds = utils.align_bounds_to_pixel_grid(bbox)
+    add_offset = not keep_egm and cache_geoid and _fetch_geoid(bounds, cache_dir)
     tmp_files = _download_in_chunks(
         left, bottom, right, top, total_width, total_height, cache_dir
     )
@@ -94,20 +115,22 @@ def download_and_stitch(
         # Set up datum conversion
         if keep_egm:
             t_srs = s_srs = None
+        elif add_offset:
+            # Horizontal only: the geoid undulation is added afterwards
+            s_srs = "EPSG:4269"
+            t_srs = "EPSG:4326"
         else:
             # 3DEP data is NAD83 + NAVD88; convert to WGS84 ellipsoidal
             s_srs = "EPSG:4269+5703"
             t_srs = "EPSG:4326"
 
-        resamp = "bilinear" if (xrate > 1 or yrate > 1) else "nearest"
+        resamp = utils.gdal_resample_alg(xrate, yrate)
 
         option_dict = dict(
             format=output_format,
-            outputBounds=utils.align_bounds_to_pixel_grid(bbox),
+            outputBounds=bounds,
             dstSRS=t_srs,
             srcSRS=s_srs,
-            xRes=xres,
-            yRes=yres,
             outputType=gdal.GetDataTypeByName(output_type.title()),
             resampleAlg=resamp,
             multithread=True,
@@ -115,9 +138,35 @@ def download_and_stitch(
             warpOptions=["NUM_THREADS=4"],
         )
 
-        logger.info("Creating %s", output_name)
-        option_dict["callback"] = gdal.TermProgress
-        gdal.Warp(output_name, src, options=gdal.WarpOptions(**option_dict))
+        option_dict.update(utils.gdal_size_options(xres, yres, target_shape))
+        if add_offset:
+            option_dict["srcNodata"] = NODATA
+            option_dict["dstNodata"] = NODATA
+
+        def _warp(filename, warp_format, warp_type):
+            opts = dict(
+                option_dict,
+                format=warp_format,
+                outputType=gdal.GetDataTypeByName(warp_type.title()),
+            )
+            logger.info("Creating %s", filename)
+            opts["callback"] = gdal.TermProgress
+            gdal.Warp(filename, src, options=gdal.WarpOptions(**opts))
+
+        if add_offset:
+            logger.info("Adding GEOID18 undulation for heights above WGS84")
+            conversions.write_with_geoid_offset(
+                _warp,
+                output_name,
+                output_format,
+                output_type,
+                geoid="geoid18",
+                nodata=NODATA,
+                cache_dir=cache_dir,
+                use_cache=True,
+            )
+        else:
+            _warp(output_name, output_format, output_type)
     finally:
         # Clean up temp files
         for f in tmp_files:
@@ -128,6 +177,20 @@ def download_and_stitch(
             os.remove(vrt_mosaic)
 
 
+def _fetch_geoid(bounds, cache_dir):
+    """Whether the GEOID18 tiles for `bounds` could be made"""
+    try:
+        conversions.fetch_geoid("geoid18", bounds, cache_dir=cache_dir, use_cache=True)
+    except (requests.RequestException, OSError, ValueError):
+        logger.warning(
+            "No GEOID18 grid for %s: converting the heights with gdal.Warp",
+            bounds,
+            exc_info=True,
+        )
+        return False
+    return True
+
+
 def _download_in_chunks(left, bottom, right, top, total_width, total_height, cache_dir):
     """Split a large area into chunks and download each as a GeoTIFF.
 
@@ -210,7 +273,7 @@ def _download_chunk(left, bottom, right, top, width, height, cache_dir):
         "size": "{},{}".format(width, height),
         "f": "image",
         "interpolation": "RSP_BilinearInterpolation",
-        "noData": "-999999",
+        "noData": str(NODATA),
     }
 
     response = requests.get(EXPORT_URL, params=params, timeout=120)
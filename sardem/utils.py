@@ -163,6 +163,48 @@ def align_bounds_to_pixel_grid(bbox):
     )
 
 
+def gdal_size_options(xres, yres, target_shape=None):
+    """Output grid options for gdal.Warp: `target_shape` if given, else the res
+
+    Args:
+        xres (float): output pixel width in degrees
+        yres (float): output pixel height in degrees
+        target_shape (tuple[int]): (rows, cols) of the output, overriding
+            `xres`/`yres`
+
+    Examples:
+        >>> gdal_size_options(0.1, 0.2)
+        {'xRes': 0.1, 'yRes': 0.2}
+        >>> gdal_size_options(0.1, 0.2, target_shape=(30, 40))
+        {'width': 40, 'height': 30}
+    """
+    if target_shape is not None:
+        rows, cols = target_shape
+        return dict(width=cols, height=rows)
+    return dict(xRes=xres, yRes=yres)
+
+
+def gdal_resample_alg(xrate, yrate):
+    """gdal.Warp `resampleAlg` for resampling the source grid by these rates
+
+    Pixel copies use "nearest", coarser grids (e.g. multilooking) "average",
+    and upsampling "bilinear".
+
+    Examples:
+        >>> gdal_resample_alg(1, 1)
+        'nearest'
+        >>> gdal_resample_alg(0.1, 0.5)
+        'average'
+        >>> gdal_resample_alg(2, 0.5)
+        'bilinear'
+    """
+    if xrate == 1 and yrate == 1:
+        return "nearest"
+    if xrate <= 1 and yrate <= 1:
+        return "average"
+    return "bilinear"
+
+
 def coords(geojson):
     """Finds the coordinates of a geojson polygon
     Note: we are assuming one simple polygon with no holes
@@ -278,6 +320,37 @@ def get_output_size(bounds, xrate, yrate):
     return rows, cols
 
 
+def target_rates(bbox, target_res=None, target_shape=None, res=DEFAULT_RES):
+    """(xrate, yrate) resampling the `res` source grid to a target grid
+
+    The rates are floats, and may be below 1 for a coarser output.
+
+    Args:
+        bbox (tuple[float]): (left, bottom, right, top) edges of the output
+        target_res (tuple[float]): (x, y) output pixel size in degrees
+        target_shape (tuple[int]): (rows, cols) of the output over `bbox`
+        res (float): source pixel size in degrees
+
+    Examples:
+        >>> target_rates((0, 0, 1, 1), target_res=(1 / 7200, 1 / 1800))
+        (2.0, 0.5)
+        >>> target_rates((0, 0, 0.5, 1), target_shape=(3600, 3600))
+        (2.0, 1.0)
+    """
+    if (target_res is None) == (target_shape is None):
+        raise ValueError("Need exactly one of target_res or target_shape")
+    if target_res is not None:
+        xres, yres = target_res
+        if xres <= 0 or yres <= 0:
+            raise ValueError("target_res must be positive: {}".format(target_res))
+        return res / xres, res / yres
+    rows, cols = target_shape
+    if rows <= 0 or cols <= 0:
+        raise ValueError("target_shape must be positive: {}".format(target_shape))
+    left, bottom, right, top = bbox
+    return cols * res / (right - left), rows * res / (top - bottom)
+
+
 def _gdal_installed_correctly():
     cmd = "gdalinfo --help-general"
     # cmd = "gdalinfo -h"